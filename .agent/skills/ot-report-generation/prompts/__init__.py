@@ -11,7 +11,10 @@ from .standard_report import (
     get_json_user_prompt,
     get_segmentation_system_prompt,
     get_segmentation_user_prompt,
-    get_prompt_metadata
+    get_prompt_metadata,
+    SEGMENTATION_PROMPT_VERSION,
+    JSON_PROMPT_VERSION,
+    PROMPT_VERSION
 )
 
 __all__ = [
@@ -19,7 +22,10 @@ __all__ = [
     'get_json_user_prompt',
     'get_segmentation_system_prompt',
     'get_segmentation_user_prompt',
-    'get_prompt_metadata'
+    'get_prompt_metadata',
+    'SEGMENTATION_PROMPT_VERSION',
+    'JSON_PROMPT_VERSION',
+    'PROMPT_VERSION'
 ]
 
 __version__ = '1.0.0'
@@ -4,8 +4,12 @@
 此模組提供結構化生成模式所需的 prompt：
 - get_segmentation_system_prompt / get_segmentation_user_prompt：把使用者輸入拆解成領域區塊
 - get_json_system_prompt / get_json_user_prompt：針對每個領域各自生成問題分析與建議（JSON）
+- SEGMENTATION_PROMPT_VERSION / JSON_PROMPT_VERSION：prompt 內容的雜湊，app.py 的結果快取以此判斷 prompt 有沒有改過
 """
 
+import hashlib
+
+
 def get_json_system_prompt():
     """結構化生成模式的 system prompt：LLM 只負責針對「已指定的每個領域」各自產出
     問題描述與建議，領域清單、編號、排版由程式碼保證完整、不會遺漏。"""
@@ -114,8 +118,24 @@ def get_prompt_metadata():
         "name": "職能治療的早療報告",
         "description": "完整的問題分析與治療建議報告",
         "language": "zh-TW",
+        "version": PROMPT_VERSION,
         "output_sections": [
             "問題分析",
             "總結與建議"
         ]
     }
+
+
+def _prompt_version(*prompts):
+    return hashlib.sha256("\0".join(prompts).encode("utf-8")).hexdigest()[:12]
+
+
+# 用佔位文字把 user prompt 套出來一起算雜湊，模板本身改了也算 prompt 有變
+SEGMENTATION_PROMPT_VERSION = _prompt_version(
+    get_segmentation_system_prompt(), get_segmentation_user_prompt("{case_description}", ["{known_domains}"])
+)
+JSON_PROMPT_VERSION = _prompt_version(
+    get_json_system_prompt(),
+    get_json_user_prompt([{"domain": "{domain}", "case_issue": "{case_issue}", "reference": "{reference}"}])
+)
+PROMPT_VERSION = _prompt_version(SEGMENTATION_PROMPT_VERSION, JSON_PROMPT_VERSION)
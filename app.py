@@ -1,5 +1,4 @@
 import gradio as gr
-import chromadb
 import requests
 import json
 import os
@@ -9,6 +8,13 @@ import anthropic
 import base64
 from dotenv import load_dotenv
 
+from domain_taxonomy import TAXONOMY_FILENAME, DomainTaxonomy, load_taxonomy
+from embedding_cache import EmbeddingCache, normalize_text
+from ollama_embed import BatchEmbeddingUnavailable, embed_batch
+from result_cache import ResultCache, result_key
+from retrieval import retrieve_many
+from vector_store import VectorStoreHandle
+
 # 載入 .env 檔案
 load_dotenv()
 
@@ -19,13 +25,23 @@ sys.path.insert(0, SKILL_PATH)
 # 導入 prompt 模組
 from prompts import (
     get_json_system_prompt, get_json_user_prompt,
-    get_segmentation_system_prompt, get_segmentation_user_prompt
+    get_segmentation_system_prompt, get_segmentation_user_prompt,
+    SEGMENTATION_PROMPT_VERSION, JSON_PROMPT_VERSION, PROMPT_VERSION
 )
 
 # ================= 設定區 =================
 # 資料庫設定
 DB_PATH = "./local_vector_db"
 COLLECTION_NAME = "ot_reports"
+# 檢索後端："chroma"（HNSW 近似搜尋）、"numpy"（整個索引載入記憶體做精確搜尋，
+# 領域 where 條件很窄時不會漏結果；效能比較見 benchmark_vector_store.py），
+# 或 "snapshot"（跟 numpy 相同，但直接 memory map create_vector_db.py 匯出的單一 snapshot 檔，啟動只要幾毫秒，
+# 部署到其他機器時只需要複製 local_vector_db/ot_reports.snapshot 這個檔案）
+VECTOR_STORE_BACKEND = "chroma"
+# numpy 後端的壓縮存放："float32"（不壓縮）、"float16" 或 "int8"；VECTOR_STORE_DIMS 只保留前 N 維（Matryoshka 模型才適用）。
+# 壓縮時完整精度向量放在磁碟上的 memory-mapped 檔案，只用來替前幾名候選重新計分
+VECTOR_STORE_QUANTIZATION = "float32"
+VECTOR_STORE_DIMS = None
 
 # Ollama 設定 (用於 Embedding 和生成)
 OLLAMA_API_URL = "http://localhost:11434/api"
@@ -46,24 +62,61 @@ GEMINI_MODEL = "gemini-3.6-flash"
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models"
 # =========================================
 
-# 1. 資料庫連線函式
+# 跟 create_vector_db.py 共用的 embedding 快取：同樣的查詢文字不必每次重算
+EMBEDDING_CACHE = EmbeddingCache()
+# 報告結果快取：同一段個案描述、同一個模型、索引與 prompt 都沒變時直接回傳上次的報告（見 result_cache.py）
+RESULT_CACHE = ResultCache()
+
+# 1. 資料庫連線：整個程式共用一個長駐的向量庫 handle，不必每個請求重開 ChromaDB；
+#    create_vector_db.py / ingest_pipeline.py 更新索引後會自動重新載入，不必重啟網頁
+VECTOR_STORE = VectorStoreHandle(
+    VECTOR_STORE_BACKEND, DB_PATH, COLLECTION_NAME,
+    quantization=VECTOR_STORE_QUANTIZATION, dims=VECTOR_STORE_DIMS,
+    full_vectors_path=os.path.join(DB_PATH, "numpy_full_vectors.f32"),
+)
+_checked_store = None
+
 def get_chroma_collection():
-    client = chromadb.PersistentClient(path=DB_PATH)
-    return client.get_collection(COLLECTION_NAME)
-
-def get_known_domains(collection):
-    """取得資料庫裡實際存在的領域名稱清單"""
-    data = collection.get(include=["metadatas"])
-    return {m["domain"] for m in data.get("metadatas", []) if m.get("domain")}
-
-def match_canonical_domains(label, known_domains):
-    """把使用者輸入的區塊標籤對應回資料庫裡真實的領域名稱。
-    完全相同的名稱跟「子分類」名稱（例如「日常生活自理」vs「日常生活自理－飲食」）都要一起找，
-    不能只抓完全相同的就不找子分類了——不同案例可能用了不同細緻程度的領域命名。"""
-    exact = [label] if label in known_domains else []
-    contains = [d for d in known_domains if d != label and (label in d or d in label)]
-    result = exact + contains
-    return result or None
+    """依 VECTOR_STORE_BACKEND 取得向量庫，回傳的物件都有 Chroma collection 的 query/get/count 介面"""
+    global _checked_store
+    store = VECTOR_STORE.get()
+    if store is not _checked_store and VECTOR_STORE_BACKEND == "snapshot":
+        manifest = store.snapshot_manifest
+        if manifest.get("embedding_model") != EMBEDDING_MODEL:
+            print(f"⚠️ snapshot 的 embedding 模型是 {manifest.get('embedding_model')}，"
+                  f"與目前設定的 {EMBEDDING_MODEL} 不同，檢索結果會不準確")
+    _checked_store = store
+    return store
+
+_taxonomy = None
+_taxonomy_store = None
+
+def get_domain_taxonomy(collection):
+    """取得建索引時算好的領域分類表（見 domain_taxonomy.py）；向量庫重新載入時才跟著重新載入"""
+    global _taxonomy, _taxonomy_store
+    if _taxonomy is not None and collection is _taxonomy_store:
+        return _taxonomy
+
+    manifest = getattr(collection, "snapshot_manifest", None) or {}
+    path = os.path.join(DB_PATH, TAXONOMY_FILENAME)
+    if manifest.get("domain_taxonomy"):
+        taxonomy = DomainTaxonomy(manifest["domain_taxonomy"])
+    elif os.path.exists(path):
+        taxonomy = DomainTaxonomy(load_taxonomy(path))
+    else:
+        print("⚠️ 找不到領域分類表（舊版索引），改為掃描資料庫 metadata；重新執行 create_vector_db.py 即可產生")
+        taxonomy = DomainTaxonomy.from_collection(collection)
+    _taxonomy, _taxonomy_store = taxonomy, collection
+    print(f"🗂️ 已載入領域分類表：{len(taxonomy.names)} 個領域（版本 {taxonomy.version}）")
+    return taxonomy
+
+def resolve_model_id(model_choice):
+    """介面上的模型選項實際對應到的模型 ID"""
+    if model_choice == "Claude Sonnet 5 (Cloud)":
+        return CLAUDE_MODEL
+    elif model_choice == "Gemini 3.6 Flash (Cloud)":
+        return GEMINI_MODEL
+    return GENERATION_MODEL
 
 def call_llm_text(model_choice, system_prompt, user_prompt):
     """非串流呼叫，回傳完整文字（結構化 JSON 生成用，串流沒辦法邊收邊 parse JSON）。
@@ -168,6 +221,9 @@ def segment_case_with_llm(case_description, model_choice, known_domains):
 
 # 2. Embedding 函式 (將文字轉向量)
 def get_embedding(text):
+    cached = EMBEDDING_CACHE.get(EMBEDDING_MODEL, text)
+    if cached is not None:
+        return cached
     try:
         response = requests.post(
             f"{OLLAMA_API_URL}/embeddings",
@@ -175,7 +231,9 @@ def get_embedding(text):
             timeout=10
         )
         if response.status_code == 200:
-            return response.json()["embedding"]
+            embedding = response.json()["embedding"]
+            EMBEDDING_CACHE.put(EMBEDDING_MODEL, text, embedding)
+            return embedding
         else:
             print(f"Embedding Error: {response.text}")
             return None
@@ -184,29 +242,73 @@ def get_embedding(text):
         return None
 
 
+def _embed_batch(texts):
+    return embed_batch(f"{OLLAMA_API_URL}/embed", EMBEDDING_MODEL, texts, timeout=10 + 2 * len(texts))
+
+def get_embeddings(texts):
+    """多段文字一起向量化：先查 embedding 快取，沒命中的合併成一個 /api/embed 請求。
+    批次不可用（舊版 Ollama 沒有這個端點、這一批逾時或伺服器錯誤）時改為逐筆呼叫；失敗的位置回傳 None"""
+    try:
+        return EMBEDDING_CACHE.get_or_compute(EMBEDDING_MODEL, texts, _embed_batch)
+    except BatchEmbeddingUnavailable as e:
+        print(f"⚠️ 批次 embedding 不可用（{e}），改為逐筆呼叫")
+        return [get_embedding(t) for t in texts]
+    except Exception as e:
+        print(f"Ollama Connection Error: {e}")
+        return [None] * len(texts)
+
+
 # 3. 生成回應函式 (RAG 核心邏輯)
-def generate_report(case_description, model_choice):
+def generate_report(case_description, model_choice, refresh=False):
+    """refresh=True（介面上勾選「重新生成」）時不讀報告、區塊拆解與各領域生成的快取，但新的結果一樣會寫回快取"""
     print(f"\n{'='*30}")
     print(f"🚀 開始生成報告任務")
     print(f"🤖 選擇模型: {model_choice}")
-    if model_choice == "Claude Sonnet 5 (Cloud)":
-        print(f"📝 使用 API 模型 ID: {CLAUDE_MODEL}")
-    elif model_choice == "Gemini 3.6 Flash (Cloud)":
-        print(f"📝 使用 API 模型 ID: {GEMINI_MODEL}")
+    if model_choice in ("Claude Sonnet 5 (Cloud)", "Gemini 3.6 Flash (Cloud)"):
+        print(f"📝 使用 API 模型 ID: {resolve_model_id(model_choice)}")
     
     status_msg = "正在分析資料..."
     yield status_msg
     
-    # --- 步驟 A: 解析與分割區塊（固定用本地模型，跟生成用的模型無關，見 SEGMENTATION_MODEL_CHOICE） ---
     collection = get_chroma_collection()
-    known_domains = get_known_domains(collection)
 
-    try:
-        sections = segment_case_with_llm(case_description, SEGMENTATION_MODEL_CHOICE, known_domains)
-    except Exception as e:
-        print(f"❌ 區塊解析失敗: {e}")
-        yield status_msg + f"\n❌ 區塊解析失敗：{e}"
-        return
+    # 報告快取：key 涵蓋所有會影響報告的東西——正規化的輸入、生成模型、拆解區塊與 embedding 用的模型、
+    # 索引版本（索引更新後檢索結果可能不同）與 prompt 版本。舊版索引沒有版本標記，無法判斷索引有沒有變，不使用快取
+    report_key = None
+    if VECTOR_STORE.version is None:
+        print("ℹ️ 索引沒有版本標記（舊版索引），不使用報告快取；重新執行 create_vector_db.py 即可產生")
+    else:
+        report_key = result_key(normalize_text(case_description), model_choice, resolve_model_id(model_choice),
+                                GENERATION_MODEL, EMBEDDING_MODEL, VECTOR_STORE.version, PROMPT_VERSION)
+        cached = None if refresh else RESULT_CACHE.get("report", report_key)
+        if cached is not None:
+            print("⚡ 輸入、模型、索引與 prompt 都沒變，直接使用快取的報告")
+            yield cached["report"]
+            return
+    # 有任何領域的檢索或生成沒有完整成功時，這份報告不寫進快取，下次送出會重新生成
+    degraded = False
+
+    # --- 步驟 A: 解析與分割區塊（固定用本地模型，跟生成用的模型無關，見 SEGMENTATION_MODEL_CHOICE） ---
+    taxonomy = get_domain_taxonomy(collection)
+    known_domains = taxonomy.names
+
+    # 區塊拆解快取：同一段輸入只要已知領域清單、拆解 prompt 與模型都沒變，拆出來的區塊就一樣，
+    # 不必再跑一次本地模型。key 用領域名稱清單本身（prompt 只用到它），索引增刪領域時自然失效
+    segmentation_key = result_key(normalize_text(case_description), "、".join(sorted(known_domains)),
+                                  SEGMENTATION_PROMPT_VERSION, SEGMENTATION_MODEL_CHOICE,
+                                  resolve_model_id(SEGMENTATION_MODEL_CHOICE))
+    cached = None if refresh else RESULT_CACHE.get("segmentation", segmentation_key)
+    if cached is not None:
+        sections = [tuple(s) for s in cached]
+        print(f"♻️ 輸入與領域清單沒變，沿用先前的區塊拆解結果：{[s[0] for s in sections]}")
+    else:
+        try:
+            sections = segment_case_with_llm(case_description, SEGMENTATION_MODEL_CHOICE, known_domains)
+        except Exception as e:
+            print(f"❌ 區塊解析失敗: {e}")
+            yield status_msg + f"\n❌ 區塊解析失敗：{e}"
+            return
+        RESULT_CACHE.put("segmentation", segmentation_key, sections)
     print(f"📋 解析到內容區塊: {[s[0] for s in sections] if sections else '無(全域檢索)'}")
 
     if not sections:
@@ -220,47 +322,45 @@ def generate_report(case_description, model_choice):
     yield status_msg
 
     # --- 步驟 B: 只針對「對應得到資料庫真實領域」的區塊做檢索 ---
-    # 對不到領域的內容（例如「主訴」）不是評估領域，不參與檢索、也不會出現在最終報告裡
+    # 對不到領域的內容（例如「主訴」）不是評估領域，不參與檢索、也不會出現在最終報告裡。
+    # 所有區塊一起檢索：一個 embedding 請求算完全部查詢向量，各領域的過濾查詢一次做完（見 retrieval.py）
+    targets = []  # (區塊標籤, 內容, 對應到的真實領域)
     for domain, content in query_tasks:
-        matched_domains = match_canonical_domains(domain, known_domains)
+        matched_domains = taxonomy.match(domain)
         if not matched_domains:
             print(f"⏭️ 「{domain}」不是資料庫裡的評估領域，略過檢索")
             continue
+        targets.append((domain, content, matched_domains))
 
-        print(f"🔍 正在檢索領域: {domain}...")
-        status_msg += f"\n🔍 檢索「{domain}」相關資料..."
-        yield status_msg
+    embeddings = get_embeddings([f"{domain}：{content}" for domain, content, _ in targets]) if targets else []
+    embedded = [i for i, embedding in enumerate(embeddings) if embedding]
+    retrieved = dict(zip(embedded, retrieve_many(
+        collection, [embeddings[i] for i in embedded], [targets[i][2] for i in embedded],
+        recommendation_counts=[taxonomy.recommendation_count(targets[i][2]) for i in embedded],
+        chunk_counts=[taxonomy.chunk_count(targets[i][2]) for i in embedded]
+    )))
 
-        search_text = f"{domain}：{content}"
-        embedding = get_embedding(search_text)
-        if not embedding:
+    for i, (domain, _, matched_domains) in enumerate(targets):
+        print(f"🔍 正在檢索領域: {domain}...")
+        if i not in retrieved:
             print(f"❌ 「{domain}」Embedding 失敗")
             problem_domain_context[domain] = ""
+            degraded = True
             continue
-
-        # 優先用「領域」metadata 鎖定範圍，避免被其他領域但字面相似的內容打敗
-        domain_clause = (
-            {"domain": matched_domains[0]}
-            if len(matched_domains) == 1
-            else {"domain": {"$in": matched_domains}}
-        )
         # 領域內優先找「有建議內容」的案例（狀態異常、有問題分析），
         # 否則光靠 embedding 相似度容易撈到主題相近但狀態是「無異常」的案例，沒有建議可用
-        where_with_rec = {"$and": [domain_clause, {"has_recommendation": True}]}
-        results = collection.query(query_embeddings=[embedding], n_results=3, where=where_with_rec)
-        if not (results['distances'] and results['distances'][0]):
+        references, fallback = retrieved[i]
+        if fallback:
             print(f"   ℹ️ 「{domain}」領域內沒有帶建議的案例，改抓一般觀察資料")
-            results = collection.query(query_embeddings=[embedding], n_results=3, where=domain_clause)
         print(f"   🎯 鎖定領域：{matched_domains}")
 
-        domain_docs = []
-        if results['distances'] and results['distances'][0]:
-            for i, dist in enumerate(results['distances'][0][:2]):  # 最多保留前 2 筆最相似的
-                similarity = 1.0 - dist
-                if similarity > 0.3:  # 領域已鎖定，門檻可放寬，只用來濾掉完全不相關的
-                    domain_docs.append(results['documents'][0][i])
+        domain_docs = [r["document"] for r in references]
         problem_domain_context[domain] = "\n\n".join(domain_docs)
         print(f"✅ 「{domain}」檢索完成，找到 {len(domain_docs)} 筆相似資料")
+        status_msg += f"\n🔍 「{domain}」找到 {len(domain_docs)} 筆參考資料"
+        yield status_msg
+
+    print(f"🧠 {EMBEDDING_CACHE.stats_line()}")
 
     # --- 步驟 C: 生成 (Generation) ---
     print(f"🧠 準備進入 LLM 生成階段...")
@@ -291,37 +391,69 @@ def generate_report(case_description, model_choice):
             retrieval_info += "---\n\n## 🤖 開始生成報告...\n\n"
 
         # --- 結構化生成：LLM 只負責每個領域各自的內容，領域清單/編號/排版由程式碼保證完整 ---
-        yield status_msg + retrieval_info + "\n🧠 正在針對各領域生成內容..."
-
-        json_system_prompt = get_json_system_prompt()
-        json_user_prompt = get_json_user_prompt(domain_blocks)
+        # 逐領域快取：(領域, 問題描述, 參考資料, 模型, prompt 版本) 都沒變的領域直接沿用上次生成的內容，
+        # 治療師只改了某個領域的段落再送出時，只有那個領域要重新生成
+        model_id = resolve_model_id(model_choice)
+        domain_keys = {
+            b["domain"]: result_key(b["domain"], b["case_issue"], b["reference"], model_choice, model_id,
+                                    JSON_PROMPT_VERSION)
+            for b in domain_blocks
+        }
+        result_domains = {}
+        if not refresh:
+            for b in domain_blocks:
+                cached = RESULT_CACHE.get("domain", domain_keys[b["domain"]])
+                if cached is not None:
+                    result_domains[b["domain"]] = cached
+        pending = [b for b in domain_blocks if b["domain"] not in result_domains]
+        # 總結句是整份報告共用的一句固定句型，沿用快取領域當初一起生成的那句
+        course_recommendation = next(
+            (d.get("course_recommendation") for d in result_domains.values() if d.get("course_recommendation")), None
+        )
+        if result_domains:
+            print(f"♻️ {len(result_domains)} 個領域的輸入沒變，沿用先前生成的內容：{list(result_domains)}")
 
-        try:
-            raw = call_llm_text(model_choice, json_system_prompt, json_user_prompt)
-            data = parse_json_response(raw)
-        except Exception as e:
-            print(f"❌ 結構化生成失敗: {e}")
-            yield status_msg + retrieval_info + f"\n❌ 生成失敗：{e}"
-            return
+        if pending:
+            yield status_msg + retrieval_info + f"\n🧠 正在針對 {len(pending)} 個領域生成內容..."
 
-        result_domains = {d.get("domain"): d for d in data.get("domains", [])}
-        expected = {b["domain"] for b in domain_blocks}
-        missing = expected - set(result_domains.keys())
+            json_system_prompt = get_json_system_prompt()
+            json_user_prompt = get_json_user_prompt(pending)
 
-        for miss_domain in missing:
-            print(f"⚠️ 「{miss_domain}」缺漏，補呼叫一次...")
-            block = next(b for b in domain_blocks if b["domain"] == miss_domain)
             try:
-                retry_raw = call_llm_text(model_choice, json_system_prompt, get_json_user_prompt([block]))
-                retry_data = parse_json_response(retry_raw)
-                for d in retry_data.get("domains", []):
-                    result_domains[d.get("domain")] = d
+                raw = call_llm_text(model_choice, json_system_prompt, json_user_prompt)
+                data = parse_json_response(raw)
             except Exception as e:
-                print(f"   補呼叫失敗：{e}")
-
-        still_missing = expected - set(result_domains.keys())
-        if still_missing:
-            print(f"⚠️ 補呼叫後仍缺漏：{still_missing}")
+                print(f"❌ 結構化生成失敗: {e}")
+                yield status_msg + retrieval_info + f"\n❌ 生成失敗：{e}"
+                return
+
+            course_recommendation = data.get("course_recommendation") or course_recommendation
+            expected = {b["domain"] for b in pending}
+            generated = {d.get("domain"): d for d in data.get("domains", []) if d.get("domain") in expected}
+            missing = expected - set(generated.keys())
+
+            for miss_domain in missing:
+                print(f"⚠️ 「{miss_domain}」缺漏，補呼叫一次...")
+                block = next(b for b in pending if b["domain"] == miss_domain)
+                try:
+                    retry_raw = call_llm_text(model_choice, json_system_prompt, get_json_user_prompt([block]))
+                    retry_data = parse_json_response(retry_raw)
+                    for d in retry_data.get("domains", []):
+                        if d.get("domain") in expected:
+                            generated[d.get("domain")] = d
+                except Exception as e:
+                    print(f"   補呼叫失敗：{e}")
+
+            still_missing = expected - set(generated.keys())
+            if still_missing:
+                print(f"⚠️ 補呼叫後仍缺漏：{still_missing}")
+                degraded = True
+
+            for domain, d in generated.items():
+                RESULT_CACHE.put("domain", domain_keys[domain], {**d, "course_recommendation": course_recommendation})
+            result_domains.update(generated)
+        else:
+            print("♻️ 所有領域的輸入都沒變，不需要呼叫模型")
 
         # --- 組裝最終報告，領域清單由程式碼掌控，保證不會漏 ---
         # 一樣用 (d.get(key) or 預設值)，防止 LLM 把欄位明確設成 null 而不是省略或給空字串
@@ -333,7 +465,7 @@ def generate_report(case_description, model_choice):
 
         lines_out.append("")
         lines_out.append("### 總結與建議")
-        lines_out.append(f"1. {data.get('course_recommendation') or '綜合以上結果，建議安排職能療育課程'}")
+        lines_out.append(f"1. {course_recommendation or '綜合以上結果，建議安排職能療育課程'}")
         lines_out.append("")
         for idx, b in enumerate(domain_blocks, 2):
             d = result_domains.get(b["domain"])
@@ -344,7 +476,10 @@ def generate_report(case_description, model_choice):
             lines_out.append("")
 
         print("✅ 結構化生成完畢")
-        yield "\n".join(lines_out)
+        report = "\n".join(lines_out)
+        if report_key and not degraded:
+            RESULT_CACHE.put("report", report_key, {"report": report})
+        yield report
 
     else:
         # 輸入裡沒有任何內容能對應到資料庫的真實評估領域，沒有素材可以結構化生成，直接清楚告知，
@@ -505,6 +640,11 @@ with gr.Blocks(title="AI 職能治療報告助手") as demo:
                 label="選擇生成模型"
             )
 
+            refresh_check = gr.Checkbox(
+                value=False,
+                label="重新生成（不使用快取的報告）"
+            )
+
             btn_submit = gr.Button("🧠 開始生成報告", variant="primary")
 
         with gr.Column(scale=1):
@@ -517,7 +657,7 @@ with gr.Blocks(title="AI 職能治療報告助手") as demo:
         outputs=[btn_submit]
     ).then(
         fn=generate_report,
-        inputs=[input_case, model_radio],
+        inputs=[input_case, model_radio, refresh_check],
         outputs=[output_report]
     ).then(
         fn=lambda: gr.update(interactive=True, value="🧠 開始生成報告"),
@@ -525,5 +665,7 @@ with gr.Blocks(title="AI 職能治療報告助手") as demo:
     )
 
 if __name__ == "__main__":
+    # 啟動時就載入向量庫與領域分類表，第一個請求不必等
+    get_domain_taxonomy(get_chroma_collection())
     print("啟動網頁介面...")
     demo.launch(server_name="0.0.0.0", server_port=7860, theme=gr.themes.Base(), css=custom_css)
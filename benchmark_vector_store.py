@@ -0,0 +1,180 @@
+"""
+比較向量檢索後端（chroma HNSW vs numpy 暴力搜尋）與 numpy 壓縮設定的載入時間、查詢延遲與召回率
+
+查詢來源：
+- 預設：索引裡隨機抽樣的語意塊再加上一點雜訊（不需要啟動 Ollama），分兩種情境：
+  全庫檢索（不加 where），以及跟 app.generate_report 一樣的窄範圍檢索
+  {"$and": [{"domain": 領域}, {"has_recommendation": True}]}
+- --queries-file：自己的查詢，一行一筆，「領域<Tab>內容」會跟 app 一樣加上領域過濾，
+  只有內容的行則做全庫檢索（需要 Ollama 產生查詢向量，算過的會存進 embedding 快取）
+召回率以 numpy float32 的精確結果為標準答案。
+
+使用方式：
+    python3 benchmark_vector_store.py --queries 200 --k 3
+    python3 benchmark_vector_store.py --quantization --queries-file my_queries.tsv
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+from vector_store import RESCORE_FACTOR, NumpyVectorStore, open_chroma_collection
+
+# =================設定區=================
+DB_PATH = "./local_vector_db"
+COLLECTION_NAME = "ot_reports"
+NOISE_SCALE = 0.05  # 查詢向量的雜訊大小（相對於向量長度）
+# --quantization 要比較的 (壓縮方式, 保留維度比例) 組合，每組都會比較有無重新計分
+QUANTIZATION_SWEEP = [("float16", 1.0), ("int8", 1.0), ("int8", 0.5), ("int8", 0.25)]
+# =======================================
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000) if samples else 0.0
+
+
+def run_queries(store, queries, k):
+    latencies, results = [], []
+    for embedding, where in queries:
+        started = time.perf_counter()
+        res = store.query(query_embeddings=[embedding], n_results=k, where=where)
+        latencies.append(time.perf_counter() - started)
+        results.append(res["ids"][0])
+    return latencies, results
+
+
+def recall(truth, approx):
+    expected = sum(len(t) for t in truth)
+    found = sum(len(set(t) & set(a)) for t, a in zip(truth, approx))
+    return found / expected if expected else 1.0
+
+
+def sampled_queries(store, count, rng):
+    """從索引抽樣的語意塊加雜訊當查詢，回傳 {情境: [(向量, where)]}"""
+    n, dim = store.matrix.shape
+    domain_rows = [i for i, m in enumerate(store.metadatas) if m.get("domain")]
+    scenarios = {"全庫檢索": [], "領域 + has_recommendation": []}
+
+    def noisy(row):
+        noise = np.random.default_rng(rng.randrange(1 << 30)).normal(0, NOISE_SCALE / np.sqrt(dim), dim)
+        return (store.matrix[row] + noise).tolist()
+
+    for _ in range(count):
+        scenarios["全庫檢索"].append((noisy(rng.randrange(n)), None))
+        if domain_rows:
+            j = rng.choice(domain_rows)
+            where = {"$and": [{"domain": store.metadatas[j]["domain"]}, {"has_recommendation": True}]}
+            scenarios["領域 + has_recommendation"].append((noisy(j), where))
+    return scenarios
+
+
+def file_queries(path):
+    """讀取自己的查詢檔並產生查詢向量（走 embedding 快取）"""
+    from create_vector_db import EMBEDDING_MODEL, OLLAMA_EMBED_URL
+    from embedding_cache import EmbeddingCache
+
+    lines = [line.rstrip("\n") for line in open(path, encoding="utf-8") if line.strip()]
+    texts, wheres = [], []
+    for line in lines:
+        if "\t" in line:
+            domain, content = line.split("\t", 1)
+            # 跟 app.generate_report 相同的查詢文字與過濾條件
+            texts.append(f"{domain.strip()}：{content.strip()}")
+            wheres.append({"$and": [{"domain": domain.strip()}, {"has_recommendation": True}]})
+        else:
+            texts.append(line.strip())
+            wheres.append(None)
+
+    def embed(batch):
+        response = requests.post(OLLAMA_EMBED_URL, json={"model": EMBEDDING_MODEL, "input": batch}, timeout=120)
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    embeddings = EmbeddingCache().get_or_compute(EMBEDDING_MODEL, texts, embed)
+    return {f"查詢檔 {path}": list(zip(embeddings, wheres))}
+
+
+def compare_backends(collection, numpy_store, scenarios, k):
+    print(f"{'情境':<24}{'後端':<8}{'p50 (ms)':>10}{'p95 (ms)':>10}{'召回率':>10}")
+    for name, queries in scenarios.items():
+        if not queries:
+            continue
+        numpy_latency, truth = run_queries(numpy_store, queries, k)
+        chroma_latency, approx = run_queries(collection, queries, k)
+        print(f"{name:<24}{'chroma':<8}{percentile_ms(chroma_latency, 50):>10.2f}"
+              f"{percentile_ms(chroma_latency, 95):>10.2f}{recall(truth, approx):>10.3f}")
+        print(f"{'':<24}{'numpy':<8}{percentile_ms(numpy_latency, 50):>10.2f}"
+              f"{percentile_ms(numpy_latency, 95):>10.2f}{1.0:>10.3f}")
+
+
+def compare_quantization(numpy_store, scenarios, k):
+    """各種壓縮設定相對於 float32 精確搜尋的記憶體、延遲與召回率"""
+    exact = {name: run_queries(numpy_store, queries, k) for name, queries in scenarios.items() if queries}
+    data = (numpy_store.ids, numpy_store.matrix, numpy_store.documents, numpy_store.metadatas)
+    configs = [("float32", None, 0)]
+    for quantization, ratio in QUANTIZATION_SWEEP:
+        dims = int(numpy_store.dim * ratio) if ratio < 1 else None
+        configs += [(quantization, dims, 0), (quantization, dims, RESCORE_FACTOR)]
+
+    spill_dir = tempfile.TemporaryDirectory()
+    spill_path = os.path.join(spill_dir.name, "full_vectors.f32")
+    print(f"\n{'壓縮設定':<28}{'記憶體 (MB)':>12}{'情境':>6}  {'p50 (ms)':>9}{'p95 (ms)':>9}{'召回率':>8}")
+    for quantization, dims, rescore in configs:
+        # 重新計分用的完整精度向量跟 app 一樣放在 memory-mapped 檔案，不計入常駐記憶體
+        store = NumpyVectorStore(*data, quantization=quantization, dims=dims, rescore_factor=rescore,
+                                 full_vectors_path=spill_path)
+        label = f"{quantization}{f' {dims}維' if dims else ''}{f' +重新計分×{rescore}' if store.rescore_factor else ''}"
+        for i, (name, (_, truth)) in enumerate(exact.items()):
+            latency, approx = run_queries(store, scenarios[name], k)
+            head = f"{label:<28}{store.memory_bytes() / 1024 / 1024:>12.1f}" if i == 0 else " " * 40
+            print(f"{head}{i + 1:>6}  {percentile_ms(latency, 50):>9.2f}{percentile_ms(latency, 95):>9.2f}"
+                  f"{recall(truth, approx):>8.3f}")
+    spill_dir.cleanup()
+    print("\n情境編號：" + "、".join(f"{i + 1}={name}" for i, name in enumerate(exact)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較 chroma 與 numpy 向量檢索後端、以及 numpy 壓縮設定")
+    parser.add_argument("--queries", type=int, default=200, help="抽樣查詢時每種情境的查詢數")
+    parser.add_argument("--queries-file", default=None, help="自己的查詢檔（每行「領域<Tab>內容」或純文字）")
+    parser.add_argument("--k", type=int, default=3, help="每次查詢取回的筆數")
+    parser.add_argument("--quantization", action="store_true", help="比較 numpy 後端的各種壓縮設定")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print("=" * 60)
+    print("向量檢索後端效能比較")
+    print("=" * 60)
+
+    started = time.perf_counter()
+    collection = open_chroma_collection(args.db_path, args.collection)
+    collection.query(query_embeddings=[collection.get(limit=1, include=["embeddings"])["embeddings"][0]],
+                     n_results=1)  # 第一次查詢才會載入 HNSW
+    chroma_load = time.perf_counter() - started
+
+    started = time.perf_counter()
+    numpy_store = NumpyVectorStore.from_chroma(collection)
+    numpy_load = time.perf_counter() - started
+    n, dim = numpy_store.matrix.shape
+    print(f"資料量: {n} 筆，{dim} 維（numpy 矩陣 {numpy_store.memory_bytes() / 1024 / 1024:.1f} MB）")
+    print(f"載入時間: chroma {chroma_load:.2f} 秒，numpy {numpy_load:.2f} 秒\n")
+    if n == 0:
+        return
+
+    scenarios = file_queries(args.queries_file) if args.queries_file else sampled_queries(numpy_store, args.queries, rng)
+    compare_backends(collection, numpy_store, scenarios, args.k)
+    if args.quantization:
+        compare_quantization(numpy_store, scenarios, args.k)
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+建索引時合併近乎重複的語意塊
+
+很多歷史報告的建議段落幾乎是逐字沿用，拆出來的領域塊只差個案名字或幾個字。
+全部放進索引會讓索引變大，檢索時前 2 名參考資料也常常是同一段內容。
+
+做法：
+- 每個語意塊以字元 5-gram 做 MinHash 簽章（64 個排列），存在 dedup_registry.sqlite3
+- 只合併領域塊：同一組（domain + has_recommendation）內，用 LSH 分桶找候選，估計的 Jaccard 相似度
+  ≥ DEDUP_THRESHOLD 的塊合併成一群；每群的成員都要跟代表塊本身相似（不做遞移合併）
+- 增量建索引時只重新分群有變動的塊、它們原本所在的群，以及落在同一個 LSH 分桶的代表塊
+- 每群只寫一個代表塊進 ChromaDB，metadata 記下合併了哪些報告（merged_sources）與幾個塊（merged_count）
+
+登錄表記錄所有「邏輯上」的語意塊（每份報告拆出來的全部塊，含文字與 metadata），以及目前實際寫入
+ChromaDB 的代表塊與上次的分群結果；每批寫入前重新分群有變動的部分，再跟上次寫入的內容比對，只更新有變的代表塊。
+語意塊 id 來自 JSON 裡的 source_file，兩個 JSON 可能拆出同一個 id（例如複製出來的 JSON），所以登錄表以
+（id, 報告）為 key，各自登錄；同一個 id 以檔名最前面的報告為準，要所有報告都移除了這個 id 才會從索引刪掉。
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# =================設定區=================
+DEDUP_THRESHOLD = 0.85  # 估計 Jaccard 相似度達到這個值就視為近乎重複；None 表示不合併
+SHINGLE_SIZE = 5        # 字元 n-gram 長度（中文以字為單位）
+NUM_PERM = 64           # MinHash 排列數
+LSH_BANDS = 16          # LSH 分桶數（每桶 NUM_PERM // LSH_BANDS 個排列）
+# =======================================
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_PERM_SEED = 20240601  # 固定種子：簽章要跨次執行可比
+_rng = np.random.RandomState(_PERM_SEED)
+# 簽章參數改了，登錄表裡存的簽章就要全部重算
+SIGNATURE_PARAMS = f"{SHINGLE_SIZE}-{NUM_PERM}-{_PERM_SEED}"
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """文字的 MinHash 簽章（NUM_PERM 個 uint32）"""
+    text = " ".join(unicodedata.normalize("NFC", text).split())
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if codes.size < SHINGLE_SIZE:
+        codes = np.pad(codes, (0, SHINGLE_SIZE - codes.size))
+    # 每個 n-gram 的多項式雜湊（向量化計算，不逐字迴圈）
+    count = codes.size - SHINGLE_SIZE + 1
+    shingles = np.zeros(count, dtype=np.uint64)
+    for j in range(SHINGLE_SIZE):
+        shingles = (shingles * np.uint64(1000003) + codes[j:j + count]) % np.uint64(_MERSENNE_PRIME)
+    shingles = np.unique(shingles)
+    hashed = (_PERM_A[:, None] * shingles[None, :] + _PERM_B[:, None]) % np.uint64(_MERSENNE_PRIME)
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def group_key(chunk_type: Optional[str], domain: Optional[str], has_recommendation) -> Optional[str]:
+    """只有領域、是否有建議都相同的領域塊才會合併（合併後 where 過濾的結果不變）；
+    profile 塊代表個案本身，不合併（回傳 None）"""
+    if chunk_type != "assessment_domain":
+        return None
+    return f"{domain or ''}|{bool(has_recommendation)}"
+
+
+def bucket_keys(group: Optional[str], signature: np.ndarray) -> List[bytes]:
+    """一個塊落在的 LSH 分桶（分組 + 第幾桶 + 該桶的排列值）；不合併的塊沒有分桶"""
+    if group is None:
+        return []
+    rows = NUM_PERM // LSH_BANDS
+    return [f"{band}|{group}|".encode("utf-8") + signature[band * rows:(band + 1) * rows].tobytes()
+            for band in range(LSH_BANDS)]
+
+
+def cluster_signatures(groups: List[Optional[str]], signatures: np.ndarray, threshold: Optional[float],
+                       preferred: Sequence[int] = (), fixed: Sequence[int] = ()) -> List[int]:
+    """回傳每個塊所屬群的代表索引。
+    依序挑代表（fixed、preferred 裡的塊優先，其餘照索引順序），代表只收跟它本身相似的塊：
+    不做遞移合併，A~B、B~C 時不會把不相似的 A、C 併成一群（否則代表塊的文字蓋不住 C 的內容）。
+    fixed 是已經確定的代表塊（增量分群時沿用的群），一定自成一群，不會被併進別的群"""
+    leader = list(range(len(groups)))
+    if threshold is None or len(groups) < 2:
+        return leader
+    rows = NUM_PERM // LSH_BANDS
+    neighbours: Dict[int, set] = {}
+    for band in range(LSH_BANDS):
+        buckets: Dict[Tuple[str, bytes], List[int]] = {}
+        band_bytes = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        for i, group in enumerate(groups):
+            if group is None:
+                continue
+            buckets.setdefault((group, band_bytes[i].tobytes()), []).append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            sigs = signatures[members]
+            similar = (sigs[:, None, :] == sigs[None, :, :]).mean(axis=2) >= threshold
+            for a, b in zip(*np.nonzero(np.triu(similar, k=1))):
+                neighbours.setdefault(members[a], set()).add(members[b])
+                neighbours.setdefault(members[b], set()).add(members[a])
+
+    fixed_set = set(fixed)
+    order = list(dict.fromkeys([*fixed, *preferred, *range(len(groups))]))
+    assigned = [False] * len(groups)
+    for i in order:
+        if assigned[i]:
+            continue
+        assigned[i] = True
+        for j in sorted(neighbours.get(i, ())):
+            if not assigned[j] and j not in fixed_set:
+                assigned[j] = True
+                leader[j] = i
+    return leader
+
+
+class DedupRegistry:
+    """語意塊登錄表（SQLite）：chunks 是每份報告的全部邏輯塊，physical 是目前寫入 ChromaDB 的代表塊"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._pending = None  # plan 算出、還沒存進登錄表的分群結果
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            primary_key = [row[1] for row in sorted(self._conn.execute("PRAGMA table_info(chunks)"),
+                                                    key=lambda row: row[5]) if row[5]]
+            if primary_key == ["id"]:
+                # 舊版以 id 為 key：同一個 id 只能屬於一份報告，改成（id, 報告）後把資料搬過去
+                self._conn.execute("ALTER TABLE chunks RENAME TO chunks_by_id")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    id TEXT,
+                    source TEXT,
+                    chunk_hash TEXT,
+                    signature BLOB,
+                    text TEXT,
+                    metadata TEXT,
+                    PRIMARY KEY (id, source)
+                )""")
+            if primary_key == ["id"]:
+                self._conn.execute("INSERT INTO chunks SELECT * FROM chunks_by_id")
+                self._conn.execute("DROP TABLE chunks_by_id")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+            # 每個 id 實際使用的那一筆（多份報告都有這個 id 時取檔名最前面的）
+            self._conn.execute("""
+                CREATE VIEW IF NOT EXISTS effective_chunks AS
+                SELECT * FROM chunks c WHERE c.source = (SELECT MIN(source) FROM chunks d WHERE d.id = c.id)""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS physical (
+                    id TEXT PRIMARY KEY,
+                    chunk_hash TEXT,
+                    payload_hash TEXT
+                )""")
+            # 上次分群的結果：每個邏輯塊屬於哪個代表塊、落在哪些 LSH 分桶；dirty 是之後新增／刪除／內容有變、
+            # 還沒重新分群的 id
+            self._conn.execute("CREATE TABLE IF NOT EXISTS clusters (id TEXT PRIMARY KEY, rep TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS clusters_rep ON clusters (rep)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lsh_buckets (bucket BLOB, id TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lsh_buckets_bucket ON lsh_buckets (bucket)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lsh_buckets_id ON lsh_buckets (id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS dirty (id TEXT PRIMARY KEY)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'signature_params'").fetchone()
+            if not row or row[0] != SIGNATURE_PARAMS:
+                self._resign()
+
+    def _resign(self):
+        """簽章參數改了：用存著的文字重算所有簽章（只有升級後第一次開啟時會發生）"""
+        rows = self._conn.execute("SELECT id, source, text FROM chunks").fetchall()
+        self._conn.executemany("UPDATE chunks SET signature = ? WHERE id = ? AND source = ?",
+                               [(minhash_signature(text).tobytes(), chunk_id, source)
+                                for chunk_id, source, text in rows])
+        self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('signature_params', ?)", (SIGNATURE_PARAMS,))
+        # 簽章變了，上次的分群與分桶都不能用，下次整個重新分群
+        self._conn.execute("DELETE FROM meta WHERE key = 'cluster_threshold'")
+
+    def _select_in(self, sql: str, ids: Sequence) -> List[Tuple]:
+        """sql 裡的 {} 換成 ids 的佔位符，分段查詢（SQLite 參數個數有上限）"""
+        ids = list(ids)
+        rows = []
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            rows.extend(self._conn.execute(sql.format(",".join("?" * len(part))), part))
+        return rows
+
+    def reset(self):
+        with self._lock, self._conn:
+            for table in ("chunks", "physical", "clusters", "lsh_buckets", "dirty"):
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.execute("DELETE FROM meta WHERE key = 'cluster_threshold'")
+        self._pending = None
+
+    def replace_source(self, source: str, chunks: List[Dict], hashes: List[str]):
+        """換掉一份報告的全部邏輯塊；內容沒變的塊沿用舊簽章，不必重算"""
+        with self._lock, self._conn:
+            previous = {
+                row[0]: (row[1], row[2]) for row in self._conn.execute(
+                    "SELECT id, chunk_hash, signature FROM chunks WHERE source = ?", (source,))
+            }
+            self._conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            rows = []
+            for chunk, chunk_hash in zip(chunks, hashes):
+                old = previous.get(chunk["id"])
+                signature = old[1] if old and old[0] == chunk_hash else minhash_signature(chunk["text"]).tobytes()
+                rows.append((chunk["id"], source, chunk_hash, signature,
+                             chunk["text"], json.dumps(chunk["metadata"], ensure_ascii=False)))
+            self._conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)", rows)
+            current = {chunk["id"]: chunk_hash for chunk, chunk_hash in zip(chunks, hashes)}
+            changed = [chunk_id for chunk_id in previous.keys() | current.keys()
+                       if previous.get(chunk_id, (None,))[0] != current.get(chunk_id)]
+            self._conn.executemany("INSERT OR IGNORE INTO dirty VALUES (?)", [(i,) for i in changed])
+
+    def remove_source(self, source: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO dirty SELECT id FROM chunks WHERE source = ?", (source,))
+            self._conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+
+    def plan(self, threshold: Optional[float]) -> Tuple[Dict[str, Dict], List[str]]:
+        """重新分群，回傳 (新的或成員有變的代表塊 {id: {"chunk_hash", "payload_hash", "sources", "members"}},
+        不再是代表塊的 id)。
+        只有上次分群後有變動的塊、它們原本所在的群，以及跟它們落在同一個 LSH 分桶的代表塊會重新分群，
+        其餘的群沿用上次的結果；第一次分群或改了門檻、簽章參數時才整個重新分群。
+        代表塊優先沿用目前已寫入的那一塊，避免每次分群都換代表、重新寫入。
+        新的分群結果要等 set_physical（ChromaDB 寫完）才存進登錄表，中途失敗時下次會重做"""
+        threshold_key = "" if threshold is None else repr(float(threshold))
+        columns = """id, chunk_hash, signature, json_extract(metadata, '$.source_file'),
+                     json_extract(metadata, '$.type'), json_extract(metadata, '$.domain'),
+                     json_extract(metadata, '$.has_recommendation')"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'cluster_threshold'").fetchone()
+            full = not row or row[0] != threshold_key
+            if full:
+                dirty = []
+                dissolved = [r[0] for r in self._conn.execute("SELECT id FROM physical")]
+                loose_rows = self._conn.execute(f"SELECT {columns} FROM effective_chunks ORDER BY id").fetchall()
+                loose = [r[0] for r in loose_rows]
+            else:
+                dirty = [r[0] for r in self._conn.execute("SELECT id FROM dirty")]
+                if not dirty:
+                    self._pending = None
+                    return {}, []
+                # 有變動的塊原本所在的群整個拆開，群裡其他塊也要重新分
+                dissolved = sorted({r[0] for r in self._select_in("SELECT rep FROM clusters WHERE id IN ({})", dirty)})
+                loose = sorted(set(dirty) | {r[0] for r in self._select_in(
+                    "SELECT id FROM clusters WHERE rep IN ({})", dissolved)})
+                loose_rows = self._select_in(f"SELECT {columns} FROM effective_chunks WHERE id IN ({{}}) ORDER BY id",
+                                             loose)
+            loose_signatures = [np.frombuffer(r[2], dtype=np.uint32) for r in loose_rows]
+            buckets = [(bucket, r[0]) for r, signature in zip(loose_rows, loose_signatures)
+                       for bucket in bucket_keys(group_key(*r[4:7]), signature)]
+            # 跟重新分群的塊落在同一個分桶、沿用的群的代表塊：重新分群的塊可以併進這些群
+            fixed_rows = []
+            if not full and threshold is not None:
+                skip = set(loose) | set(dissolved)
+                candidates = sorted({r[0] for r in self._select_in(
+                    "SELECT l.id FROM lsh_buckets l JOIN clusters c ON c.id = l.id AND c.rep = l.id "
+                    "WHERE l.bucket IN ({})", {bucket for bucket, _ in buckets})} - skip)
+                fixed_rows = self._select_in(f"SELECT {columns} FROM effective_chunks WHERE id IN ({{}}) ORDER BY id",
+                                             candidates)
+            # 只有代表塊會寫進 ChromaDB，重新分群的塊裡目前已寫入的就是被拆開的群的代表塊
+            physical = set(dissolved)
+
+            rows = fixed_rows + loose_rows
+            plan = {}
+            assignments = []
+            if rows:
+                ids = [r[0] for r in rows]
+                signatures = np.stack([np.frombuffer(r[2], dtype=np.uint32) for r in fixed_rows] + loose_signatures)
+                leaders = cluster_signatures(
+                    [group_key(*r[4:7]) for r in rows], signatures, threshold,
+                    preferred=[i for i in range(len(fixed_rows), len(rows)) if ids[i] in physical],
+                    fixed=range(len(fixed_rows)))
+                clusters: Dict[int, List[str]] = {}
+                for i in range(len(fixed_rows), len(rows)):
+                    assignments.append((ids[i], ids[leaders[i]]))
+                    clusters.setdefault(leaders[i], []).append(rows[i][3] or "")
+                # 沿用的群有新成員時，連同原本的成員重算來源
+                kept = self._select_in("""
+                    SELECT c.rep, json_extract(e.metadata, '$.source_file') FROM clusters c
+                    JOIN effective_chunks e ON e.id = c.id WHERE c.rep IN ({})""",
+                                       [ids[i] for i in clusters if i < len(fixed_rows)])
+                index = {chunk_id: i for i, chunk_id in enumerate(ids)}
+                for rep_id, source in kept:
+                    clusters[index[rep_id]].append(source or "")
+                for rep, member_sources in clusters.items():
+                    sources = sorted(set(member_sources))
+                    payload = json.dumps([rows[rep][1], sources, len(member_sources)], ensure_ascii=False)
+                    plan[ids[rep]] = {
+                        "chunk_hash": rows[rep][1],
+                        "payload_hash": hashlib.sha256(payload.encode("utf-8")).hexdigest(),
+                        "sources": sources,
+                        "members": len(member_sources),
+                    }
+        self._pending = {"full": full, "threshold": threshold_key, "dirty": dirty, "loose": loose,
+                         "clusters": assignments, "buckets": buckets}
+        return plan, [chunk_id for chunk_id in dissolved if chunk_id not in plan]
+
+    def physical(self, ids: Optional[Sequence[str]] = None) -> Dict[str, Tuple[str, str]]:
+        """目前寫入 ChromaDB 的代表塊 {id: (chunk_hash, payload_hash)}（可只查指定的 id）"""
+        with self._lock:
+            rows = (self._conn.execute("SELECT * FROM physical") if ids is None
+                    else self._select_in("SELECT * FROM physical WHERE id IN ({})", ids))
+            return {row[0]: (row[1], row[2]) for row in rows}
+
+    def physical_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM physical").fetchone()[0]
+
+    def counts(self) -> Tuple[int, int]:
+        """(邏輯語意塊數, 代表塊數)"""
+        with self._lock:
+            logical = self._conn.execute("SELECT COUNT(*) FROM effective_chunks").fetchone()[0]
+            return logical, self._conn.execute("SELECT COUNT(*) FROM physical").fetchone()[0]
+
+    def set_physical(self, plan: Dict[str, Dict], removed: Sequence[str] = ()):
+        """ChromaDB 寫完後記下新的代表塊（plan 的回傳值），連同這次的分群結果一起存進登錄表"""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM physical WHERE id = ?", [(chunk_id,) for chunk_id in removed])
+            self._conn.executemany("INSERT OR REPLACE INTO physical VALUES (?, ?, ?)", [
+                (chunk_id, entry["chunk_hash"], entry["payload_hash"]) for chunk_id, entry in plan.items()
+            ])
+            pending, self._pending = self._pending, None
+            if not pending:
+                return
+            if pending["full"]:
+                for table in ("clusters", "lsh_buckets", "dirty"):
+                    self._conn.execute(f"DELETE FROM {table}")
+            else:
+                loose = [(chunk_id,) for chunk_id in pending["loose"]]
+                self._conn.executemany("DELETE FROM clusters WHERE id = ?", loose)
+                self._conn.executemany("DELETE FROM lsh_buckets WHERE id = ?", loose)
+                self._conn.executemany("DELETE FROM dirty WHERE id = ?", [(i,) for i in pending["dirty"]])
+            self._conn.executemany("INSERT INTO clusters VALUES (?, ?)", pending["clusters"])
+            self._conn.executemany("INSERT INTO lsh_buckets VALUES (?, ?)", pending["buckets"])
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('cluster_threshold', ?)", (pending["threshold"],))
+
+    def version(self) -> str:
+        """目前寫入 ChromaDB 的內容（代表塊 id 與內容雜湊）的版本，內容一樣就是同一個版本"""
+        digest = hashlib.sha256()
+        with self._lock:
+            for chunk_id, payload_hash in self._conn.execute("SELECT id, payload_hash FROM physical ORDER BY id"):
+                digest.update(f"{chunk_id}\0{payload_hash}\n".encode("utf-8"))
+        return digest.hexdigest()[:12]
+
+    def domain_counts(self) -> Dict[str, Dict[str, int]]:
+        """索引裡（代表塊）每個領域的語意塊數與有建議的語意塊數，給領域分類表用"""
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT json_extract(c.metadata, '$.domain'),
+                       COUNT(*), SUM(COALESCE(json_extract(c.metadata, '$.has_recommendation'), 0))
+                FROM physical p JOIN effective_chunks c ON c.id = p.id
+                WHERE json_extract(c.metadata, '$.domain') IS NOT NULL
+                GROUP BY 1""").fetchall()
+        return {domain: {"chunks": count, "with_recommendation": int(with_rec or 0)}
+                for domain, count, with_rec in rows}
+
+    def payloads(self, ids: List[str]) -> Dict[str, Tuple[str, Dict]]:
+        """代表塊的文字與原始 metadata"""
+        result = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                part = ids[start:start + 500]
+                for chunk_id, text, metadata in self._conn.execute(
+                        f"SELECT id, text, metadata FROM effective_chunks WHERE id IN ({','.join('?' * len(part))})", part):
+                    result[chunk_id] = (text, json.loads(metadata))
+        return result
@@ -1,23 +1,137 @@
 import os
 import json
+import hashlib
+import argparse
+import threading
+import time
 import chromadb
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import requests
 from datetime import datetime
 
+from chunk_dedup import DEDUP_THRESHOLD, DedupRegistry
+from domain_taxonomy import TAXONOMY_FILENAME, build_taxonomy, load_taxonomy, save_taxonomy
+from embedding_cache import EmbeddingCache
+from ollama_embed import BatchEmbeddingUnavailable, embed_batch
+from vector_store import export_snapshot, snapshot_path, write_index_version
+
 # =================設定區=================
 # 向量資料庫儲存路徑 (會存在您的專案資料夾下)
 DB_PATH = "./local_vector_db"
 COLLECTION_NAME = "ot_reports"
 
 # Ollama 設定
-OLLAMA_BASE_URL = "http://localhost:11434/api/embeddings"
+OLLAMA_BASE_URL = "http://localhost:11434/api/embeddings"   # 單筆 embedding（舊版 Ollama 也支援）
+OLLAMA_EMBED_URL = "http://localhost:11434/api/embed"       # 一次送多筆 input 的批次 embedding
 EMBEDDING_MODEL = "nomic-embed-text"  # 務必確認已執行 ollama pull nomic-embed-text
+EMBEDDING_BATCH_SIZE = 64  # 每個 /api/embed 請求帶幾個語意塊
+
+# 平行建索引：JSON 讀取/拆塊用 process pool，embedding 請求用 thread pool 同時送出，
+# 寫入 ChromaDB 則累積成大批次一次 upsert（要讓 embedding 真的並行，Ollama 需設定 OLLAMA_NUM_PARALLEL）
+DEFAULT_LOAD_WORKERS = os.cpu_count() or 1
+DEFAULT_EMBED_WORKERS = 2
+UPSERT_BATCH_SIZE = 2000  # 每次 upsert 的語意塊數（會再受 ChromaDB 的 max_batch_size 限制）
+
+# 增量建索引紀錄（每個 JSON 的內容雜湊與它產生的語意塊），放在資料庫資料夾裡跟著索引走
+INDEX_MANIFEST_FILENAME = "index_manifest.json"
+# 拆塊格式版本：修改 process_json_to_chunks 產生的語意塊內容或 metadata 時要手動加一，所有檔案才會重新拆塊比對
+# （只改註解或排版不用動；內容沒變的語意塊重新拆塊後也不會重新向量化）
+CHUNKER_VERSION = "1"
+# 近乎重複語意塊的登錄表（MinHash 簽章與目前寫入的代表塊），見 chunk_dedup.py
+DEDUP_REGISTRY_FILENAME = "dedup_registry.sqlite3"
 # =======================================
 
+
+class IndexManifest:
+    """增量建索引紀錄：以結構化 JSON 檔名為 key，記下檔案 SHA-256 與寫入索引的每個語意塊（id → 內容雜湊）。
+    檔案雜湊、拆塊邏輯版本、embedding 模型都沒變的檔案直接跳過；有變的檔案只重新向量化內容有變的塊，
+    不再產生的舊塊 id 從索引刪除。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.exists = self.path.exists()
+        data = {}
+        if self.exists:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        self.embedding_model = data.get("embedding_model")
+        self.sources = data.get("sources", {})
+
+    def is_current(self, name: str, sha256: str, chunker_version: str) -> bool:
+        entry = self.sources.get(name)
+        return bool(entry and entry.get("sha256") == sha256 and entry.get("chunker_version") == chunker_version)
+
+    def current_sha256(self, name: str, chunker_version: str) -> Optional[str]:
+        """拆塊邏輯沒變時回傳上次寫入的檔案雜湊（給平行讀檔的 worker 判斷能不能跳過）"""
+        entry = self.sources.get(name)
+        if entry and entry.get("chunker_version") == chunker_version:
+            return entry.get("sha256")
+        return None
+
+    def chunk_hashes(self, name: str) -> Dict[str, str]:
+        return (self.sources.get(name) or {}).get("chunks", {})
+
+    def reset(self, embedding_model: str):
+        self.embedding_model = embedding_model
+        self.sources = {}
+
+    def record(self, name: str, sha256: str, chunker_version: str, chunks: Dict[str, str],
+               extraction: Dict[str, str] = None):
+        with self._lock:
+            self.sources[name] = {
+                "sha256": sha256,
+                "chunker_version": chunker_version,
+                "chunks": chunks,
+                **(extraction or {}),
+                "indexed_at": datetime.now().isoformat(),
+            }
+
+    def extraction_versions(self) -> Dict[str, List[str]]:
+        """索引裡所有報告用到的萃取 prompt 版本與萃取模型（寫進 snapshot manifest）"""
+        return {
+            key + "s": sorted({entry[key] for entry in self.sources.values() if entry.get(key)})
+            for key in ("extraction_prompt_version", "extraction_model")
+        }
+
+    def remove(self, name: str):
+        with self._lock:
+            self.sources.pop(name, None)
+
+    def save(self):
+        # record/remove 只改記憶體，一批寫完再存一次（每個檔案都重寫整份紀錄，檔案多時會變成 O(n²)）
+        # 先寫暫存檔再取代，避免中途中斷留下寫一半的紀錄
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"embedding_model": self.embedding_model, "sources": self.sources},
+                      f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def extraction_info(data: Dict) -> Dict[str, str]:
+    """結構化 JSON 裡記錄的萃取 prompt 版本與模型（extract_report.save_extraction_result 寫入）"""
+    return {key: data[key] for key in ("extraction_prompt_version", "extraction_model") if data.get(key)}
+
+
+def chunk_hash(chunk: Dict) -> str:
+    """語意塊內容（文字 + metadata）的雜湊，用來判斷這個 id 需不需要重新寫入"""
+    payload = json.dumps({"text": chunk["text"], "metadata": chunk["metadata"]}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
 class LocalRAGBuilder:
-    def __init__(self):
+    def __init__(self, batch_size: int = EMBEDDING_BATCH_SIZE, use_embedding_cache: bool = True,
+                 embed_workers: int = 1, dedup_threshold: Optional[float] = DEDUP_THRESHOLD):
+        # 所有 embedding 請求共用同一個 HTTP 連線池，不用每次重新建立連線
+        self.session = requests.Session()
+        self.batch_size = max(1, batch_size)
+        self.embed_workers = max(1, embed_workers)
+        self.batch_supported = True  # 伺服器不支援 /api/embed 時改回逐筆呼叫
+        # 跟 app.py 共用的 embedding 快取：內容沒變的語意塊重建索引時不必重算
+        self.embedding_cache = EmbeddingCache() if use_embedding_cache else None
+
         print(f"初始化 ChromaDB (路徑: {DB_PATH})...")
         self.client = chromadb.PersistentClient(path=DB_PATH)
         
@@ -28,11 +142,18 @@ class LocalRAGBuilder:
             metadata={"hnsw:space": "cosine"}
         )
         print(f"目前資料庫內已有 {self.collection.count()} 筆資料")
+        max_batch = getattr(self.client, "get_max_batch_size", lambda: UPSERT_BATCH_SIZE)()
+        self.upsert_batch_size = min(UPSERT_BATCH_SIZE, max_batch)
+
+        self.manifest = IndexManifest(Path(DB_PATH) / INDEX_MANIFEST_FILENAME)
+        # 每份報告的全部語意塊都登錄在這裡，近乎重複的塊只寫一個代表塊進 ChromaDB
+        self.registry = DedupRegistry(Path(DB_PATH) / DEDUP_REGISTRY_FILENAME)
+        self.dedup_threshold = dedup_threshold
 
     def get_embedding(self, text: str) -> List[float]:
         """呼叫 Ollama 產生向量"""
         try:
-            response = requests.post(
+            response = self.session.post(
                 OLLAMA_BASE_URL,
                 json={
                     "model": EMBEDDING_MODEL,
@@ -47,7 +168,8 @@ class LocalRAGBuilder:
             print("請確認 Ollama 已啟動，且已下載模型: ollama pull nomic-embed-text")
             raise
 
-    def process_json_to_chunks(self, data: Dict) -> List[Dict]:
+    @staticmethod
+    def process_json_to_chunks(data: Dict) -> List[Dict]:
         """將結構化 JSON 拆解為語意塊：每個領域只帶「自己領域」的問題分析與建議，
         不再把全案的建議混進每一個領域塊裡（避免跨領域污染）。"""
         chunks = []
@@ -62,7 +184,8 @@ class LocalRAGBuilder:
             "child_name": name,
             "child_age": age,
             "source_file": source_file,
-            "processed_at": datetime.now().isoformat()
+            # 用萃取時間而不是建索引的當下，內容沒變的塊 metadata 才會一模一樣，增量建索引時可以跳過
+            "processed_at": data.get("processed_at") or ""
         }
 
         # 1. 領域塊：觀察數據 + 只屬於這個領域的問題分析與建議
@@ -133,33 +256,203 @@ class LocalRAGBuilder:
 
         return chunks
 
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """一次向 Ollama 的 /api/embed 送出多筆文字；舊版 Ollama 沒有這個端點時之後都改為逐筆呼叫，
+        這一批逾時或伺服器錯誤（5xx）時只有這一批改為逐筆呼叫（見 ollama_embed.py）"""
+        if not self.batch_supported or len(texts) == 1:
+            return [self.get_embedding(t) for t in texts]
+        try:
+            return embed_batch(OLLAMA_EMBED_URL, EMBEDDING_MODEL, texts, timeout=30 + 5 * len(texts),
+                               session=self.session)
+        except BatchEmbeddingUnavailable as e:
+            if e.permanent:
+                print(f"  ⚠️ 批次 embedding 不可用（{e}），改為逐筆呼叫 {OLLAMA_BASE_URL}")
+                self.batch_supported = False
+            else:
+                print(f"  ⚠️ 這批 embedding 失敗（{e}），這批改為逐筆呼叫")
+            return [self.get_embedding(t) for t in texts]
+        except Exception as e:
+            print(f"向量化失敗: {e}")
+            print("請確認 Ollama 已啟動，且已下載模型: ollama pull nomic-embed-text")
+            raise
+
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """每 batch_size 段文字合併成一個請求"""
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings.extend(self.get_embeddings(texts[start:start + self.batch_size]))
+        return embeddings
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if self.embedding_cache is None:
+            return self._embed_texts(texts)
+        return self.embedding_cache.get_or_compute(EMBEDDING_MODEL, texts, self._embed_texts)
+
+    def embed_chunks(self, chunks: List[Dict]) -> List[List[float]]:
+        """為每個塊產生 embedding（先查 embedding 快取，只有沒命中的才呼叫 Ollama）。
+        embed_workers > 1 時每個 batch_size 的批次交給不同執行緒同時送出"""
+        texts = [c["text"] for c in chunks]
+        if self.embed_workers <= 1 or len(texts) <= self.batch_size:
+            return self._embed_batch(texts)
+        batches = [texts[start:start + self.batch_size] for start in range(0, len(texts), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.embed_workers) as pool:
+            return [emb for batch in pool.map(self._embed_batch, batches) for emb in batch]
+
+    def upsert_chunks(self, chunks: List[Dict], embeddings: List[List[float]]):
+        """Upsert (如果 id 存在就更新，不然就新增)；超過 ChromaDB 單次上限時分段寫入"""
+        for start in range(0, len(chunks), self.upsert_batch_size):
+            part = chunks[start:start + self.upsert_batch_size]
+            self.collection.upsert(
+                ids=[c["id"] for c in part],
+                documents=[c["text"] for c in part],
+                embeddings=embeddings[start:start + self.upsert_batch_size],
+                metadatas=[c["metadata"] for c in part]
+            )
+
+    def plan_source(self, name: str, chunks: List[Dict]) -> Tuple[List[Dict], List[str]]:
+        """比對紀錄，回傳 (內容有變或新增、需要重新寫入的塊, 不再產生、要刪除的舊塊 id)"""
+        previous = self.manifest.chunk_hashes(name)
+        changed = [c for c in chunks if previous.get(c["id"]) != chunk_hash(c)]
+        current_ids = {c["id"] for c in chunks}
+        stale_ids = [chunk_id for chunk_id in previous if chunk_id not in current_ids]
+        return changed, stale_ids
+
+    def sync_sources(self, updates: List[Tuple[str, str, List[Dict], Dict[str, str]]],
+                     removed: List[str] = ()) -> Tuple[int, int]:
+        """登錄新的/刪除的報告（updates 為 (檔名, 檔案雜湊, 全部塊, 萃取版本資訊)），重新合併近乎重複的塊，
+        再把 ChromaDB 更新成新的代表塊集合。回傳 (寫入的代表塊數, 刪除的塊數)。
+        ChromaDB 寫入成功後才更新紀錄；中途失敗時下次會重新比對、重做"""
+        for name, _, chunks, _ in updates:
+            self.registry.replace_source(name, chunks, [chunk_hash(c) for c in chunks])
+        for name in removed:
+            self.registry.remove_source(name)
+
+        plan, dropped = self.registry.plan(self.dedup_threshold)
+        physical = self.registry.physical(list(plan) + dropped)
+        stale_ids = [chunk_id for chunk_id in dropped if chunk_id in physical]
+        # 代表塊本身內容有變才需要重新向量化；只有合併來源變了的改 metadata 就好
+        rewrite = [chunk_id for chunk_id, entry in plan.items()
+                   if physical.get(chunk_id, (None, None))[0] != entry["chunk_hash"]]
+        relabel = [chunk_id for chunk_id, entry in plan.items()
+                   if chunk_id in physical and physical[chunk_id][0] == entry["chunk_hash"]
+                   and physical[chunk_id][1] != entry["payload_hash"]]
+
+        payloads = self.registry.payloads(rewrite + relabel)
+        representatives = {}
+        for chunk_id in rewrite + relabel:
+            text, metadata = payloads[chunk_id]
+            representatives[chunk_id] = {"id": chunk_id, "text": text, "metadata": {
+                **metadata,
+                "merged_sources": "、".join(plan[chunk_id]["sources"]),
+                "merged_count": plan[chunk_id]["members"],
+            }}
+
+        if rewrite:
+            self.add_to_db([representatives[chunk_id] for chunk_id in rewrite])
+        for start in range(0, len(relabel), self.upsert_batch_size):
+            part = relabel[start:start + self.upsert_batch_size]
+            self.collection.update(ids=part, metadatas=[representatives[i]["metadata"] for i in part])
+        for start in range(0, len(stale_ids), self.upsert_batch_size):
+            self.collection.delete(ids=stale_ids[start:start + self.upsert_batch_size])
+
+        self.registry.set_physical(plan, stale_ids)
+        for name, sha256, chunks, extraction in updates:
+            self.manifest.record(name, sha256, CHUNKER_VERSION, {c["id"]: chunk_hash(c) for c in chunks}, extraction)
+        for name in removed:
+            self.manifest.remove(name)
+        self.manifest.save()
+        return len(rewrite), len(stale_ids)
+
+    def publish(self) -> str:
+        """一批寫入完成後更新領域分類表與索引版本標記（app.py 看到標記變了會重新載入索引）"""
+        self.export_taxonomy()
+        version = self.registry.version()
+        if write_index_version(DB_PATH, version):
+            print(f"🔖 索引版本: {version}")
+        return version
+
+    def export_taxonomy(self) -> Dict:
+        """依目前索引內容更新領域分類表（內容沒變時不重寫檔案）"""
+        path = Path(DB_PATH) / TAXONOMY_FILENAME
+        taxonomy = build_taxonomy(self.registry.domain_counts())
+        previous = load_taxonomy(path)
+        if not previous or previous.get("version") != taxonomy["version"]:
+            save_taxonomy(path, taxonomy)
+        return taxonomy
+
+    def reset(self):
+        """完整重建前清空增量紀錄與合併登錄表"""
+        self.manifest.reset(EMBEDDING_MODEL)
+        self.registry.reset()
+
+    def all_ids(self) -> List[str]:
+        return self.collection.get(include=[])["ids"]
+
+    def export_snapshot(self) -> str:
+        """把目前的索引匯出成 app.py 可以直接 memory map 的單一 snapshot 檔"""
+        path = snapshot_path(DB_PATH, COLLECTION_NAME)
+        count = export_snapshot(self.collection, path, {
+            "collection": COLLECTION_NAME,
+            "embedding_model": EMBEDDING_MODEL,
+            "chunker_version": CHUNKER_VERSION,
+            "index_version": self.registry.version(),
+            **self.manifest.extraction_versions(),
+            # snapshot 部署時只複製這一個檔案，分類表也要跟著走
+            "domain_taxonomy": self.export_taxonomy(),
+        })
+        print(f"📦 已匯出 snapshot: {path}（{count} 筆，{os.path.getsize(path) / 1024 / 1024:.1f} MB）")
+        return path
+
     def add_to_db(self, chunks: List[Dict]):
         """將處理好的塊存入資料庫"""
         if not chunks:
             return
-            
-        ids = [c["id"] for c in chunks]
-        texts = [c["text"] for c in chunks]
-        metadatas = [c["metadata"] for c in chunks]
         
         print(f"  正在產生 {len(chunks)} 個向量 (使用 {EMBEDDING_MODEL})...")
         
         # 批次產生 embedding
-        embeddings = []
-        for text in texts:
-            embeddings.append(self.get_embedding(text))
+        embeddings = self.embed_chunks(chunks)
             
-        # Upsert (如果 id 存在就更新，不然就新增)
-        self.collection.upsert(
-            ids=ids,
-            documents=texts,
-            embeddings=embeddings,
-            metadatas=metadatas
-        )
+        self.upsert_chunks(chunks, embeddings)
         print(f"  ✓ 成功存入 {len(chunks)} 筆資料")
 
 
-def main():
+def load_and_chunk(path: str, known_sha256: Optional[str]) -> Tuple[str, str, Optional[List[Dict]], Dict]:
+    """（process pool 用）讀取一個結構化 JSON 並拆塊，回傳 (檔名, 檔案雜湊, 語意塊, 萃取版本資訊)；
+    檔案雜湊跟紀錄相同時不拆塊，語意塊回傳 None"""
+    fpath = Path(path)
+    raw = fpath.read_bytes()
+    sha256 = hashlib.sha256(raw).hexdigest()
+    if sha256 == known_sha256:
+        return fpath.name, sha256, None, {}
+    data = json.loads(raw.decode('utf-8'))
+    return fpath.name, sha256, LocalRAGBuilder.process_json_to_chunks(data), extraction_info(data)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="建立 Local 向量知識庫（structured files → ChromaDB）")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE,
+                        help="每個 embedding 請求帶幾個語意塊（1 表示逐筆呼叫）")
+    parser.add_argument("--no-embedding-cache", action="store_true",
+                        help="不讀寫 embedding 快取，全部重新計算")
+    parser.add_argument("--full", action="store_true",
+                        help="忽略增量紀錄，所有檔案重新寫入，並清掉索引裡不屬於任何檔案的舊資料")
+    parser.add_argument("--workers", type=int, default=DEFAULT_LOAD_WORKERS,
+                        help="讀取與拆解 JSON 的 process 數（預設為 CPU 核心數，1 表示不開 process pool）")
+    parser.add_argument("--embed-workers", type=int, default=DEFAULT_EMBED_WORKERS,
+                        help="同時送出的 embedding 請求數")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="建完索引後不匯出 snapshot 檔")
+    parser.add_argument("--dedup-threshold", type=float, default=DEDUP_THRESHOLD,
+                        help="MinHash 估計相似度達到這個值的語意塊合併成一個代表塊")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="不合併近乎重複的語意塊")
+    return parser.parse_args()
+
+
+def main(batch_size: int = EMBEDDING_BATCH_SIZE, use_embedding_cache: bool = True, full: bool = False,
+         workers: int = DEFAULT_LOAD_WORKERS, embed_workers: int = DEFAULT_EMBED_WORKERS,
+         snapshot: bool = True, dedup_threshold: Optional[float] = DEDUP_THRESHOLD):
     print("="*60)
     print("建立 Local 向量知識庫 (ChromaDB + Ollama)")
     print("="*60)
@@ -175,35 +468,117 @@ def main():
         print("沒有找到結構化 JSON 檔案 (.json)")
         return
         
-    print(f"找到 {len(json_files)} 個檔案待處理")
+    print(f"找到 {len(json_files)} 個檔案")
     
     # 2. 初始化 builder
     try:
-        builder = LocalRAGBuilder()
+        builder = LocalRAGBuilder(batch_size=batch_size, use_embedding_cache=use_embedding_cache,
+                                  embed_workers=embed_workers, dedup_threshold=dedup_threshold)
     except Exception as e:
         print(f"初始化失敗: {e}")
         return
         
-    # 3. 處理每個檔案
-    for i, fpath in enumerate(json_files, 1):
-        print(f"\n[{i}/{len(json_files)}] 讀取: {fpath.name}")
-        
+    # 3. 決定增量或完整重建：沒有紀錄、換了 embedding 模型、或紀錄跟索引筆數對不上（例如資料庫被手動刪過）
+    #    就整個重來，最後再清掉索引裡不屬於任何檔案的舊資料
+    manifest = builder.manifest
+    if not full:
+        if not manifest.exists:
+            print("沒有增量紀錄，這次完整建立索引")
+            full = True
+        elif manifest.embedding_model != EMBEDDING_MODEL:
+            print(f"embedding 模型由 {manifest.embedding_model} 改為 {EMBEDDING_MODEL}，這次完整重建索引")
+            full = True
+        elif builder.registry.physical_count() != builder.collection.count():
+            print(f"合併登錄表（{builder.registry.physical_count()} 塊）與資料庫（{builder.collection.count()} 塊）"
+                  f"不一致，這次完整重建索引")
+            full = True
+    if full:
+        builder.reset()
+
+    # 4. 平行讀取、拆解每個檔案：有變動的檔案累積到 upsert_batch_size 個變動塊後一起登錄、
+    #    合併近乎重複的塊，再把有變的代表塊向量化（多個 embedding 請求同時送出）並一次寫入
+    pending_count = 0
+    pending_sources = []  # (檔名, 檔案雜湊, 全部塊, 萃取版本資訊)
+    skipped = written = deleted = 0
+    started = time.monotonic()
+
+    def flush(removed=()):
+        nonlocal written, deleted, pending_count
         try:
-            with open(fpath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            chunks = builder.process_json_to_chunks(data)
-            print(f"  拆解為 {len(chunks)} 個語意塊")
-            
-            builder.add_to_db(chunks)
-            
+            rewritten, removed_count = builder.sync_sources(pending_sources, removed)
+            written += rewritten
+            deleted += removed_count
+        except Exception as e:
+            print(f"  ✗ 寫入失敗（{'、'.join([s[0] for s in pending_sources] + list(removed))}）: {e}")
+        pending_count = 0
+        pending_sources.clear()
+
+    known_sha256 = [manifest.current_sha256(f.name, CHUNKER_VERSION) for f in json_files]
+    # workers=1 時用單一背景執行緒讀檔，仍可跟 embedding 重疊
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else ThreadPoolExecutor(max_workers=1)
+    with pool:
+        futures = [pool.submit(load_and_chunk, str(f), sha) for f, sha in zip(json_files, known_sha256)]
+        for i, (fpath, future) in enumerate(zip(json_files, futures), 1):
+            try:
+                name, sha256, chunks, extraction = future.result()
+            except Exception as e:
+                print(f"[{i}/{len(json_files)}] {fpath.name} ✗ 處理失敗: {e}")
+                continue
+            if chunks is None:
+                skipped += 1
+                continue
+
+            changed, stale_ids = builder.plan_source(name, chunks)
+            print(f"[{i}/{len(json_files)}] {name}：{len(chunks)} 個語意塊"
+                  f"（{len(changed)} 個有變動，{len(stale_ids)} 個舊塊待刪除）")
+            pending_count += len(changed)
+            pending_sources.append((name, sha256, chunks, extraction))
+            if pending_count >= builder.upsert_batch_size:
+                flush()
+
+    # 5. 清掉已刪除 JSON 的塊（最後一批一定要跑：合併門檻改了、沒有任何檔案變動時也會重新合併）
+    existing_names = {f.name for f in json_files}
+    removed = [n for n in manifest.sources if n not in existing_names]
+    for name in removed:
+        print(f"🗑️ {name} 已不存在，從索引移除")
+    flush(removed)
+    elapsed = time.monotonic() - started
+
+    # 完整重建時另外掃描整個索引，清掉登錄表以外的舊資料
+    if full:
+        known_ids = builder.registry.physical()
+        orphan_ids = [chunk_id for chunk_id in builder.all_ids() if chunk_id not in known_ids]
+        if orphan_ids:
+            builder.collection.delete(ids=orphan_ids)
+            deleted += len(orphan_ids)
+    # 全部寫完才更新版本標記，app 不會在建索引途中重新載入到一半的索引
+    builder.publish()
+
+    logical, representatives = builder.registry.counts()
+    print(f"\n{'完整重建' if full else '增量更新'}：略過未變動檔案 {skipped} 個，"
+          f"寫入 {written} 個語意塊，刪除 {deleted} 個舊塊")
+    print(f"🧩 {logical} 個語意塊合併為 {representatives} 個代表塊"
+          f"（{'門檻 ' + str(dedup_threshold) if dedup_threshold is not None else '未合併近乎重複的塊'}）")
+    if written:
+        print(f"⏱️ 耗時 {elapsed:.1f} 秒，{written / elapsed:.1f} 塊/秒"
+              f"（讀檔 {workers} process、embedding {embed_workers} 執行緒）")
+
+    # 6. 匯出 snapshot（沒有任何變動且 snapshot 已存在時不必重寫）
+    if snapshot and (written or deleted or full or not os.path.exists(snapshot_path(DB_PATH, COLLECTION_NAME))):
+        try:
+            builder.export_snapshot()
         except Exception as e:
-            print(f"  ✗ 處理失敗: {e}")
+            print(f"  ✗ snapshot 匯出失敗: {e}")
 
     print("\n" + "="*60)
     print("全部完成！向量資料庫已建立。")
     print(f"資料庫路徑: {os.path.abspath(DB_PATH)}")
+    if builder.embedding_cache is not None:
+        print(builder.embedding_cache.stats_line())
     print("="*60)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    main(batch_size=args.batch_size, use_embedding_cache=not args.no_embedding_cache, full=args.full,
+         workers=args.workers, embed_workers=args.embed_workers, snapshot=not args.no_snapshot,
+         dedup_threshold=None if args.no_dedup else args.dedup_threshold)
@@ -0,0 +1,143 @@
+"""
+領域分類表（domain taxonomy）
+
+app.py 每個請求都要知道資料庫裡有哪些評估領域（給區塊拆解的 prompt、把使用者的區塊標籤對應回真實領域），
+原本每次都把整個索引的 metadata 讀進來找 domain，再對每個標籤線性掃描一遍，成本跟資料量成正比。
+
+改成建索引時（create_vector_db.py / ingest_pipeline.py）順便算好分類表，存成
+local_vector_db/domain_taxonomy.json（snapshot 的 manifest 裡也有一份）：
+- domains：每個領域名稱的語意塊數、有建議的語意塊數、上層領域與子領域（「日常生活自理－飲食」的上層是「日常生活自理」）
+- aliases：正規化後的寫法與常見簡稱 → 正式領域名稱
+- version：內容雜湊，分類表有變時才會改變
+
+app 只載入一次，標籤對應用預先建好的子字串索引查表，每個請求的成本跟資料量無關。
+"""
+
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# =================設定區=================
+TAXONOMY_FILENAME = "domain_taxonomy.json"
+# 子領域分隔符號（「日常生活自理－飲食」）
+SUBDOMAIN_SEPARATOR = re.compile(r"[－\-—–]")
+# 常見簡稱 → 正式領域名稱（只有正式名稱真的出現在資料庫裡才會生效）
+DOMAIN_ALIASES = {
+    "感統": "感覺統合",
+    "ADL": "日常生活自理",
+    "生活自理": "日常生活自理",
+    "精細": "精細動作",
+    "粗大": "粗大動作",
+}
+# =======================================
+
+
+def normalize_domain(name: str) -> str:
+    """全形/半形、空白、各種破折號的差異不影響對應"""
+    name = unicodedata.normalize("NFKC", name or "")
+    name = SUBDOMAIN_SEPARATOR.sub("－", name)
+    return "".join(name.split()).upper()
+
+
+def build_taxonomy(counts: Dict[str, Dict[str, int]]) -> Dict:
+    """由 {領域名稱: {"chunks": n, "with_recommendation": m}} 建出分類表"""
+    domains = {}
+    for name in sorted(counts):
+        parts = SUBDOMAIN_SEPARATOR.split(name, maxsplit=1)
+        parent = parts[0].strip() if len(parts) > 1 and parts[0].strip() else None
+        domains[name] = {**counts[name], "parent": parent, "children": []}
+    for name, entry in domains.items():
+        if entry["parent"] in domains:
+            domains[entry["parent"]]["children"].append(name)
+
+    aliases = {}
+    for name in domains:
+        if normalize_domain(name) != name:
+            aliases[normalize_domain(name)] = name
+    for alias, canonical in DOMAIN_ALIASES.items():
+        if canonical in domains and alias not in domains:
+            aliases[normalize_domain(alias)] = canonical
+
+    body = {"domains": domains, "aliases": aliases}
+    version = hashlib.sha256(json.dumps(body, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return {"version": version, **body}
+
+
+def save_taxonomy(path, taxonomy: Dict):
+    # 先寫暫存檔再取代，app 讀到的一定是完整的檔案
+    path = Path(path)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(taxonomy, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_taxonomy(path) -> Optional[Dict]:
+    path = Path(path)
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class DomainTaxonomy:
+    """載入後的分類表：names 是資料庫裡有語意塊的領域名稱，match() 以查表把標籤對應回真實領域"""
+
+    def __init__(self, taxonomy: Dict):
+        self.version = taxonomy.get("version")
+        self.domains = taxonomy.get("domains", {})
+        self.names = frozenset(name for name, entry in self.domains.items() if entry.get("chunks"))
+        self.aliases = {alias: name for alias, name in taxonomy.get("aliases", {}).items() if name in self.names}
+        self._normalized: Dict[str, List[str]] = {}      # 正規化名稱 → 領域名稱
+        self._substrings: Dict[str, List[str]] = {}      # 正規化名稱的每個子字串 → 包含它的領域名稱
+        for name in sorted(self.names):
+            key = normalize_domain(name)
+            self._normalized.setdefault(key, []).append(name)
+            for start in range(len(key)):
+                for end in range(start + 1, len(key) + 1):
+                    bucket = self._substrings.setdefault(key[start:end], [])
+                    if not bucket or bucket[-1] != name:
+                        bucket.append(name)
+
+    @classmethod
+    def from_collection(cls, collection) -> "DomainTaxonomy":
+        """還沒有分類表的舊索引：掃描 metadata 現算（成本跟資料量成正比，只在載入時做一次）"""
+        counts: Dict[str, Dict[str, int]] = {}
+        for m in collection.get(include=["metadatas"]).get("metadatas", []):
+            if m.get("domain"):
+                entry = counts.setdefault(m["domain"], {"chunks": 0, "with_recommendation": 0})
+                entry["chunks"] += 1
+                entry["with_recommendation"] += int(bool(m.get("has_recommendation")))
+        return cls(build_taxonomy(counts))
+
+    def match(self, label: str) -> Optional[List[str]]:
+        """完全相同的名稱跟「子分類」名稱（例如「日常生活自理」vs「日常生活自理－飲食」）都要一起找，
+        不能只抓完全相同的就不找子分類了——不同案例可能用了不同細緻程度的領域命名。
+        標籤包含某個領域名稱（「精細動作與書寫」包含「精細動作」）也算；簡稱先換成正式名稱再找。"""
+        keys = {normalize_domain(label)}
+        if self.aliases.get(normalize_domain(label)):
+            keys.add(normalize_domain(self.aliases[normalize_domain(label)]))
+        found = set()
+        for key in keys:
+            # 領域名稱包含標籤
+            found.update(self._substrings.get(key, ()))
+            # 標籤包含領域名稱：標籤很短，逐一檢查它的子字串
+            for start in range(len(key)):
+                for end in range(start + 1, len(key) + 1):
+                    found.update(self._normalized.get(key[start:end], ()))
+        if not found:
+            return None
+        exact = [label] if label in found else []
+        return exact + sorted(found - set(exact))
+
+    def chunk_count(self, names: List[str]) -> int:
+        """這些領域的語意塊總數"""
+        return sum(self.domains.get(name, {}).get("chunks", 0) for name in names)
+
+    def recommendation_count(self, names: List[str]) -> int:
+        """這些領域裡有建議內容的語意塊總數"""
+        return sum(self.domains.get(name, {}).get("with_recommendation", 0) for name in names)
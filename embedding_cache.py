@@ -0,0 +1,284 @@
+"""
+Embedding 快取（建索引的 create_vector_db.py 與網頁 app.py 共用）
+
+同樣的文字、同樣的 embedding 模型一定得到同樣的向量，不必每次重算：
+- 改了語意塊格式重建索引時，內容沒變的塊直接讀快取
+- 治療師重新送出同一段個案描述時，各領域的查詢向量直接讀快取
+
+儲存方式：
+- index.sqlite3：key（模型 + 正規化文字的 SHA-256）→ 向量檔中的列號、最後使用時間
+- vectors-<模型雜湊>-<維度>.f32：float32 的 memory-mapped 陣列，一列一個向量
+超過 max_entries 筆時淘汰最久沒用到的向量（LRU），空出來的列號給新向量重複使用。
+
+查看快取狀態：
+    python3 embedding_cache.py
+"""
+
+import argparse
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# =================設定區=================
+EMBEDDING_CACHE_DIR = "./local_embedding_cache"
+EMBEDDING_CACHE_MAX_ENTRIES = 100000  # 768 維 float32 約 300MB
+GROW_ROWS = 4096                      # 向量檔每次擴充的列數
+# 讀取時不必每次都寫資料庫：使用時間超過這麼久才更新（LRU 只需要粗略的先後），
+# 命中計數先累積在記憶體，最多隔這麼久（或下次寫入快取時）一起寫入
+LAST_USED_RESOLUTION_SECONDS = 600
+COUNTER_FLUSH_SECONDS = 60
+# =======================================
+
+
+def normalize_text(text: str) -> str:
+    """統一 Unicode 形式與換行，去掉頭尾空白（不影響語意的差異不該造成快取未命中）"""
+    text = unicodedata.normalize("NFC", text)
+    return text.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+
+def cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """以（模型, 正規化文字雜湊）為 key 的持久化 embedding 快取，可跨行程、跨執行緒共用"""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_DIR, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._arrays: Dict[str, np.memmap] = {}
+        self._pending_counts: Dict[str, List[int]] = {}  # 還沒寫進資料庫的 {model: [hits, misses]}
+        self._counts_flushed = time.monotonic()
+        # timeout：建索引跟網頁同時寫入時等對方的交易結束，而不是直接報錯
+        self._conn = sqlite3.connect(str(self.path / "index.sqlite3"), check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    dim INTEGER,
+                    slot INTEGER,
+                    last_used REAL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_slot ON entries (model, dim, slot)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS free_slots (
+                    model TEXT,
+                    dim INTEGER,
+                    slot INTEGER,
+                    PRIMARY KEY (model, dim, slot)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    model TEXT PRIMARY KEY,
+                    hits INTEGER DEFAULT 0,
+                    misses INTEGER DEFAULT 0
+                )""")
+
+    # ---- 向量檔 ----
+
+    def _vector_file(self, model: str, dim: int) -> Path:
+        model_hash = hashlib.sha256(model.encode("utf-8")).hexdigest()[:12]
+        return self.path / f"vectors-{model_hash}-{dim}.f32"
+
+    def _vectors(self, model: str, dim: int, min_rows: int) -> np.memmap:
+        """取得（必要時擴充）某個模型/維度的向量檔。其他行程可能已經擴充過檔案，列數不夠時重新 map"""
+        file_path = self._vector_file(model, dim)
+        name = file_path.name
+        array = self._arrays.get(name)
+        if array is not None and array.shape[0] >= min_rows:
+            return array
+        row_bytes = dim * 4
+        file_rows = file_path.stat().st_size // row_bytes if file_path.exists() else 0
+        if file_rows < min_rows:
+            file_rows = (min_rows // GROW_ROWS + 1) * GROW_ROWS
+            with open(file_path, "ab") as f:
+                f.truncate(file_rows * row_bytes)
+        array = np.memmap(file_path, dtype=np.float32, mode="r+", shape=(file_rows, dim))
+        self._arrays[name] = array
+        return array
+
+    # ---- 讀寫 ----
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """依序回傳每段文字的快取向量，沒有快取的位置為 None"""
+        if not texts:
+            return []
+        keys = [cache_key(model, t) for t in texts]
+        with self._lock:
+            found = {}
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                part = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, dim, slot, last_used FROM entries WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, dim, slot, last_used in rows:
+                    found[key] = (dim, slot, last_used)
+
+            results = []
+            for key in keys:
+                if key not in found:
+                    results.append(None)
+                    continue
+                dim, slot, _ = found[key]
+                results.append(self._vectors(model, dim, slot + 1)[slot].tolist())
+
+            hits = sum(r is not None for r in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+            pending = self._pending_counts.setdefault(model, [0, 0])
+            pending[0] += hits
+            pending[1] += len(results) - hits
+            # 使用時間夠新的不必更新，大部分的讀取不用寫資料庫
+            now = time.time()
+            stale = [(now, k) for k, (_, _, last_used) in found.items()
+                     if last_used < now - LAST_USED_RESOLUTION_SECONDS]
+            if stale or time.monotonic() - self._counts_flushed >= COUNTER_FLUSH_SECONDS:
+                with self._conn:
+                    self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", stale)
+                    self._flush_counts()
+        return results
+
+    def _flush_counts(self):
+        """把記憶體裡累積的命中計數寫進資料庫（呼叫端負責交易）"""
+        self._conn.executemany("""
+            INSERT INTO counters (model, hits, misses) VALUES (?, ?, ?)
+            ON CONFLICT(model) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+        """, [(model, hits, misses) for model, (hits, misses) in self._pending_counts.items()])
+        self._pending_counts.clear()
+        self._counts_flushed = time.monotonic()
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """寫入向量（已存在的 key 只更新使用時間）"""
+        if not texts:
+            return
+        items = dict(zip((cache_key(model, t) for t in texts), vectors))
+        with self._lock:
+            # BEGIN IMMEDIATE：配置列號到寫完向量之間不讓其他行程插進來搶同一列
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                keys = list(items)
+                existing = set()
+                for start in range(0, len(keys), 500):
+                    part = keys[start:start + 500]
+                    existing.update(row[0] for row in self._conn.execute(
+                        f"SELECT key FROM entries WHERE key IN ({','.join('?' * len(part))})", part))
+                self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in existing])
+                new_keys = [key for key in keys if key not in existing]
+                # 整批只數一次、淘汰一次，先空出列號再給這批新向量用
+                self._evict_if_full(len(new_keys))
+                for key in new_keys:
+                    vector = np.asarray(items[key], dtype=np.float32)
+                    dim = vector.shape[0]
+                    slot = self._allocate_slot(model, dim)
+                    array = self._vectors(model, dim, slot + 1)
+                    array[slot] = vector
+                    self._conn.execute(
+                        "INSERT INTO entries (key, model, dim, slot, last_used) VALUES (?, ?, ?, ?, ?)",
+                        (key, model, dim, slot, now)
+                    )
+                self._flush_counts()
+                for array in self._arrays.values():
+                    array.flush()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _allocate_slot(self, model: str, dim: int) -> int:
+        row = self._conn.execute(
+            "SELECT slot FROM free_slots WHERE model = ? AND dim = ? ORDER BY slot LIMIT 1", (model, dim)
+        ).fetchone()
+        if row:
+            self._conn.execute(
+                "DELETE FROM free_slots WHERE model = ? AND dim = ? AND slot = ?", (model, dim, row[0])
+            )
+            return row[0]
+        max_slot = self._conn.execute(
+            "SELECT MAX(slot) FROM entries WHERE model = ? AND dim = ?", (model, dim)
+        ).fetchone()[0]
+        return 0 if max_slot is None else max_slot + 1
+
+    def _evict_if_full(self, incoming: int):
+        """再寫入 incoming 筆會超過上限時，淘汰最久沒用的"""
+        count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count + incoming <= self.max_entries:
+            return
+        # 多淘汰 1%，避免接下來每寫一批就淘汰一次
+        victims = self._conn.execute(
+            "SELECT key, model, dim, slot FROM entries ORDER BY last_used LIMIT ?",
+            (count + incoming - self.max_entries + max(1, self.max_entries // 100),)
+        ).fetchall()
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", [(v[0],) for v in victims])
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO free_slots (model, dim, slot) VALUES (?, ?, ?)", [v[1:] for v in victims]
+        )
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        return self.get_many(model, [text])[0]
+
+    def put(self, model: str, text: str, vector: Sequence[float]):
+        self.put_many(model, [text], [vector])
+
+    def get_or_compute(self, model: str, texts: Sequence[str],
+                       compute: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """先查快取，只把沒命中的文字（去重後）交給 compute 一次算完，再寫回快取"""
+        results = self.get_many(model, texts)
+        missing = list(dict.fromkeys(t for t, r in zip(texts, results) if r is None))
+        if missing:
+            computed = dict(zip(missing, compute(missing)))
+            self.put_many(model, missing, [computed[t] for t in missing])
+            results = [r if r is not None else list(computed[t]) for t, r in zip(texts, results)]
+        return results
+
+    # ---- 統計 ----
+
+    def stats_line(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"embedding 快取：命中 {self.hits}/{total}（{rate:.1f}%）"
+
+    def summary(self) -> List[str]:
+        """每個模型的快取筆數與累計命中率"""
+        with self._lock:
+            if self._pending_counts:
+                with self._conn:
+                    self._flush_counts()
+            rows = self._conn.execute("""
+                SELECT c.model, COALESCE(e.n, 0), c.hits, c.misses
+                FROM counters c LEFT JOIN (SELECT model, COUNT(*) AS n FROM entries GROUP BY model) e
+                ON c.model = e.model ORDER BY c.model
+            """).fetchall()
+        lines = []
+        for model, count, hits, misses in rows:
+            total = hits + misses
+            rate = hits / total * 100 if total else 0.0
+            lines.append(f"{model}: {count} 筆向量，累計命中 {hits}/{total}（{rate:.1f}%）")
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查看 embedding 快取狀態")
+    parser.add_argument("--path", default=EMBEDDING_CACHE_DIR)
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.path)
+    size = sum(f.stat().st_size for f in cache.path.iterdir() if f.is_file())
+    print(f"快取路徑: {cache.path.absolute()}（{size / 1024 / 1024:.1f} MB，上限 {cache.max_entries} 筆）")
+    for line in cache.summary() or ["（尚無資料）"]:
+        print(f"  {line}")
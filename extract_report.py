@@ -4,10 +4,20 @@
 """
 
 import os
+import copy
 import json
+import time
+import hashlib
+import random
+import argparse
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 import anthropic
+import requests
 from datetime import datetime
 
 try:
@@ -22,41 +32,406 @@ try:
 except ImportError:
     DOTENV_AVAILABLE = False
 
+# =================設定區=================
+# 大量回填 (backfill) 時的併發設定：workers 決定同時處理幾份報告，
+# RPM / TPM 預算請依照自己 API 帳號的額度調整 (None 表示不限制)
+DEFAULT_WORKERS = 1
+DEFAULT_REQUESTS_PER_MINUTE = None
+DEFAULT_TOKENS_PER_MINUTE = None
 
-class OccupationalTherapyReportProcessor:
-    """職能治療報告處理器"""
-    
-    def __init__(self, api_key: str = None):
-        if DOTENV_AVAILABLE:
-            load_dotenv()
-        
-        self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
-        if not self.api_key:
-            raise ValueError("找不到 API Key！")
-        
-        self.client = anthropic.Anthropic(api_key=self.api_key)
-        self.model = "claude-sonnet-5"
-        
-    def extract_text_from_pdf(self, pdf_path: str) -> str:
-        """從 PDF 萃取文字"""
-        if not PDF_AVAILABLE:
-            raise ImportError("需要安裝 pdfplumber: pip3 install pdfplumber")
-        
-        text_content = []
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    text_content.append(text)
-        return "\n\n".join(text_content)
-    
-    def structure_report_with_claude(self, report_text: str) -> Dict:
-        """使用 Claude 將職能治療報告結構化"""
-        
-        prompt = f"""請分析以下早期療育（職能治療）評估報告，並將其結構化為 JSON 格式。
+# 結構化萃取後端：claude（雲端，預設）或 ollama（本地，不計 token 費用、沒有雲端頻率限制）
+DEFAULT_BACKEND = "claude"
+CLAUDE_EXTRACTION_MODEL = "claude-sonnet-5"
+OLLAMA_BASE_URL = "http://localhost:11434"
+OLLAMA_EXTRACTION_MODEL = "qwen2.5:7b"
+OLLAMA_NUM_CTX = 32768      # 萃取 prompt + 報告全文 + 輸出都要放得下，Ollama 預設的 context 太小
+OLLAMA_TIMEOUT_SECONDS = 600
 
-報告內容：
-{report_text}
+# 遇到 429 / 503 / 529 時的重試設定（所有 worker 共用同一個退避時間）
+MAX_API_RETRIES = 5
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {429, 503, 529}
+
+# 增量萃取 manifest（放在輸出資料夾內）：記錄每份報告萃取時的 原始檔 SHA-256 + prompt 版本 + 模型
+MANIFEST_FILENAME = ".extraction_manifest.json"
+
+# PDF 文字萃取階段：用 process pool 平行解析（pdfplumber 是 CPU-bound），
+# 結果以原始檔 SHA-256 為 key 存成側檔快取，換 prompt/模型時只需要重跑 LLM 步驟
+TEXT_CACHE_DIRNAME = ".text_cache"
+TEXT_EXTRACTOR_VERSION = "pdfplumber-1"  # 改了文字萃取方式就調整，舊快取會自動失效
+PDF_PAGES_PER_TASK = 8
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1
+
+# Batch 模式（Message Batches API）：大量回填時把請求打包成非同步 batch，不受單筆延遲與併發上限限制。
+# 送出後的 batch 狀態存在輸出資料夾，程式中斷後再執行會先把未收回的結果收完
+BATCH_STATE_DIRNAME = ".batches"
+BATCH_MAX_REQUESTS = 10000
+BATCH_POLL_SECONDS = 60
+
+# 長報告分段萃取（map-reduce）：超過門檻的報告依頁面切成數個視窗平行萃取，再合併回同一份 schema。
+# 單次呼叫的輸出被 max_tokens 截斷時也會自動改用分段萃取
+LONG_REPORT_CHAR_THRESHOLD = 20000
+LONG_REPORT_WINDOW_CHARS = 8000
+LONG_REPORT_WINDOW_WORKERS = 4
+LONG_REPORT_WINDOW_MAX_TOKENS = 8000
+LONG_REPORT_MAX_KEYWORDS = 15
+
+# 工作日誌（SQLite）：記錄每次執行中每個檔案的狀態 queued/parsing/llm/written/failed、嘗試次數、錯誤與耗時，
+# 中斷或失敗後用 --resume 接續上一次執行，只重做還沒寫出的檔案
+JOURNAL_FILENAME = ".extraction_journal.sqlite3"
+DEFAULT_MAX_ATTEMPTS = 3
+# =======================================
+
+
+class RateLimiter:
+    """所有 worker 共用的請求/token 預算與退避狀態。
+    以 60 秒滑動視窗計算 RPM/TPM；任何一個 worker 收到 429/503 時，
+    會把「暫停到某個時間點」設定給全部 worker，避免大家一起繼續撞牆。"""
+
+    def __init__(self, requests_per_minute: Optional[int] = None,
+                 tokens_per_minute: Optional[int] = None):
+        # 0 或負數視為不限（跟 None 相同），不然空視窗也會被判定超過預算
+        self.requests_per_minute = requests_per_minute if requests_per_minute and requests_per_minute > 0 else None
+        self.tokens_per_minute = tokens_per_minute if tokens_per_minute and tokens_per_minute > 0 else None
+        self._lock = threading.Lock()
+        self._window = deque()  # (timestamp, tokens)
+        self._window_tokens = 0
+        self._pause_until = 0.0
+
+    def acquire(self, tokens: int = 0):
+        """等到預算足夠（且不在共用退避期間）才放行"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._window and now - self._window[0][0] >= 60:
+                    _, old_tokens = self._window.popleft()
+                    self._window_tokens -= old_tokens
+
+                wait = self._pause_until - now
+                if wait <= 0:
+                    over_rpm = (
+                        self.requests_per_minute is not None
+                        and len(self._window) >= self.requests_per_minute
+                    )
+                    # 視窗是空的時候一律放行，避免單筆請求估計值超過 TPM 時永遠卡住
+                    over_tpm = (
+                        self.tokens_per_minute is not None
+                        and self._window
+                        and self._window_tokens + tokens > self.tokens_per_minute
+                    )
+                    if not over_rpm and not over_tpm:
+                        self._window.append((now, tokens))
+                        self._window_tokens += tokens
+                        return
+                    wait = 60 - (now - self._window[0][0])
+            time.sleep(max(wait, 0.05))
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """設定全體共用的退避時間，回傳這次要等待的秒數"""
+        if retry_after is None:
+            delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+            delay *= random.uniform(0.8, 1.2)
+        else:
+            delay = retry_after
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+        return delay
+
+
+def file_sha256(path: Path) -> str:
+    """計算檔案內容的 SHA-256"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ExtractionManifest:
+    """增量萃取紀錄：以原始檔名為 key，記下產出目前 JSON 時的輸入
+    （原始檔 SHA-256、prompt 版本、模型 ID）。三者任一改變就需要重新萃取，其餘直接跳過。
+    另外記下檔案大小與 mtime，沒變的檔案不必重新計算雜湊。"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def source_hash(self, file_path: Path) -> str:
+        """取得原始檔雜湊；大小與 mtime 跟上次一樣時直接沿用紀錄"""
+        stat = file_path.stat()
+        entry = self.entries.get(file_path.name)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return entry["sha256"]
+        return file_sha256(file_path)
+
+    def is_current(self, file_path: Path, sha256: str, prompt_version: str, model: str,
+                   output_file: Path) -> bool:
+        entry = self.entries.get(file_path.name)
+        return bool(
+            entry
+            and output_file.exists()
+            and entry.get("sha256") == sha256
+            and entry.get("prompt_version") == prompt_version
+            and entry.get("model") == model
+            and entry.get("complete", True)
+        )
+
+    def has_entry(self, file_path: Path) -> bool:
+        return file_path.name in self.entries
+
+    def record(self, file_path: Path, sha256: str, prompt_version: str, model: str, output_file: Path,
+               source_stat: Optional[Tuple[Optional[int], Optional[int]]] = None, complete: bool = True):
+        """source_stat：計算 sha256 當時的 (大小, mtime_ns)。萃取跟登錄隔很久時（batch 可能隔了幾小時才收回）
+        要用當時的值，不然期間改過的原始檔會被當成沒變；不給則讀目前的檔案。
+        complete=False（長報告有段落萃取失敗）時照樣登錄，但 is_current 不會把它當成最新，下次會重做"""
+        if source_stat is None:
+            stat = file_path.stat()
+            source_stat = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self.entries[file_path.name] = {
+                "sha256": sha256,
+                "prompt_version": prompt_version,
+                "model": model,
+                "size": source_stat[0],
+                "mtime_ns": source_stat[1],
+                "output": output_file.name,
+                "complete": complete,
+                "extracted_at": datetime.now().isoformat(),
+            }
+            self._save()
+
+    def _save(self):
+        # 先寫暫存檔再取代，避免中途中斷留下寫一半的 manifest
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class ExtractionJournal:
+    """萃取工作日誌（SQLite，append/update 都立即 commit）。
+    每次執行一個 run_id，每個檔案一列：狀態、嘗試次數、最後錯誤、解析與 LLM 耗時。
+    程式中斷時停在 parsing/llm 的檔案就是「執行到一半」的檔案，--resume 會把它們跟 failed 一起重做。"""
+
+    STATES = ("queued", "parsing", "llm", "written", "failed")
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    started_at TEXT,
+                    finished_at TEXT,
+                    mode TEXT
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    run_id TEXT,
+                    file TEXT,
+                    sha256 TEXT,
+                    state TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    error TEXT,
+                    queued_at TEXT,
+                    updated_at TEXT,
+                    parse_seconds REAL,
+                    llm_seconds REAL,
+                    PRIMARY KEY (run_id, file)
+                )""")
+        self.run_id = None
+
+    def start_run(self, mode: str) -> str:
+        self.run_id = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO runs (run_id, started_at, mode) VALUES (?, ?, ?)",
+                (self.run_id, datetime.now().isoformat(), mode)
+            )
+        return self.run_id
+
+    def resume_last_run(self) -> Optional[str]:
+        """接續最近一次有處理檔案的執行（沒有任何檔案的空執行略過，例如沒事做就結束的那幾次）"""
+        row = self._conn.execute("""
+            SELECT run_id FROM runs r WHERE EXISTS (SELECT 1 FROM jobs j WHERE j.run_id = r.run_id)
+            ORDER BY started_at DESC LIMIT 1""").fetchone()
+        self.run_id = row[0] if row else None
+        return self.run_id
+
+    def finish_run(self):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE runs SET finished_at = ? WHERE run_id = ?",
+                (datetime.now().isoformat(), self.run_id)
+            )
+
+    def unfinished(self) -> Dict[str, int]:
+        """上一次執行中還沒寫出的檔案 {檔名: 已嘗試次數}"""
+        rows = self._conn.execute(
+            "SELECT file, attempts FROM jobs WHERE run_id = ? AND state != 'written'", (self.run_id,)
+        ).fetchall()
+        return dict(rows)
+
+    def update(self, file_name: str, state: str, sha256: str = None, error: str = None,
+               parse_seconds: float = None, llm_seconds: float = None, new_attempt: bool = False):
+        assert state in self.STATES
+        now = datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.execute("""
+                INSERT INTO jobs (run_id, file, sha256, state, attempts, error, queued_at, updated_at,
+                                  parse_seconds, llm_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (run_id, file) DO UPDATE SET
+                    state = excluded.state,
+                    sha256 = COALESCE(excluded.sha256, jobs.sha256),
+                    attempts = jobs.attempts + excluded.attempts,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at,
+                    parse_seconds = COALESCE(excluded.parse_seconds, jobs.parse_seconds),
+                    llm_seconds = COALESCE(excluded.llm_seconds, jobs.llm_seconds)
+            """, (self.run_id, file_name, sha256, state, 1 if new_attempt else 0, error, now, now,
+                  parse_seconds, llm_seconds))
+
+    def summary(self) -> Dict[str, int]:
+        rows = self._conn.execute(
+            "SELECT state, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY state", (self.run_id,)
+        ).fetchall()
+        return dict(rows)
+
+
+def _count_pdf_pages(pdf_path: str) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _extract_pdf_pages(pdf_path: str, start: int, end: int) -> Tuple[List[str], float]:
+    """萃取 [start, end) 頁的文字，連同耗費秒數一起回傳（process pool 的工作單位，必須是模組層級函式才能 pickle）"""
+    started = time.monotonic()
+    with pdfplumber.open(pdf_path) as pdf:
+        pages = [pdf.pages[i].extract_text() or "" for i in range(start, end)]
+    return pages, time.monotonic() - started
+
+
+def read_report_pages(file_path: str) -> Tuple[List[str], float]:
+    """讀取整份報告的逐頁文字（.txt 視為單頁），連同耗費秒數一起回傳；模組層級函式，可直接丟進 process pool"""
+    path = Path(file_path)
+    if path.suffix.lower() == '.pdf':
+        return _extract_pdf_pages(file_path, 0, _count_pdf_pages(file_path))
+    started = time.monotonic()
+    with open(path, 'r', encoding='utf-8') as f:
+        return [f.read()], time.monotonic() - started
+
+
+def join_pages(pages: List[str]) -> str:
+    """跟 extract_text_from_pdf 一樣：略過空白頁，頁與頁之間空一行"""
+    return "\n\n".join(p for p in pages if p)
+
+
+class ReportTextCache:
+    """PDF 文字側檔快取：<sha256>.json 內存逐頁文字"""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, sha256: str) -> Path:
+        return self.cache_dir / f"{sha256}.json"
+
+    def get_pages(self, sha256: str) -> Optional[List[str]]:
+        path = self._path(sha256)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if data.get("extractor") != TEXT_EXTRACTOR_VERSION:
+            return None
+        return data["pages"]
+
+    def put_pages(self, sha256: str, pages: List[str]):
+        path = self._path(sha256)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"extractor": TEXT_EXTRACTOR_VERSION, "pages": pages}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def prefetch_pdf_texts(items: List[Tuple[Path, str]], text_cache: ReportTextCache,
+                       workers: int = DEFAULT_PARSE_WORKERS,
+                       on_parsed: Optional[Callable[[Path, float], None]] = None) -> Dict[str, Exception]:
+    """平行萃取尚未快取的 PDF 文字（跨檔案、跨頁切分工作），回傳 {檔名: 例外} 的失敗清單。
+    items 為 (file_path, sha256)；.txt 檔讀取成本很低，不經過這個階段。
+    on_parsed(file_path, 秒數) 在每個檔案解析完成時呼叫（秒數為各頁工作實際耗費的時間加總）。"""
+    todo = [
+        (file_path, sha256) for file_path, sha256 in items
+        if file_path.suffix.lower() == '.pdf' and text_cache.get_pages(sha256) is None
+    ]
+    errors = {}
+    if not todo:
+        return errors
+    if not PDF_AVAILABLE:
+        raise ImportError("需要安裝 pdfplumber: pip3 install pdfplumber")
+
+    print(f"📄 平行萃取 {len(todo)} 個 PDF 的文字（{workers} 個 process，另有 {len(items) - len(todo)} 個已有快取或非 PDF）...")
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        count_futures = {executor.submit(_count_pdf_pages, str(fp)): (fp, sha) for fp, sha in todo}
+        page_futures = {}
+        for future in as_completed(count_futures):
+            file_path, sha256 = count_futures[future]
+            try:
+                page_count = future.result()
+            except Exception as e:
+                errors[file_path.name] = e
+                continue
+            page_futures[(file_path, sha256)] = [
+                executor.submit(_extract_pdf_pages, str(file_path), start, min(start + PDF_PAGES_PER_TASK, page_count))
+                for start in range(0, page_count, PDF_PAGES_PER_TASK)
+            ]
+
+        for (file_path, sha256), futures in page_futures.items():
+            try:
+                chunks = [future.result() for future in futures]
+            except Exception as e:
+                errors[file_path.name] = e
+                continue
+            text_cache.put_pages(sha256, [page for chunk_pages, _ in chunks for page in chunk_pages])
+            if on_parsed:
+                on_parsed(file_path, sum(seconds for _, seconds in chunks))
+
+    print(f"📄 PDF 文字萃取完成，耗時 {time.monotonic() - started:.1f} 秒，失敗 {len(errors)} 個\n")
+    return errors
+
+
+def _api_error_status(e: Exception) -> Optional[int]:
+    """跟 app.call_llm_text 一樣的判斷方式：從例外裡找出 HTTP status code"""
+    return getattr(getattr(e, "response", None), "status_code", None) or getattr(e, "status_code", None)
+
+
+def _retry_after_seconds(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# 結構化萃取 prompt 拆成兩段：
+# - EXTRACTION_SYSTEM_PROMPT：固定的萃取規則與 JSON schema，每份報告都一樣，放在 system 並加上 prompt cache 標記，
+#   第一份報告之後都直接讀快取，不用每次重新處理這 4KB 的指示
+# - EXTRACTION_USER_TEMPLATE：每份報告不同的部分（{report_text} 為報告全文）
+# 版本由內容雜湊自動產生：只要改了 prompt，manifest 就會判定所有報告需要重新萃取
+EXTRACTION_SYSTEM_PROMPT = """你會收到一份早期療育（職能治療）評估報告，請將其結構化為 JSON 格式。
 
 請依照以下邏輯進行深度萃取（若無資訊填 null）：
 
@@ -98,49 +473,49 @@ class OccupationalTherapyReportProcessor:
 
 請以以下 JSON 格式回傳（只回傳 JSON，不要其他說明文字）：
 
-{{
-  "child_info": {{
+{
+  "child_info": {
     "name_or_id": "兒童姓名或代號",
     "gender": "性別",
     "birth_date": "出生日期（格式：YYYY.MM.DD）",
     "age_at_assessment": "評估時年齡"
-  }},
-  "assessment_info": {{
+  },
+  "assessment_info": {
     "date": "評估日期",
     "therapist": "治療師姓名",
     "tools": ["評估工具1", "評估工具2"]
-  }},
+  },
   "family_concerns": [
     "主訴重點1 (例如：在學校無法跟上團體指令)",
     "主訴重點2 (例如：拿筆姿勢不正確)"
   ],
   "assessment_domains": [
-    {{
+    {
       "domain": "領域名稱",
       "status": "評估狀態",
       "assessment_tool": "評估工具（如有）",
       "observations": "行為觀察與綜合結果",
-      "scores": {{
+      "scores": {
         "description": "分數描述",
-        "values": {{
+        "values": {
           "百分比": "數值",
           "發展商數": "數值",
           "發展年齡": "數值"
-        }}
-      }},
+        }
+      },
       "findings": "主要發現",
       "domain_issue": "這個領域對應的問題點簡述（無異常則 null）",
       "domain_reasoning": "這個領域的臨床推理，表現→原因→結果（無異常則 null）",
-      "domain_recommendations": {{
+      "domain_recommendations": {
         "treatment_focus": "這個領域的治療課程重點（無則 null）",
         "home_school_strategies": ["只跟這個領域有關的居家/學校建議"],
         "suggested_activities": ["只跟這個領域有關的具體訓練活動"]
-      }}
-    }}
+      }
+    }
   ],
   "case_level_recommendation": "總結與建議開場的固定句型，例如：綜合以上結果，建議安排職能療育課程（若報告沒有這句，填 null）",
   "keywords": ["關鍵詞1", "關鍵詞2"]
-}}
+}
 
 請確保：
 1. 完整保留報告中的專業術語和數據
@@ -149,85 +524,659 @@ class OccupationalTherapyReportProcessor:
 4. 關鍵詞涵蓋職能治療的核心概念
 
 """
+
+EXTRACTION_USER_TEMPLATE = """請分析以下早期療育（職能治療）評估報告，依照上述規則結構化為 JSON 格式。
+
+報告內容：
+{report_text}
+"""
+
+# 長報告分段萃取時，每個視窗用的 user 訊息（system 與單次萃取相同，一樣吃得到 prompt cache）
+EXTRACTION_WINDOW_USER_TEMPLATE = """以下是一份較長的早期療育（職能治療）評估報告的第 {index}/{total} 段（依頁面切分）。
+請依照上述規則，只萃取「這一段」實際出現的內容，回傳同樣格式的 JSON：
+- 這一段沒有提到的欄位填 null 或空陣列，不要推測其他段落的內容
+- 某個評估領域在這一段只出現部分資訊（例如只有評估結果、或只有建議）時，仍然輸出該領域物件，沒出現的欄位填 null
+
+報告片段：
+{report_text}
+"""
+
+EXTRACTION_PROMPT_VERSION = hashlib.sha256(
+    (EXTRACTION_SYSTEM_PROMPT + EXTRACTION_USER_TEMPLATE + EXTRACTION_WINDOW_USER_TEMPLATE).encode("utf-8")
+).hexdigest()[:12]
+
+
+def split_report_windows(pages: List[str], max_chars: int = LONG_REPORT_WINDOW_CHARS) -> List[str]:
+    """把逐頁文字依序合併成不超過 max_chars 的視窗；單頁就超過上限時再依段落（空行）切開"""
+    pieces = []
+    for page in pages:
+        if not page:
+            continue
+        if len(page) <= max_chars:
+            pieces.append(page)
+            continue
+        for paragraph in page.split("\n\n"):
+            pieces.extend(paragraph[i:i + max_chars] for i in range(0, len(paragraph), max_chars))
+
+    windows = []
+    current = []
+    current_len = 0
+    for piece in pieces:
+        if current and current_len + len(piece) > max_chars:
+            windows.append("\n\n".join(current))
+            current, current_len = [], 0
+        current.append(piece)
+        current_len += len(piece) + 2
+    if current:
+        windows.append("\n\n".join(current))
+    return windows
+
+
+def _is_blank(value) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def _extend_unique(target: List, values) -> None:
+    for value in values or []:
+        if not _is_blank(value) and value not in target:
+            target.append(value)
+
+
+# 同一領域出現在多個視窗時：這些欄位取第一個有值的，其餘文字欄位把不同內容串接起來
+_FIRST_VALUE_DOMAIN_FIELDS = {"domain", "status", "assessment_tool"}
+
+
+def _merge_domain(target: Dict, source: Dict) -> None:
+    for key, value in source.items():
+        if _is_blank(value):
+            continue
+        current = target.get(key)
+        if _is_blank(current):
+            target[key] = copy.deepcopy(value)
+        elif key == "domain_recommendations" and isinstance(current, dict) and isinstance(value, dict):
+            if _is_blank(current.get("treatment_focus")):
+                current["treatment_focus"] = value.get("treatment_focus")
+            for list_key in ("home_school_strategies", "suggested_activities"):
+                merged_list = list(current.get(list_key) or [])
+                _extend_unique(merged_list, value.get(list_key))
+                current[list_key] = merged_list
+        elif key == "scores" and isinstance(current, dict) and isinstance(value, dict):
+            if _is_blank(current.get("description")):
+                current["description"] = value.get("description")
+            values = dict(value.get("values") or {})
+            values.update({k: v for k, v in (current.get("values") or {}).items() if not _is_blank(v)})
+            current["values"] = values
+        elif key in _FIRST_VALUE_DOMAIN_FIELDS:
+            continue
+        elif isinstance(current, str) and isinstance(value, str) and value not in current:
+            target[key] = f"{current}\n{value}"
+
+
+def merge_window_results(results: List[Dict]) -> Dict:
+    """把各視窗的萃取結果合併回單一報告的 schema（依視窗順序，同名領域合併成一個物件）"""
+    merged = {
+        "child_info": {},
+        "assessment_info": {"tools": []},
+        "family_concerns": [],
+        "assessment_domains": [],
+        "case_level_recommendation": None,
+        "keywords": [],
+    }
+    domains = {}
+    for result in results:
+        for section in ("child_info", "assessment_info"):
+            for key, value in (result.get(section) or {}).items():
+                if key == "tools":
+                    _extend_unique(merged[section]["tools"], value)
+                elif _is_blank(merged[section].get(key)) and not _is_blank(value):
+                    merged[section][key] = value
+        _extend_unique(merged["family_concerns"], result.get("family_concerns"))
+        _extend_unique(merged["keywords"], result.get("keywords"))
+        if _is_blank(merged["case_level_recommendation"]):
+            merged["case_level_recommendation"] = result.get("case_level_recommendation")
+
+        for domain in result.get("assessment_domains") or []:
+            name = (domain.get("domain") or "").strip() or "未分類"
+            if name in domains:
+                _merge_domain(domains[name], domain)
+            else:
+                domains[name] = copy.deepcopy(domain)
+
+    merged["assessment_domains"] = list(domains.values())
+    merged["keywords"] = merged["keywords"][:LONG_REPORT_MAX_KEYWORDS]
+    return merged
+
+
+class ExtractionResponse(NamedTuple):
+    """各後端統一的回應格式"""
+    text: str
+    stop_reason: Optional[str]  # 輸出被截斷時為 "max_tokens"
+    usage: Dict[str, int]
+
+
+class ClaudeExtractionBackend:
+    """Anthropic Claude 萃取後端：system 加 prompt cache 標記，支援 Message Batches"""
+
+    name = "claude"
+    supports_batch = True
+    supports_prompt_cache = True
+
+    def __init__(self, api_key: str = None, base_url: str = None, model: str = CLAUDE_EXTRACTION_MODEL):
+        self.api_key = api_key or os.environ.get("ANTHROPIC_API_KEY")
+        if not self.api_key:
+            raise ValueError("找不到 API Key！")
+        # 重試交給 processor 統一處理（才能跟其他 worker 共用退避時間），SDK 本身不重試。
+        # base_url 可指向其他端點（例如 fake_api_server.py 本地替身伺服器）
+        self.client = anthropic.Anthropic(api_key=self.api_key, base_url=base_url, max_retries=0)
+        self.model = model
+        self.model_id = model  # 寫進 manifest 的模型 ID，沿用原本只有 Claude 時的值
+
+    def build_request(self, system_prompt: str, user_content: str, max_tokens: int) -> Dict:
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "system": [{
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            "messages": [{
+                "role": "user",
+                "content": user_content
+            }]
+        }
+
+    @staticmethod
+    def to_response(message) -> ExtractionResponse:
+        """把 Anthropic 的 message（單筆呼叫或 batch 結果）轉成 ExtractionResponse"""
+        usage = message.usage
+        return ExtractionResponse(
+            text=next(block.text for block in message.content if block.type == "text"),
+            stop_reason=message.stop_reason,
+            usage={
+                "input_tokens": usage.input_tokens or 0,
+                "output_tokens": usage.output_tokens or 0,
+                "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+                "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+            }
+        )
+
+    def send(self, request: Dict) -> ExtractionResponse:
+        return self.to_response(self.client.messages.create(**request))
+
+
+class OllamaExtractionBackend:
+    """本地 Ollama 萃取後端：/api/chat 搭配 format=json 強制輸出 JSON。
+    要讓多個 worker 真的同時跑，Ollama 伺服器需設定 OLLAMA_NUM_PARALLEL；
+    佇列滿時 Ollama 回 503，會跟雲端一樣走共用退避重試。"""
+
+    name = "ollama"
+    supports_batch = False
+    supports_prompt_cache = False
+
+    def __init__(self, base_url: str = None, model: str = OLLAMA_EXTRACTION_MODEL):
+        self.base_url = (base_url or OLLAMA_BASE_URL).rstrip("/")
+        self.model = model
+        self.model_id = f"ollama/{model}"
+        self.session = requests.Session()
+
+    def build_request(self, system_prompt: str, user_content: str, max_tokens: int) -> Dict:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content}
+            ],
+            "format": "json",
+            "stream": False,
+            "options": {"temperature": 0, "num_predict": max_tokens, "num_ctx": OLLAMA_NUM_CTX}
+        }
+
+    def send(self, request: Dict) -> ExtractionResponse:
+        resp = self.session.post(f"{self.base_url}/api/chat", json=request, timeout=OLLAMA_TIMEOUT_SECONDS)
+        resp.raise_for_status()
+        body = resp.json()
+        return ExtractionResponse(
+            text=body["message"]["content"],
+            stop_reason="max_tokens" if body.get("done_reason") == "length" else body.get("done_reason"),
+            usage={
+                "input_tokens": body.get("prompt_eval_count") or 0,
+                "output_tokens": body.get("eval_count") or 0,
+            }
+        )
+
+
+def create_extraction_backend(name: str = DEFAULT_BACKEND, api_key: str = None,
+                              base_url: str = None, model: str = None):
+    """依名稱建立萃取後端（claude / ollama）"""
+    if name == "claude":
+        return ClaudeExtractionBackend(api_key=api_key, base_url=base_url, model=model or CLAUDE_EXTRACTION_MODEL)
+    if name == "ollama":
+        return OllamaExtractionBackend(base_url=base_url, model=model or OLLAMA_EXTRACTION_MODEL)
+    raise ValueError(f"不支援的萃取後端: {name}")
+
+
+class OccupationalTherapyReportProcessor:
+    """職能治療報告處理器"""
+    
+    def __init__(self, api_key: str = None, rate_limiter: RateLimiter = None, base_url: str = None,
+                 backend=None):
+        if DOTENV_AVAILABLE:
+            load_dotenv()
+        
+        # 沒指定後端時維持原本的 Claude 行為
+        self.backend = backend or ClaudeExtractionBackend(api_key=api_key, base_url=base_url)
+        self.model = self.backend.model_id
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._usage_lock = threading.Lock()
+        self.usage_totals = {
+            "calls": 0, "cache_hits": 0, "input_tokens": 0, "output_tokens": 0,
+            "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0,
+        }
+
+    def _send(self, request: Dict, estimated_tokens: int) -> ExtractionResponse:
+        """透過萃取後端送出請求，先向 RateLimiter 取得預算；
+        遇到 429/503/529 就設定共用退避後重試，其他錯誤直接往上拋"""
+        for attempt in range(MAX_API_RETRIES + 1):
+            self.rate_limiter.acquire(estimated_tokens)
+            try:
+                return self.backend.send(request)
+            except Exception as e:
+                status_code = _api_error_status(e)
+                if status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_API_RETRIES:
+                    raise
+                delay = self.rate_limiter.backoff(attempt, _retry_after_seconds(e))
+                print(f"  ⏳ API 回應 {status_code}，所有 worker 暫停 {delay:.1f} 秒後重試 ({attempt + 1}/{MAX_API_RETRIES})")
+        
+    def extract_text_from_pdf(self, pdf_path: str) -> str:
+        """從 PDF 萃取文字"""
+        if not PDF_AVAILABLE:
+            raise ImportError("需要安裝 pdfplumber: pip3 install pdfplumber")
+        
+        with pdfplumber.open(pdf_path) as pdf:
+            return join_pages([page.extract_text() or "" for page in pdf.pages])
+    
+    def read_report_text(self, file_path: Path) -> str:
+        """依副檔名讀取報告全文"""
+        if file_path.suffix.lower() == '.pdf':
+            return self.extract_text_from_pdf(str(file_path))
+        elif file_path.suffix.lower() in ['.txt', '.text']:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        else:
+            raise ValueError(f"不支援的檔案格式: {file_path.suffix}")
+
+    def build_extraction_request(self, report_text: str) -> Dict:
+        """組出萃取請求（單筆呼叫與 batch 模式共用）。
+        固定的萃取規則放在 system（Claude 會標記 cache_control），每份報告只有 user 訊息不同。"""
+        return self.backend.build_request(
+            EXTRACTION_SYSTEM_PROMPT,
+            EXTRACTION_USER_TEMPLATE.format(report_text=report_text),
+            16000  # 新 schema 每個領域多了 domain_issue/reasoning/recommendations，輸出變長
+        )
+
+    def record_usage(self, response: ExtractionResponse, label: str = "") -> None:
+        """記錄並印出這次呼叫的 token 用量與 prompt cache 命中狀況"""
+        usage = response.usage
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+        cache_read = usage.get("cache_read_input_tokens", 0)
+        cache_write = usage.get("cache_creation_input_tokens", 0)
+        with self._usage_lock:
+            self.usage_totals["calls"] += 1
+            self.usage_totals["cache_hits"] += 1 if cache_read else 0
+            self.usage_totals["input_tokens"] += input_tokens
+            self.usage_totals["output_tokens"] += output_tokens
+            self.usage_totals["cache_read_input_tokens"] += cache_read
+            self.usage_totals["cache_creation_input_tokens"] += cache_write
+
+        prefix = f"  🧾 {label + ' ' if label else ''}"
+        if not self.backend.supports_prompt_cache:
+            print(f"{prefix}input {input_tokens}、output {output_tokens} tokens")
+            return
+        cache_state = "命中" if cache_read else ("寫入" if cache_write else "未命中")
+        print(f"{prefix}prompt cache {cache_state}：input {input_tokens}、"
+              f"快取讀取 {cache_read}、快取寫入 {cache_write}、output {output_tokens} tokens")
+
+    def usage_summary(self) -> str:
+        t = self.usage_totals
+        if not t["calls"]:
+            return "本次沒有呼叫 API"
+        if not self.backend.supports_prompt_cache:
+            return f"API 呼叫 {t['calls']} 次；input {t['input_tokens']}、output {t['output_tokens']} tokens"
+        return (f"API 呼叫 {t['calls']} 次，prompt cache 命中 {t['cache_hits']} 次；"
+                f"input {t['input_tokens']}（快取讀取 {t['cache_read_input_tokens']}、"
+                f"快取寫入 {t['cache_creation_input_tokens']}）、output {t['output_tokens']} tokens")
+
+    def _extract_window(self, window_text: str, index: int, total: int) -> Dict:
+        """分段萃取單一視窗：system（含 cache 標記）跟單次萃取相同，只換 user 訊息"""
+        user_content = EXTRACTION_WINDOW_USER_TEMPLATE.format(index=index, total=total, report_text=window_text)
+        request = self.backend.build_request(EXTRACTION_SYSTEM_PROMPT, user_content, LONG_REPORT_WINDOW_MAX_TOKENS)
+        response = self._send(request, estimated_tokens=len(user_content))
+        self.record_usage(response, label=f"第 {index}/{total} 段")
+        if response.stop_reason == "max_tokens":
+            raise ValueError("輸出超過 max_tokens 被截斷")
+        return self.parse_extraction_response(response)
+
+    def structure_long_report(self, report_text: str, pages: List[str] = None,
+                              max_chars: int = LONG_REPORT_WINDOW_CHARS) -> Dict:
+        """長報告分段萃取：依頁面切成視窗平行萃取各自的領域物件，再合併回原本的 schema。
+        單一視窗失敗不會讓整份報告作廢，失敗的視窗記在 extraction_windows.failed。"""
+        windows = split_report_windows(pages or [report_text], max_chars)
+        total = len(windows)
+        print(f"  📑 長報告分段萃取：{len(report_text)} 字元切成 {total} 段")
+
+        results = [None] * total
+        failed = []
+        with ThreadPoolExecutor(max_workers=min(LONG_REPORT_WINDOW_WORKERS, total)) as executor:
+            futures = {
+                executor.submit(self._extract_window, window, i, total): i
+                for i, window in enumerate(windows, 1)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index - 1] = future.result()
+                except Exception as e:
+                    print(f"  ✗ 第 {index}/{total} 段萃取失敗: {e}")
+                    failed.append(index)
+
+        succeeded = [r for r in results if r]
+        if not succeeded:
+            return None
+
+        structured_data = merge_window_results(succeeded)
+        structured_data["extraction_windows"] = {"total": total, "failed": sorted(failed)}
+        structured_data["processed_at"] = datetime.now().isoformat()
+        structured_data["report_type"] = "occupational_therapy"
+        return structured_data
+
+    @staticmethod
+    def parse_extraction_response(response: ExtractionResponse) -> Dict:
+        """從模型回應取出 JSON（JSON 格式錯誤時拋出 json.JSONDecodeError）"""
+        response_text = response.text
+        
+        # 移除 markdown 標記
+        response_text = response_text.strip()
+        if response_text.startswith("```json"):
+            response_text = response_text[7:]
+        if response_text.startswith("```"):
+            response_text = response_text[3:]
+        if response_text.endswith("```"):
+            response_text = response_text[:-3]
         
         try:
-            message = self.client.messages.create(
-                model=self.model,
-                max_tokens=16000,  # 新 schema 每個領域多了 domain_issue/reasoning/recommendations，輸出變長
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
-            )
-            
-            response_text = next(
-                block.text for block in message.content if block.type == "text"
-            )
-            
-            # 移除 markdown 標記
-            response_text = response_text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.startswith("```"):
-                response_text = response_text[3:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            
             structured_data = json.loads(response_text.strip())
-            structured_data["processed_at"] = datetime.now().isoformat()
-            structured_data["report_type"] = "occupational_therapy"
-            
-            return structured_data
-            
         except json.JSONDecodeError as e:
             print(f"JSON 解析錯誤: {e}")
-            print(f"Claude 回應前 500 字: {response_text[:500]}")
+            print(f"模型回應前 500 字: {response_text[:500]}")
+            raise
+        structured_data["processed_at"] = datetime.now().isoformat()
+        structured_data["report_type"] = "occupational_therapy"
+        return structured_data
+
+    def structure_report_with_claude(self, report_text: str, pages: List[str] = None) -> Dict:
+        """使用萃取後端（預設 Claude）將職能治療報告結構化（超過 LONG_REPORT_CHAR_THRESHOLD 的長報告改用分段萃取）"""
+        
+        try:
+            if len(report_text) > LONG_REPORT_CHAR_THRESHOLD:
+                return self.structure_long_report(report_text, pages)
+
+            request = self.build_extraction_request(report_text)
+            response = self._send(
+                request,
+                # 粗估 input token 數（中文大約一字一 token），只用來控制 TPM 預算；
+                # 讀快取的 system 部分不計入 input token 頻率限制，只算報告本身
+                estimated_tokens=len(report_text)
+            )
+            self.record_usage(response)
+            if response.stop_reason == "max_tokens":
+                # 輸出被截斷，JSON 一定不完整；改成分段萃取，視窗至少切成兩段
+                print("  ⚠️ 輸出超過 max_tokens 被截斷，改用分段萃取")
+                return self.structure_long_report(
+                    report_text, pages, max_chars=min(LONG_REPORT_WINDOW_CHARS, len(report_text) // 2 + 1)
+                )
+            return self.parse_extraction_response(response)
+            
+        except json.JSONDecodeError:
             return None
         except Exception as e:
             print(f"處理時發生錯誤: {e}")
             return None
     
-    def process_single_file(self, file_path: str) -> Dict:
-        """處理單一檔案"""
+    def process_single_file(self, file_path: str, verbose: bool = True, text: str = None,
+                            pages: List[str] = None) -> Dict:
+        """處理單一檔案（併發模式下 verbose=False，只由呼叫端印出每個檔案的結果，避免輸出交錯）。
+        text / pages 有給的話（例如來自文字快取）就不再重新萃取；pages 另外用來切分長報告。"""
         file_path = Path(file_path)
+        log = print if verbose else (lambda *args, **kwargs: None)
         
-        print(f"處理檔案: {file_path.name}")
+        log(f"處理檔案: {file_path.name}")
         
         # 萃取文字
-        if file_path.suffix.lower() == '.pdf':
-            text = self.extract_text_from_pdf(str(file_path))
-        elif file_path.suffix.lower() in ['.txt', '.text']:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-        else:
-            raise ValueError(f"不支援的檔案格式: {file_path.suffix}")
+        if text is None and pages is not None:
+            text = join_pages(pages)
+        if text is None:
+            text = self.read_report_text(file_path)
         
-        print(f"  萃取文字長度: {len(text)} 字元")
+        log(f"  萃取文字長度: {len(text)} 字元")
         
         # 結構化分析
-        print(f"  使用 Claude 進行結構化分析...")
-        structured_data = self.structure_report_with_claude(text)
+        log(f"  使用 {self.model} 進行結構化分析...")
+        structured_data = self.structure_report_with_claude(text, pages)
         
         if structured_data:
             structured_data["source_file"] = file_path.name
             structured_data["file_path"] = str(file_path.absolute())
-            print(f"  ✓ 處理完成")
+            log(f"  ✓ 處理完成")
             
             # 顯示摘要
-            print(f"\n  摘要資訊：")
-            print(f"    個案: {structured_data.get('child_info', {}).get('name_or_id', 'N/A')}")
-            print(f"    年齡: {structured_data.get('child_info', {}).get('age_at_assessment', 'N/A')}")
-            print(f"    評估領域數: {len(structured_data.get('assessment_domains', []))}")
-            print(f"    關鍵詞數: {len(structured_data.get('keywords', []))}")
+            log(f"\n  摘要資訊：")
+            log(f"    個案: {structured_data.get('child_info', {}).get('name_or_id', 'N/A')}")
+            log(f"    年齡: {structured_data.get('child_info', {}).get('age_at_assessment', 'N/A')}")
+            log(f"    評估領域數: {len(structured_data.get('assessment_domains', []))}")
+            log(f"    關鍵詞數: {len(structured_data.get('keywords', []))}")
         else:
-            print(f"  ✗ 處理失敗")
+            log(f"  ✗ 處理失敗")
         
         return structured_data
 
 
 
-def process_all_raw_files():
-    """處理 'raw files' 資料夾中的所有報告"""
+def load_cached_pages(file_path: Path, sha256: str, text_cache: ReportTextCache) -> Optional[List[str]]:
+    """從文字快取取出 PDF 逐頁文字；沒有快取（或不是 PDF）回傳 None，交給 process_single_file 自己讀"""
+    if file_path.suffix.lower() != '.pdf':
+        return None
+    return text_cache.get_pages(sha256)
+
+
+def save_extraction_result(result: Dict, file_path: Path, output_file: Path, sha256: str,
+                           model: str, prompt_version: str, manifest: ExtractionManifest,
+                           source_stat: Optional[Tuple[Optional[int], Optional[int]]] = None) -> List[int]:
+    """寫出結構化 JSON 並登錄 manifest（source_stat 見 ExtractionManifest.record）。
+    回傳萃取失敗的段落編號：長報告有段落失敗時 JSON 仍會寫出（其餘段落可先用），
+    但 manifest 標成不完整、下次執行會重做，呼叫端也要把工作日誌記成 failed 讓 --resume 重試"""
+    result["source_sha256"] = sha256
+    result["extraction_prompt_version"] = prompt_version
+    result["extraction_model"] = model
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    failed_windows = (result.get("extraction_windows") or {}).get("failed") or []
+    manifest.record(file_path, sha256, prompt_version, model, output_file, source_stat,
+                    complete=not failed_windows)
+    return failed_windows
+
+
+def partial_extraction_error(failed_windows: List[int], total: int) -> str:
+    return f"長報告第 {'、'.join(map(str, failed_windows))}/{total} 段萃取失敗（已寫出其餘段落，下次執行會重做）"
+
+
+def _extract_and_save(processor, file_path: Path, output_file: Path, sha256: str,
+                      manifest: ExtractionManifest, text_cache: ReportTextCache,
+                      journal: ExtractionJournal, verbose: bool = True) -> bool:
+    """萃取單一檔案並寫出 JSON、更新 manifest 與工作日誌，回傳是否成功（例外記進日誌後往上拋，由呼叫端印出）"""
+    name = file_path.name
+    try:
+        journal.update(name, "parsing", sha256=sha256, new_attempt=True)
+        started = time.monotonic()
+        pages = load_cached_pages(file_path, sha256, text_cache)
+        text = join_pages(pages) if pages is not None else processor.read_report_text(file_path)
+        # 文字來自快取時，解析耗時已由文字萃取階段記錄，不要用讀快取的時間覆蓋
+        parse_seconds = None if pages is not None else time.monotonic() - started
+
+        journal.update(name, "llm", parse_seconds=parse_seconds)
+        started = time.monotonic()
+        result = processor.process_single_file(str(file_path), verbose=verbose, text=text, pages=pages)
+        llm_seconds = time.monotonic() - started
+        if not result:
+            journal.update(name, "failed", error="結構化萃取失敗（JSON 解析錯誤或 API 錯誤）", llm_seconds=llm_seconds)
+            return False
+
+        failed_windows = save_extraction_result(result, file_path, output_file, sha256,
+                                                processor.model, EXTRACTION_PROMPT_VERSION, manifest)
+        if failed_windows:
+            error = partial_extraction_error(failed_windows, result["extraction_windows"]["total"])
+            print(f"   ⚠️ {name}: {error}")
+            journal.update(name, "failed", error=error, llm_seconds=llm_seconds)
+            return False
+        journal.update(name, "written", llm_seconds=llm_seconds)
+        return True
+    except Exception as e:
+        journal.update(name, "failed", error=str(e))
+        raise
+
+
+def submit_extraction_batches(processor, pending, text_cache: ReportTextCache,
+                              state_dir: Path, journal: ExtractionJournal) -> Tuple[List[Path], int, List]:
+    """把待處理檔案打包成一個或多個 batch 送出，回傳 (batch 狀態檔清單, 準備失敗的檔案數, 長報告清單)。
+    超過 LONG_REPORT_CHAR_THRESHOLD 的長報告需要分段萃取再合併，不放進 batch，交回呼叫端逐一處理。"""
+    state_dir.mkdir(parents=True, exist_ok=True)
+    state_files = []
+    fail_count = 0
+    long_reports = []
+
+    for start in range(0, len(pending), BATCH_MAX_REQUESTS):
+        batch_requests = []
+        items = {}
+        for offset, (file_path, output_file, sha256) in enumerate(pending[start:start + BATCH_MAX_REQUESTS]):
+            try:
+                # 送出當下的大小/mtime 記進狀態檔，收回時拿來登錄 manifest
+                stat = file_path.stat()
+                pages = load_cached_pages(file_path, sha256, text_cache)
+                text = join_pages(pages) if pages is not None else processor.read_report_text(file_path)
+            except Exception as e:
+                print(f"   ✗ {file_path.name} 讀取失敗: {e}")
+                journal.update(file_path.name, "failed", sha256=sha256, error=str(e), new_attempt=True)
+                fail_count += 1
+                continue
+            if len(text) > LONG_REPORT_CHAR_THRESHOLD:
+                long_reports.append((file_path, output_file, sha256))
+                continue
+            # custom_id 只接受英數字、底線與連字號，中文檔名另外記在狀態檔對照
+            custom_id = f"r{start + offset:06d}"
+            batch_requests.append({"custom_id": custom_id, "params": processor.build_extraction_request(text)})
+            items[custom_id] = {"file": str(file_path), "output": str(output_file), "sha256": sha256,
+                                "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+        if not batch_requests:
+            continue
+        batch = processor.backend.client.messages.batches.create(requests=batch_requests)
+        state_path = state_dir / f"{batch.id}.json"
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "batch_id": batch.id,
+                "model": processor.model,
+                "prompt_version": EXTRACTION_PROMPT_VERSION,
+                "submitted_at": datetime.now().isoformat(),
+                "items": items,
+            }, f, ensure_ascii=False, indent=2)
+        for item in items.values():
+            journal.update(Path(item["file"]).name, "llm", sha256=item["sha256"], new_attempt=True)
+        print(f"📦 已送出 batch {batch.id}（{len(batch_requests)} 份報告）")
+        state_files.append(state_path)
+
+    return state_files, fail_count, long_reports
+
+
+def collect_extraction_batch(processor, state_path: Path, manifest: ExtractionManifest,
+                             journal: ExtractionJournal,
+                             poll_seconds: float = BATCH_POLL_SECONDS) -> Tuple[int, int]:
+    """輪詢 batch 直到完成，寫出所有結果，回傳 (成功數, 失敗數)。
+    全部寫完才刪除狀態檔——中途中斷的話，下次執行會重新收這個 batch。"""
+    with open(state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    batch_id = state["batch_id"]
+
+    while True:
+        batch = processor.backend.client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            break
+        counts = batch.request_counts
+        print(f"   ⏳ batch {batch_id} 處理中（進行中 {counts.processing}、成功 {counts.succeeded}、"
+              f"失敗 {counts.errored}），{poll_seconds:.0f} 秒後再查詢...")
+        time.sleep(poll_seconds)
+
+    success_count = 0
+    fail_count = 0
+    for entry in processor.backend.client.messages.batches.results(batch_id):
+        item = state["items"].get(entry.custom_id)
+        if item is None:
+            continue
+        file_path = Path(item["file"])
+        output_file = Path(item["output"])
+        if not file_path.exists():
+            # 送出後原始檔被刪掉了：結果不寫出也不登錄，其餘項目照常收回
+            print(f"   ✗ {file_path.name}: 原始檔已不存在，略過")
+            journal.update(file_path.name, "failed", sha256=item["sha256"], error="原始檔在 batch 收回前已被刪除")
+            fail_count += 1
+            continue
+        if entry.result.type != "succeeded":
+            print(f"   ✗ {file_path.name}: batch 結果為 {entry.result.type}")
+            journal.update(file_path.name, "failed", sha256=item["sha256"], error=f"batch 結果為 {entry.result.type}")
+            fail_count += 1
+            continue
+        response = ClaudeExtractionBackend.to_response(entry.result.message)
+        processor.record_usage(response, label=file_path.name)
+        try:
+            result = processor.parse_extraction_response(response)
+        except json.JSONDecodeError as e:
+            print(f"   ✗ {file_path.name}: 回應不是合法 JSON")
+            journal.update(file_path.name, "failed", sha256=item["sha256"], error=f"JSON 解析錯誤: {e}")
+            fail_count += 1
+            continue
+        result["source_file"] = file_path.name
+        result["file_path"] = str(file_path.absolute())
+        # 用送出當時的 prompt 版本與原始檔大小/mtime 登錄，送出後才改 prompt 或原始檔的話下次仍會判定需要重做
+        # （舊版狀態檔沒有大小/mtime，登錄成 None，下次會重新計算雜湊）
+        save_extraction_result(result, file_path, output_file, item["sha256"],
+                               state["model"], state["prompt_version"], manifest,
+                               source_stat=(item.get("size"), item.get("mtime_ns")))
+        journal.update(file_path.name, "written", sha256=item["sha256"])
+        print(f"   ✓ 已儲存: {output_file.name}")
+        success_count += 1
+
+    state_path.unlink()
+    return success_count, fail_count
+
+
+def process_all_raw_files(workers: int = DEFAULT_WORKERS,
+                          requests_per_minute: Optional[int] = DEFAULT_REQUESTS_PER_MINUTE,
+                          tokens_per_minute: Optional[int] = DEFAULT_TOKENS_PER_MINUTE,
+                          force: bool = False,
+                          parse_workers: int = DEFAULT_PARSE_WORKERS,
+                          batch: bool = False,
+                          base_url: Optional[str] = None,
+                          resume: bool = False,
+                          max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                          backend: str = DEFAULT_BACKEND,
+                          model: Optional[str] = None):
+    """處理 'raw files' 資料夾中的所有報告。
+    只重新萃取 manifest 判定輸入有變（原始檔內容、prompt 版本、模型）的檔案；force=True 則全部重做。
+    workers > 1 時改用併發模式：多個 worker 共用同一個 RateLimiter（RPM/TPM 預算與 429/503 退避）。
+    batch=True 時改用 Message Batches API 一次送出、輪詢完成後寫出全部結果。
+    每個檔案的狀態都記在工作日誌；resume=True 時接續上一次執行，只重做尚未寫出（失敗或中斷）的檔案，
+    已嘗試 max_attempts 次的檔案不再重試。
+    backend="ollama" 時改用本地 Ollama 萃取（不需要 API Key，也不支援 batch）。"""
     
     print("=" * 70)
     print("大量處理職能治療評估報告")
@@ -239,16 +1188,20 @@ def process_all_raw_files():
         if env_path.exists():
             load_dotenv(dotenv_path=env_path)
     
-    # Check API key
+    # Check API key（只有 Claude 後端需要）
     api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not api_key:
+    if backend == "claude" and not api_key:
         print("\n錯誤：未設定 ANTHROPIC_API_KEY")
         print("請確認 .env 檔案是否設定正確。")
         return
     
     # Initialize processor
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
     try:
-        processor = OccupationalTherapyReportProcessor(api_key=api_key)
+        extraction_backend = create_extraction_backend(backend, api_key=api_key, base_url=base_url, model=model)
+        if batch and not extraction_backend.supports_batch:
+            raise ValueError(f"{backend} 後端不支援 --batch")
+        processor = OccupationalTherapyReportProcessor(rate_limiter=rate_limiter, backend=extraction_backend)
     except Exception as e:
         print(f"處理器初始化失敗: {e}")
         return
@@ -273,49 +1226,195 @@ def process_all_raw_files():
     if not files_to_process:
         print(f"在 {raw_dir} 中找不到可處理的檔案 (.pdf, .txt, .text)")
         return
-        
-    print(f"找到 {len(files_to_process)} 個檔案待處理...\n")
+
+    journal = ExtractionJournal(output_dir / JOURNAL_FILENAME)
+    if resume:
+        if not journal.resume_last_run():
+            print("工作日誌裡沒有可以接續的執行紀錄")
+            return
+        unfinished = journal.unfinished()
+        exhausted = sorted(name for name, attempts in unfinished.items() if attempts >= max_attempts)
+        for name in exhausted:
+            print(f"⏭️ 已嘗試 {unfinished[name]} 次仍失敗，不再重試: {name}")
+        files_to_process = [
+            f for f in files_to_process
+            if f.name in unfinished and unfinished[f.name] < max_attempts
+        ]
+        print(f"接續執行 {journal.run_id}：{len(files_to_process)} 個檔案尚未完成\n")
+    else:
+        journal.start_run("batch" if batch else f"workers={workers}")
+        print(f"找到 {len(files_to_process)} 個檔案待處理（執行編號 {journal.run_id}）...\n")
     
+    manifest = ExtractionManifest(output_dir / MANIFEST_FILENAME)
+    print(f"Prompt 版本: {EXTRACTION_PROMPT_VERSION}，模型: {processor.model}\n")
+
     success_count = 0
     fail_count = 0
+    pending = []  # (file_path, output_file, sha256)
     
     for i, file_path in enumerate(files_to_process, 1):
-        print(f"[{i}/{len(files_to_process)}] 正在處理: {file_path.name}")
-        
         output_filename = f"{file_path.stem}_structured.json"
         output_file = output_dir / output_filename
-                
-        # Check if output file already exists to avoid redundant processing
-        if output_file.exists():
-            print(f"   ✓ 檔案已存在，跳過處理: {output_file.name}")
-            success_count += 1
-            print("-" * 50)
-            continue
-            
-        try:
-            result = processor.process_single_file(str(file_path))
-            
-            if result:
-                
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(result, f, ensure_ascii=False, indent=2)
-                
-                print(f"   ✓ 已儲存: {output_file.name}")
+        prefix = f"[{i}/{len(files_to_process)}]"
+        sha256 = manifest.source_hash(file_path)
+
+        if not force:
+            if manifest.is_current(file_path, sha256, EXTRACTION_PROMPT_VERSION, processor.model, output_file):
+                print(f"{prefix} ✓ 輸入未變更，跳過處理: {output_file.name}")
+                if resume:
+                    # 上次已經寫出、只是日誌還沒來得及更新就中斷了
+                    journal.update(file_path.name, "written", sha256=sha256)
                 success_count += 1
-            else:
+                continue
+            # 導入 manifest 之前就萃取好的輸出：沿用並補登紀錄，避免第一次執行就把整個語料重付一次
+            # （需要用新 prompt 重做時請加 --force）
+            if output_file.exists() and not manifest.has_entry(file_path):
+                manifest.record(file_path, sha256, EXTRACTION_PROMPT_VERSION, processor.model, output_file)
+                print(f"{prefix} ✓ 沿用既有輸出並登錄至 manifest: {output_file.name}")
+                success_count += 1
+                continue
+        pending.append((file_path, output_file, sha256))
+
+    print(f"\n需要萃取 {len(pending)} 個檔案，{success_count} 個沿用既有結果\n")
+    for file_path, _, sha256 in pending:
+        journal.update(file_path.name, "queued", sha256=sha256)
+
+    # PDF 文字萃取階段：先平行把所有待處理 PDF 的文字備妥（已有快取的直接略過）
+    text_cache = ReportTextCache(output_dir / TEXT_CACHE_DIRNAME)
+    if pending:
+        for file_path, _, _ in pending:
+            if file_path.suffix.lower() == '.pdf':
+                journal.update(file_path.name, "parsing")
+        parse_errors = prefetch_pdf_texts(
+            [(fp, sha) for fp, _, sha in pending], text_cache, parse_workers,
+            on_parsed=lambda fp, seconds: journal.update(fp.name, "queued", parse_seconds=seconds)
+        )
+        for name, e in parse_errors.items():
+            print(f"   ✗ {name} PDF 文字萃取失敗: {e}")
+            journal.update(name, "failed", error=f"PDF 文字萃取失敗: {e}", new_attempt=True)
+        fail_count += len(parse_errors)
+        pending = [item for item in pending if item[0].name not in parse_errors]
+
+    if batch:
+        # 先收回上次中斷前已送出、還沒收的 batch，再把仍需處理的檔案打包送出
+        state_dir = output_dir / BATCH_STATE_DIRNAME
+        for state_path in sorted(state_dir.glob("*.json")):
+            print(f"📦 收回先前送出的 batch: {state_path.stem}")
+            ok, failed = collect_extraction_batch(processor, state_path, manifest, journal)
+            success_count += ok
+            fail_count += failed
+        # 只剔除剛才收回時已寫出的檔案（用本次日誌判斷，--force 時 manifest 會把舊結果也算成最新）
+        not_written = journal.unfinished()
+        pending = [(fp, out, sha) for fp, out, sha in pending if fp.name in not_written]
+        state_files, prepare_failures, long_reports = submit_extraction_batches(
+            processor, pending, text_cache, state_dir, journal
+        )
+        fail_count += prepare_failures
+        # 長報告在等 batch 的同時直接分段萃取
+        for file_path, output_file, sha256 in long_reports:
+            print(f"📑 長報告改用分段萃取: {file_path.name}")
+            try:
+                if _extract_and_save(processor, file_path, output_file, sha256, manifest, text_cache, journal, False):
+                    print(f"   ✓ 已儲存: {output_file.name}")
+                    success_count += 1
+                else:
+                    print(f"   ✗ 處理失敗")
+                    fail_count += 1
+            except Exception as e:
+                print(f"   ✗ 處理發生例外錯誤: {e}")
                 fail_count += 1
-                
-        except Exception as e:
-            print(f"   ✗ 處理發生例外錯誤: {e}")
-            fail_count += 1
-            
+        for state_path in state_files:
+            ok, failed = collect_extraction_batch(processor, state_path, manifest, journal)
+            success_count += ok
+            fail_count += failed
+    elif workers <= 1:
+        for i, (file_path, output_file, sha256) in enumerate(pending, 1):
+            print(f"[{i}/{len(pending)}] 正在處理: {file_path.name}")
+            try:
+                if _extract_and_save(processor, file_path, output_file, sha256, manifest, text_cache, journal):
+                    print(f"   ✓ 已儲存: {output_file.name}")
+                    success_count += 1
+                else:
+                    fail_count += 1
+            except Exception as e:
+                print(f"   ✗ 處理發生例外錯誤: {e}")
+                fail_count += 1
+            print("-" * 50)
+    elif pending:
+        budget = []
+        if requests_per_minute:
+            budget.append(f"{requests_per_minute} RPM")
+        if tokens_per_minute:
+            budget.append(f"{tokens_per_minute} TPM")
+        print(f"併發模式：{workers} 個 worker，預算 {'、'.join(budget) or '不限'}")
         print("-" * 50)
 
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    _extract_and_save, processor, file_path, output_file, sha256, manifest, text_cache, journal, False
+                ): (file_path, output_file)
+                for file_path, output_file, sha256 in pending
+            }
+            # 依完成順序回報，每個檔案一行狀態
+            for done, future in enumerate(as_completed(futures), 1):
+                file_path, output_file = futures[future]
+                prefix = f"[{done}/{len(pending)}] {file_path.name}"
+                try:
+                    if future.result():
+                        print(f"{prefix}  ✓ 已儲存: {output_file.name}")
+                        success_count += 1
+                    else:
+                        print(f"{prefix}  ✗ 處理失敗")
+                        fail_count += 1
+                except Exception as e:
+                    print(f"{prefix}  ✗ 處理發生例外錯誤: {e}")
+                    fail_count += 1
+
     print("\n" + "=" * 70)
+    journal.finish_run()
+    states = journal.summary()
     print(f"處理完成！ 成功: {success_count}, 失敗: {fail_count}")
+    print(processor.usage_summary())
+    print(f"工作日誌（{journal.run_id}）：" + "、".join(f"{k} {v}" for k, v in sorted(states.items())))
+    if states.get("failed"):
+        print("有失敗的檔案，可用 --resume 只重做失敗的部分")
     print(f"輸出目錄: {output_dir.absolute()}")
     print("=" * 70)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="大量處理職能治療評估報告（raw files → structured files）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="同時處理的報告數（預設 1，逐一處理）")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MINUTE,
+                        help="每分鐘最多送出的 API 請求數（0 表示不限）")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TOKENS_PER_MINUTE,
+                        help="每分鐘最多送出的 input token 數（粗估，0 表示不限）")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略 manifest，全部重新萃取")
+    parser.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                        help="PDF 文字萃取的 process 數（預設為 CPU 核心數）")
+    parser.add_argument("--batch", action="store_true",
+                        help="使用 Message Batches API 一次送出所有請求（適合大量回填）")
+    parser.add_argument("--base-url", default=None,
+                        help="API 端點（例如本地替身伺服器 http://localhost:8765），"
+                             "預設使用官方端點或本機 Ollama")
+    parser.add_argument("--resume", action="store_true",
+                        help="接續上一次執行，只重做失敗或中斷時還沒寫出的檔案")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                        help="--resume 時，同一個檔案最多嘗試幾次")
+    parser.add_argument("--backend", choices=["claude", "ollama"], default=DEFAULT_BACKEND,
+                        help="結構化萃取後端：claude（雲端）或 ollama（本地，搭配 --workers 併發）")
+    parser.add_argument("--model", default=None,
+                        help=f"萃取模型（預設 claude: {CLAUDE_EXTRACTION_MODEL}、ollama: {OLLAMA_EXTRACTION_MODEL}）")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    process_all_raw_files()
+    args = parse_args()
+    process_all_raw_files(workers=args.workers, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                          force=args.force, parse_workers=args.parse_workers,
+                          batch=args.batch, base_url=args.base_url,
+                          resume=args.resume, max_attempts=args.max_attempts,
+                          backend=args.backend, model=args.model)
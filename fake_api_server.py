@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+本地替身 API 伺服器（只用標準函式庫）
+
+模擬 extract_report.py 會用到的雲端端點，用來在不花 API 額度的情況下測試整個萃取流程：
+- POST /v1/messages                       單筆結構化萃取
+- POST /v1/messages/batches               建立 batch
+- GET  /v1/messages/batches/{id}          查詢 batch 狀態（查詢幾次後變成 ended）
+- GET  /v1/messages/batches/{id}/results  取得 batch 結果（JSONL）
+- POST /api/chat                          模擬本地 Ollama（--backend ollama）
+- POST /api/embed, /api/embeddings        模擬 Ollama embedding（由文字雜湊產生固定向量）
+
+使用方式：
+    python3 fake_api_server.py --port 8765
+    python3 extract_report.py --batch --base-url http://localhost:8765
+    python3 extract_report.py --backend ollama --base-url http://localhost:8765
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 固定回傳的結構化結果（格式與 extract_report.EXTRACTION_SYSTEM_PROMPT 要求的 JSON 一致）
+FAKE_STRUCTURED_REPORT = {
+    "child_info": {"name_or_id": "測試個案", "gender": "男", "birth_date": None, "age_at_assessment": "5歲"},
+    "assessment_info": {"date": None, "therapist": None, "tools": ["PDMS-2"]},
+    "family_concerns": ["拿筆姿勢不正確"],
+    "assessment_domains": [
+        {
+            "domain": "精細動作",
+            "status": "臨界",
+            "assessment_tool": "PDMS-2",
+            "observations": "抓握姿勢不成熟",
+            "scores": {"description": None, "values": {}},
+            "findings": "工具使用經驗不足",
+            "domain_issue": "工具使用能力較不足",
+            "domain_reasoning": "手部肌力不足導致運筆控制不穩定",
+            "domain_recommendations": {
+                "treatment_focus": "手部肌力與前三指操作",
+                "home_school_strategies": ["多玩黏土、夾子遊戲"],
+                "suggested_activities": ["夾彈珠"]
+            }
+        }
+    ],
+    "case_level_recommendation": "綜合以上結果，建議安排職能療育課程",
+    "keywords": ["精細動作", "前三指操作"]
+}
+
+FAKE_EMBEDDING_DIM = 768
+
+_batches = {}
+_lock = threading.Lock()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _fake_message(model):
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": json.dumps(FAKE_STRUCTURED_REPORT, ensure_ascii=False)}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 0, "output_tokens": 0,
+                  "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0},
+    }
+
+
+def _fake_embedding(text):
+    """同樣的文字永遠得到同樣的向量（值域 -1～1）"""
+    digest = b""
+    counter = 0
+    while len(digest) < FAKE_EMBEDDING_DIM:
+        digest += hashlib.sha256(f"{counter}:{text}".encode("utf-8")).digest()
+        counter += 1
+    return [b / 127.5 - 1.0 for b in digest[:FAKE_EMBEDDING_DIM]]
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    polls_until_ended = 2
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _batch_body(self, batch):
+        ended = batch["polls"] >= self.polls_until_ended
+        total = len(batch["requests"])
+        host = self.headers.get("Host")
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else total,
+                "succeeded": total if ended else 0,
+                "errored": 0, "canceled": 0, "expired": 0,
+            },
+            "created_at": batch["created_at"],
+            "expires_at": batch["created_at"],
+            "ended_at": _now() if ended else None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": f"http://{host}/v1/messages/batches/{batch['id']}/results" if ended else None,
+        }
+
+    def do_POST(self):
+        body = self._read_json()
+        if self.path.startswith("/v1/messages/batches"):
+            batch = {
+                "id": f"msgbatch_{uuid.uuid4().hex[:24]}",
+                "requests": body.get("requests", []),
+                "created_at": _now(),
+                "polls": 0,
+            }
+            with _lock:
+                _batches[batch["id"]] = batch
+            self._send_json(self._batch_body(batch))
+        elif self.path.startswith("/api/embeddings"):
+            self._send_json({"embedding": _fake_embedding(body.get("prompt", ""))})
+        elif self.path.startswith("/api/embed"):
+            inputs = body.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_json({"model": body.get("model"), "embeddings": [_fake_embedding(t) for t in inputs]})
+        elif self.path.startswith("/api/chat"):
+            self._send_json({
+                "model": body.get("model", "fake-model"),
+                "created_at": _now(),
+                "message": {"role": "assistant", "content": json.dumps(FAKE_STRUCTURED_REPORT, ensure_ascii=False)},
+                "done": True,
+                "done_reason": "stop",
+                "prompt_eval_count": 0,
+                "eval_count": 0,
+            })
+        elif self.path.startswith("/v1/messages"):
+            self._send_json(_fake_message(body.get("model", "fake-model")))
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if parts[:3] != ["v1", "messages", "batches"] or len(parts) < 4:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+            return
+        with _lock:
+            batch = _batches.get(parts[3])
+            if batch and len(parts) == 4:
+                batch["polls"] += 1
+        if batch is None:
+            self._send_json({"type": "error", "error": {"type": "not_found_error"}}, status=404)
+        elif len(parts) == 4:
+            self._send_json(self._batch_body(batch))
+        else:
+            lines = [
+                json.dumps({
+                    "custom_id": req["custom_id"],
+                    "result": {"type": "succeeded", "message": _fake_message(req["params"].get("model", "fake-model"))},
+                }, ensure_ascii=False)
+                for req in batch["requests"]
+            ]
+            data = ("\n".join(lines) + "\n").encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/binary")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地替身 API 伺服器（測試用）")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--polls-until-ended", type=int, default=2,
+                        help="batch 被查詢幾次之後變成 ended")
+    args = parser.parse_args()
+
+    FakeAPIHandler.polls_until_ended = args.polls_until_ended
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), FakeAPIHandler)
+    print(f"替身 API 伺服器啟動於 http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
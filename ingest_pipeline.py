@@ -0,0 +1,335 @@
+"""
+串流式 ingest 管線：原始報告 → 結構化 JSON → 向量資料庫，一次跑完
+
+原本 extract_report.py 要把整批 JSON 全部寫完，create_vector_db.py 才會重新掃描 structured files/ 建索引；
+這裡把兩段串成一條管線，每個階段之間用有上限的佇列連接、各自設定併發數：
+
+    parse（PDF 文字萃取）→ llm（結構化萃取）→ chunk（拆語意塊）→ embed（向量化）→ upsert（寫入 ChromaDB）
+
+一份報告萃取完成後很快就能被檢索到，不必等整批結束。寫入階段把報告累積成小批次
+（UPSERT_BATCH_SIZE 份或等了 UPSERT_MAX_WAIT_SECONDS 秒）一次合併近乎重複的塊、更新分類表與索引版本，
+不然每份報告都要對整個語料重新分群一次，app 也會每份報告重新載入一次。萃取結果一樣會寫進 structured files/
+（並登錄 manifest 與工作日誌），之後照常可以用 create_vector_db.py 重建索引。
+"""
+
+import argparse
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from extract_report import (
+    CLAUDE_EXTRACTION_MODEL, DEFAULT_BACKEND, DEFAULT_PARSE_WORKERS, DEFAULT_REQUESTS_PER_MINUTE,
+    DEFAULT_TOKENS_PER_MINUTE, EXTRACTION_PROMPT_VERSION, JOURNAL_FILENAME, MANIFEST_FILENAME,
+    OLLAMA_EXTRACTION_MODEL, TEXT_CACHE_DIRNAME,
+    ExtractionJournal, ExtractionManifest, OccupationalTherapyReportProcessor, RateLimiter,
+    ReportTextCache, create_extraction_backend, join_pages, partial_extraction_error, read_report_pages,
+    save_extraction_result,
+)
+from create_vector_db import EMBEDDING_MODEL, LocalRAGBuilder, extraction_info
+
+# =================設定區=================
+RAW_DIR = Path("raw files")
+OUTPUT_DIR = Path("structured files")
+
+DEFAULT_LLM_WORKERS = 4
+DEFAULT_EMBED_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 16  # 每個階段之間最多暫存幾個工作，避免前段跑太快把記憶體塞滿
+UPSERT_BATCH_SIZE = 16        # 累積幾份報告才寫入一次索引
+UPSERT_MAX_WAIT_SECONDS = 10  # 第一份報告等了這麼久還湊不滿一批就先寫入，新報告不會等太久才能被檢索
+# =======================================
+
+_DONE = object()  # 佇列結束標記
+
+
+class _Stage:
+    """管線中的一個階段：workers 個執行緒從 in_queue 取工作、呼叫 fn，把 fn 回傳的每個結果放進 out_queue。
+    收到結束標記時放回去讓同階段的其他執行緒也看得到；最後一個結束的執行緒再把結束標記往下一階段傳。
+    有給 flush 時（累積成批次處理的階段），等了 flush_seconds 秒沒有新工作、以及階段結束前都會呼叫一次。"""
+
+    def __init__(self, name, fn, in_queue, out_queue, workers, flush=None, flush_seconds=None):
+        self.name = name
+        self.fn = fn
+        self.flush = flush
+        self.flush_seconds = flush_seconds if flush else None
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.remaining = workers
+        self.processed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._loop, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+    def _flush(self):
+        if self.flush is None:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"   ✗ [{self.name}] 批次處理失敗: {e}")
+            with self._lock:
+                self.errors += 1
+
+    def _loop(self):
+        while True:
+            try:
+                item = self.in_queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                self._flush()
+                continue
+            if item is _DONE:
+                self.in_queue.put(_DONE)
+                break
+            try:
+                for result in self.fn(item) or []:
+                    if self.out_queue is not None:
+                        self.out_queue.put(result)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                print(f"   ✗ [{self.name}] {getattr(item, 'name', '')} 處理失敗: {e}")
+                with self._lock:
+                    self.errors += 1
+
+        with self._lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last:
+            self._flush()
+        if last and self.out_queue is not None:
+            self.out_queue.put(_DONE)
+
+
+class _Job:
+    """一份報告在管線中的狀態"""
+
+    def __init__(self, file_path: Path, output_file: Path, sha256: str):
+        self.file_path = file_path
+        self.output_file = output_file
+        self.sha256 = sha256
+        self.name = file_path.name
+        self.pages = None
+        self.result = None
+        self.chunks = None
+        self.json_sha256 = None
+        self.started = time.monotonic()
+        self.ready = None  # 進入 upsert 階段的時間
+
+
+def run_pipeline(parse_workers: int = DEFAULT_PARSE_WORKERS,
+                 llm_workers: int = DEFAULT_LLM_WORKERS,
+                 embed_workers: int = DEFAULT_EMBED_WORKERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+                 base_url: str = None,
+                 force: bool = False,
+                 backend: str = DEFAULT_BACKEND,
+                 model: str = None,
+                 upsert_batch_size: int = UPSERT_BATCH_SIZE):
+    print("=" * 70)
+    print("串流式 ingest：原始報告 → 結構化 JSON → 向量資料庫")
+    print("=" * 70)
+
+    if not RAW_DIR.exists():
+        print(f"找不到輸入資料夾: {RAW_DIR.absolute()}")
+        return
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    try:
+        processor = OccupationalTherapyReportProcessor(
+            rate_limiter=RateLimiter(requests_per_minute, tokens_per_minute),
+            backend=create_extraction_backend(backend, base_url=base_url, model=model)
+        )
+        builder = LocalRAGBuilder()
+    except Exception as e:
+        print(f"初始化失敗: {e}")
+        return
+
+    manifest = ExtractionManifest(OUTPUT_DIR / MANIFEST_FILENAME)
+    text_cache = ReportTextCache(OUTPUT_DIR / TEXT_CACHE_DIRNAME)
+    journal = ExtractionJournal(OUTPUT_DIR / JOURNAL_FILENAME)
+
+    # 跟 process_all_raw_files 一樣用 manifest 判斷哪些檔案需要萃取；
+    # 已萃取過的檔案不會重新進索引，需要時請另外執行 create_vector_db.py
+    jobs = []
+    for file_path in sorted(RAW_DIR.iterdir()):
+        if not file_path.is_file() or file_path.suffix.lower() not in ('.pdf', '.txt', '.text'):
+            continue
+        output_file = OUTPUT_DIR / f"{file_path.stem}_structured.json"
+        sha256 = manifest.source_hash(file_path)
+        if not force and manifest.is_current(file_path, sha256, EXTRACTION_PROMPT_VERSION,
+                                             processor.model, output_file):
+            continue
+        jobs.append(_Job(file_path, output_file, sha256))
+
+    if not jobs:
+        print("沒有需要萃取的檔案")
+        return
+    # 有檔案要處理才開新的一輪，沒事做的執行不會在紀錄裡留下空的一輪（--resume 會找錯輪）
+    journal.start_run("pipeline")
+    print(f"{len(jobs)} 個檔案進入管線（parse {parse_workers}、llm {llm_workers}、"
+          f"embed {embed_workers}，佇列上限 {queue_size}）\n")
+
+    started = time.monotonic()
+    pool = ProcessPoolExecutor(max_workers=parse_workers)
+
+    def parse(job):
+        journal.update(job.name, "parsing", sha256=job.sha256, new_attempt=True)
+        job.pages = text_cache.get_pages(job.sha256) if job.file_path.suffix.lower() == '.pdf' else None
+        parse_seconds = None
+        if job.pages is None:
+            # pdfplumber 是 CPU-bound，交給 process pool；這個執行緒只負責等結果
+            try:
+                job.pages, parse_seconds = pool.submit(read_report_pages, str(job.file_path)).result()
+            except Exception as e:
+                journal.update(job.name, "failed", error=f"文字萃取失敗: {e}")
+                raise
+            if job.file_path.suffix.lower() == '.pdf':
+                text_cache.put_pages(job.sha256, job.pages)
+        journal.update(job.name, "llm", parse_seconds=parse_seconds)
+        return [job]
+
+    def extract(job):
+        llm_started = time.monotonic()
+        try:
+            job.result = processor.process_single_file(
+                str(job.file_path), verbose=False, text=join_pages(job.pages), pages=job.pages
+            )
+        except Exception as e:
+            journal.update(job.name, "failed", error=str(e))
+            raise
+        llm_seconds = time.monotonic() - llm_started
+        if not job.result:
+            journal.update(job.name, "failed", error="結構化萃取失敗（JSON 解析錯誤或 API 錯誤）",
+                           llm_seconds=llm_seconds)
+            print(f"   ✗ {job.name} 結構化萃取失敗")
+            return []
+        failed_windows = save_extraction_result(job.result, job.file_path, job.output_file, job.sha256,
+                                                processor.model, EXTRACTION_PROMPT_VERSION, manifest)
+        if failed_windows:
+            # 其餘段落照樣寫入索引，但日誌記成 failed，下次執行（或 --resume）會重做
+            error = partial_extraction_error(failed_windows, job.result["extraction_windows"]["total"])
+            journal.update(job.name, "failed", error=error, llm_seconds=llm_seconds)
+            print(f"   ⚠️ {job.name}: {error}")
+        else:
+            journal.update(job.name, "written", llm_seconds=llm_seconds)
+            print(f"   ✓ 已萃取: {job.output_file.name}")
+        return [job]
+
+    def chunk(job):
+        job.chunks = builder.process_json_to_chunks(job.result)
+        return [job]
+
+    def embed(job):
+        # 先把向量算好放進 embedding 快取，upsert 階段合併近乎重複的塊後直接讀快取寫入
+        builder.embed_chunks(job.chunks)
+        job.ready = time.monotonic()
+        return [job]
+
+    pending_upserts = []  # 只有單一 upsert 執行緒會碰，不需要鎖
+
+    def upsert(job):
+        job.json_sha256 = hashlib.sha256(job.output_file.read_bytes()).hexdigest()
+        pending_upserts.append(job)
+        if (len(pending_upserts) >= upsert_batch_size
+                or time.monotonic() - pending_upserts[0].ready >= UPSERT_MAX_WAIT_SECONDS):
+            flush_upserts()
+        return []
+
+    def flush_upserts():
+        # 登錄到增量建索引紀錄與合併登錄表：重新萃取後領域變少時舊的塊會一併刪除，
+        # 跟既有報告近乎重複的塊只會更新代表塊的合併來源。整批只重新分群、發布一次
+        if not pending_upserts:
+            return
+        batch = pending_upserts[:]
+        del pending_upserts[:]
+        builder.sync_sources([
+            (job.output_file.name, job.json_sha256, job.chunks, extraction_info(job.result)) for job in batch
+        ])
+        builder.publish()  # 執行中的 app 看到新版本會重新載入
+        for job in batch:
+            print(f"   🔎 已可檢索: {job.name}（{len(job.chunks)} 個語意塊，"
+                  f"進入管線後 {time.monotonic() - job.started:.1f} 秒）")
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(5)]
+    stages = [
+        _Stage("parse", parse, queues[0], queues[1], parse_workers),
+        _Stage("llm", extract, queues[1], queues[2], llm_workers),
+        _Stage("chunk", chunk, queues[2], queues[3], 1),
+        _Stage("embed", embed, queues[3], queues[4], embed_workers),
+        # ChromaDB 寫入維持單一執行緒，累積成批次寫入
+        _Stage("upsert", upsert, queues[4], None, 1,
+               flush=flush_upserts, flush_seconds=UPSERT_MAX_WAIT_SECONDS),
+    ]
+    for stage in stages:
+        stage.start()
+
+    for job in jobs:
+        journal.update(job.name, "queued", sha256=job.sha256)
+        queues[0].put(job)
+    queues[0].put(_DONE)
+
+    for stage in stages:
+        stage.join()
+    pool.shutdown()
+    journal.finish_run()
+    if stages[-1].processed:
+        try:
+            builder.export_snapshot()
+        except Exception as e:
+            print(f"  ✗ snapshot 匯出失敗: {e}")
+
+    elapsed = time.monotonic() - started
+    print("\n" + "=" * 70)
+    print(f"管線完成，耗時 {elapsed:.1f} 秒（embedding 模型: {EMBEDDING_MODEL}）")
+    for stage in stages:
+        print(f"  {stage.name:<7} 完成 {stage.processed}、失敗 {stage.errors}")
+    print(processor.usage_summary())
+    print("=" * 70)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="串流式 ingest：原始報告一路處理到向量資料庫")
+    parser.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                        help="PDF 文字萃取的 process 數")
+    parser.add_argument("--llm-workers", type=int, default=DEFAULT_LLM_WORKERS,
+                        help="同時進行結構化萃取的報告數")
+    parser.add_argument("--embed-workers", type=int, default=DEFAULT_EMBED_WORKERS,
+                        help="同時向量化的報告數")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="階段之間的佇列上限")
+    parser.add_argument("--upsert-batch", type=int, default=UPSERT_BATCH_SIZE,
+                        help=f"累積幾份報告寫入一次索引（最多等 {UPSERT_MAX_WAIT_SECONDS} 秒）")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TOKENS_PER_MINUTE)
+    parser.add_argument("--base-url", default=None, help="API 端點（例如本地替身伺服器）")
+    parser.add_argument("--backend", choices=["claude", "ollama"], default=DEFAULT_BACKEND,
+                        help="結構化萃取後端")
+    parser.add_argument("--model", default=None,
+                        help=f"萃取模型（預設 claude: {CLAUDE_EXTRACTION_MODEL}、ollama: {OLLAMA_EXTRACTION_MODEL}）")
+    parser.add_argument("--force", action="store_true", help="忽略 manifest，全部重新萃取")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_pipeline(parse_workers=args.parse_workers, llm_workers=args.llm_workers,
+                 embed_workers=args.embed_workers, queue_size=args.queue_size,
+                 requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                 base_url=args.base_url, force=args.force,
+                 backend=args.backend, model=args.model,
+                 upsert_batch_size=args.upsert_batch)
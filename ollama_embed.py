@@ -0,0 +1,40 @@
+"""
+Ollama 批次 embedding（建索引的 create_vector_db.py 與網頁 app.py 共用）
+
+/api/embed 一次送出多段文字（input 為清單），比逐筆呼叫 /api/embeddings 快很多。
+批次請求失敗時分兩種情況：
+- 伺服器不支援（舊版 Ollama 沒有這個端點回 400/404/405、回傳的向量數對不上）：之後都改為逐筆呼叫
+- 這一批暫時失敗（逾時、5xx，例如一批太大、模型還在載入）：只有這一批改為逐筆呼叫，下一批照樣批次送出
+兩種都以 BatchEmbeddingUnavailable 通知呼叫端（permanent 區分）；連不上伺服器等其他錯誤照常拋出，
+逐筆呼叫也一樣會失敗，不必再試。
+"""
+
+from typing import List, Optional
+
+import requests
+
+
+class BatchEmbeddingUnavailable(Exception):
+    """批次 embedding 不可用，呼叫端應改為逐筆呼叫；permanent=False 表示只有這一批失敗"""
+
+    def __init__(self, reason: str, permanent: bool = True):
+        super().__init__(reason)
+        self.permanent = permanent
+
+
+def embed_batch(url: str, model: str, texts: List[str], timeout: float,
+                session: Optional[requests.Session] = None) -> List[List[float]]:
+    """向 /api/embed 送出一批文字，回傳與 texts 同順序的向量"""
+    try:
+        response = (session or requests).post(url, json={"model": model, "input": texts}, timeout=timeout)
+    except requests.Timeout as e:
+        raise BatchEmbeddingUnavailable(f"逾時 {timeout:.0f} 秒", permanent=False) from e
+    if response.status_code in (400, 404, 405):
+        raise BatchEmbeddingUnavailable(f"HTTP {response.status_code}")
+    if response.status_code >= 500:
+        raise BatchEmbeddingUnavailable(f"HTTP {response.status_code}", permanent=False)
+    response.raise_for_status()
+    embeddings = response.json().get("embeddings") or []
+    if len(embeddings) != len(texts):
+        raise BatchEmbeddingUnavailable(f"回傳 {len(embeddings)} 個向量，預期 {len(texts)} 個")
+    return embeddings
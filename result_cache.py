@@ -0,0 +1,142 @@
+"""
+生成結果快取（app.py 用）
+
+治療師常常小改一下就重按「開始生成報告」，或同一個個案打開兩次；每按一次都要重跑區塊拆解、
+embedding、檢索和一次上萬 token 的生成，既慢又燒雲端額度。輸入、模型、索引版本與 prompt 版本都相同時，
+結果就直接從這裡拿。
+
+儲存方式：local_result_cache/results.sqlite3，一筆一個 JSON 結果，以（種類, key）區分
+- key 由呼叫端把所有會影響結果的東西（正規化的輸入、模型、索引版本、prompt 版本…）組起來取雜湊
+- 超過 RESULT_CACHE_TTL_DAYS 天的結果視為過期（模型本身也會更新，太舊的結果不該一直沿用）
+- 超過 max_entries 筆時淘汰最久沒用到的（LRU）
+
+查看快取狀態／清除快取：
+    python3 result_cache.py
+    python3 result_cache.py --clear [種類]
+"""
+
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+# =================設定區=================
+RESULT_CACHE_DIR = "./local_result_cache"
+RESULT_CACHE_TTL_DAYS = 30
+RESULT_CACHE_MAX_ENTRIES = 5000
+# =======================================
+
+
+def result_key(*parts) -> str:
+    """把會影響結果的各個部分組成一個 key（None 也算一種值，例如沒有索引版本的舊索引）"""
+    return hashlib.sha256("\0".join("" if p is None else str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """以（種類, key）存放 JSON 結果的持久化快取，有效期限 + LRU 淘汰，可跨執行緒共用"""
+
+    def __init__(self, path: str = RESULT_CACHE_DIR, ttl_days: float = RESULT_CACHE_TTL_DAYS,
+                 max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path / "results.sqlite3"), check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    kind TEXT,
+                    key TEXT,
+                    value TEXT,
+                    created REAL,
+                    last_used REAL,
+                    PRIMARY KEY (kind, key)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    kind TEXT PRIMARY KEY,
+                    hits INTEGER DEFAULT 0,
+                    misses INTEGER DEFAULT 0
+                )""")
+
+    def get(self, kind: str, key: str):
+        """回傳快取的結果，沒有或已過期時回傳 None"""
+        with self._lock, self._conn:
+            now = time.time()
+            row = self._conn.execute(
+                "SELECT value, created FROM entries WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            if row and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+                row = None
+            if row:
+                self._conn.execute("UPDATE entries SET last_used = ? WHERE kind = ? AND key = ?", (now, kind, key))
+            self._conn.execute("""
+                INSERT INTO counters (kind, hits, misses) VALUES (?, ?, ?)
+                ON CONFLICT(kind) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+            """, (kind, int(row is not None), int(row is None)))
+        return json.loads(row[0]) if row else None
+
+    def put(self, kind: str, key: str, value):
+        """寫入結果（同一個 key 直接覆蓋，有效期限重新起算）"""
+        with self._lock, self._conn:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def clear(self, kind: Optional[str] = None) -> int:
+        """清除某個種類（不指定則全部）的快取，回傳清掉的筆數"""
+        with self._lock, self._conn:
+            if kind is None:
+                return self._conn.execute("DELETE FROM entries").rowcount
+            return self._conn.execute("DELETE FROM entries WHERE kind = ?", (kind,)).rowcount
+
+    def summary(self) -> List[str]:
+        """每個種類的快取筆數與累計命中率"""
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT c.kind, COALESCE(e.n, 0), c.hits, c.misses
+                FROM counters c LEFT JOIN (SELECT kind, COUNT(*) AS n FROM entries GROUP BY kind) e
+                ON c.kind = e.kind ORDER BY c.kind
+            """).fetchall()
+        lines = []
+        for kind, count, hits, misses in rows:
+            total = hits + misses
+            rate = hits / total * 100 if total else 0.0
+            lines.append(f"{kind}: {count} 筆，累計命中 {hits}/{total}（{rate:.1f}%）")
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="查看或清除生成結果快取")
+    parser.add_argument("--path", default=RESULT_CACHE_DIR)
+    parser.add_argument("--clear", nargs="?", const="", default=None, metavar="種類",
+                        help="清除快取（可指定種類，例如 report；不指定則全部清除）")
+    args = parser.parse_args()
+
+    cache = ResultCache(args.path)
+    if args.clear is not None:
+        removed = cache.clear(args.clear or None)
+        print(f"🗑️ 已清除 {removed} 筆快取結果")
+    print(f"快取路徑: {cache.path.absolute()}（有效 {RESULT_CACHE_TTL_DAYS} 天，上限 {cache.max_entries} 筆）")
+    for line in cache.summary() or ["（尚無資料）"]:
+        print(f"  {line}")
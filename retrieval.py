@@ -0,0 +1,170 @@
+"""
+各領域參考資料的檢索與篩選（app.py 步驟 B 用）
+
+原本每個領域最多查兩次：先查 {"$and": [領域, {"has_recommendation": True}]}，查不到再只用領域條件查一次，
+再從前 3 筆裡保留前 2 筆相似度 > 0.3 的。這裡改成每個領域只查一次：用領域條件取一個候選池，
+在記憶體裡依序做：
+1. 有建議內容的候選優先（池裡有帶建議的就只用它們，沒有才退回一般觀察資料，跟原本的兩段式查詢同義）
+2. 相似度門檻
+3. 多樣性：內容近乎相同的不重複選，盡量來自不同報告
+
+以「無異常」為主的領域，帶建議的塊可能全都排在候選池之外；分類表顯示這些領域有帶建議的塊時，
+再補一次只查帶建議的查詢（numpy/snapshot 後端直接把條件併進同一次運算的遮罩），不會因為候選池太小就
+退回一般觀察資料。ChromaDB 後端的補查要多一次往返，所以候選池依分類表裡帶建議的塊所佔比例放大
+（pool_size_for），讓池裡通常已經有帶建議的塊，補查很少真的需要。
+
+retrieve_many 把一份個案的所有評估區塊一起檢索：numpy/snapshot 後端所有區塊的候選一次矩陣運算算完，
+ChromaDB 後端則把不同領域的查詢同時送出。
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+from chunk_dedup import DEDUP_THRESHOLD, NUM_PERM, minhash_signature
+
+# =================設定區=================
+CANDIDATE_POOL_SIZE = 30   # 每個領域一次取回的候選數（帶建議的候選排在這之後就會被視為沒有）
+MAX_CANDIDATE_POOL_SIZE = 200  # 帶建議的塊很少的領域，候選池最多放大到這麼多
+RECOMMENDATIONS_IN_POOL = 4    # 放大候選池時，希望池裡預期有幾筆帶建議的塊
+REFERENCES_PER_DOMAIN = 2  # 每個領域最多保留幾筆參考資料
+MIN_SIMILARITY = 0.3       # 領域已鎖定，門檻可放寬，只用來濾掉完全不相關的
+REDUNDANT_SIMILARITY = DEDUP_THRESHOLD  # 兩筆參考資料的 MinHash 相似度達到這個值就只留一筆
+QUERY_WORKERS = 4          # ChromaDB 後端同時送出的查詢數（不同領域條件無法合併成一次查詢）
+# =======================================
+
+
+def domain_where(matched_domains: List[str]) -> Dict:
+    """用「領域」metadata 鎖定範圍，避免被其他領域但字面相似的內容打敗"""
+    if len(matched_domains) == 1:
+        return {"domain": matched_domains[0]}
+    return {"domain": {"$in": matched_domains}}
+
+
+def recommendation_where(matched_domains: List[str]) -> Dict:
+    """只找領域內有建議內容的塊"""
+    return {"$and": [domain_where(matched_domains), {"has_recommendation": True}]}
+
+
+def candidates_from_results(results: Dict, row: int = 0) -> List[Dict]:
+    """把 Chroma 格式的查詢結果（第 row 個查詢）轉成候選清單"""
+    if not (results.get("ids") and results["ids"][row]):
+        return []
+    return [
+        {"id": chunk_id, "document": document, "metadata": metadata or {}, "similarity": 1.0 - distance}
+        for chunk_id, document, metadata, distance in zip(
+            results["ids"][row], results["documents"][row], results["metadatas"][row], results["distances"][row]
+        )
+    ]
+
+
+def _redundant(candidate: Dict, chosen: List[Dict], signatures: Dict[str, object]) -> bool:
+    """candidate 跟已選的某一筆內容近乎相同（簽章只在需要比對時才算）"""
+    def signature(c):
+        if c["id"] not in signatures:
+            signatures[c["id"]] = minhash_signature(c["document"] or "")
+        return signatures[c["id"]]
+
+    return any((signature(candidate) == signature(c)).sum() / NUM_PERM >= REDUNDANT_SIMILARITY for c in chosen)
+
+
+def select_references(candidates: List[Dict], k: int = REFERENCES_PER_DOMAIN,
+                      min_similarity: float = MIN_SIMILARITY) -> Tuple[List[Dict], bool]:
+    """從依相似度排序的候選池挑出參考資料，回傳 (參考資料, 是否退回沒有建議的一般觀察資料)"""
+    with_recommendation = [c for c in candidates if c["metadata"].get("has_recommendation")]
+    pool = [c for c in (with_recommendation or candidates) if c["similarity"] > min_similarity]
+
+    chosen: List[Dict] = []
+    signatures: Dict[str, object] = {}
+    # 第一輪只挑不同報告的，還不夠再從同一份報告補（近乎相同的內容兩輪都不選）
+    for distinct_sources in (True, False):
+        for candidate in pool:
+            if len(chosen) >= k:
+                break
+            if candidate in chosen:
+                continue
+            if distinct_sources and candidate["metadata"].get("source_file") in {
+                    c["metadata"].get("source_file") for c in chosen}:
+                continue
+            if not _redundant(candidate, chosen, signatures):
+                chosen.append(candidate)
+    chosen.sort(key=lambda c: -c["similarity"])
+    return chosen, not with_recommendation
+
+
+def pool_size_for(chunk_count: int, recommendation_count: int, pool_size: int = CANDIDATE_POOL_SIZE) -> int:
+    """依分類表裡領域內帶建議的塊所佔比例放大候選池：池裡預期要有 RECOMMENDATIONS_IN_POOL 筆帶建議的塊，
+    最多 MAX_CANDIDATE_POOL_SIZE 筆，也不超過領域的塊數（整個領域都在池裡就不可能漏掉）"""
+    if not chunk_count or not recommendation_count:
+        return pool_size
+    wanted = -(-RECOMMENDATIONS_IN_POOL * chunk_count // recommendation_count)
+    return max(pool_size, min(wanted, MAX_CANDIDATE_POOL_SIZE, chunk_count))
+
+
+def query_many(collection, embeddings: List[List[float]], wheres: List[Dict], n_results: Union[int, List[int]],
+               workers: int = QUERY_WORKERS) -> List[List[Dict]]:
+    """多個查詢各自帶 where 條件，回傳每個查詢的候選清單（n_results 可以每個查詢各自指定）。
+    numpy/snapshot 後端一次向量化算完（NumpyVectorStore.query_many）；
+    ChromaDB 一次查詢只能帶一個 where，條件與筆數相同的查詢合併成一次呼叫，不同的同時送出"""
+    sizes = n_results if isinstance(n_results, list) else [n_results] * len(embeddings)
+    if hasattr(collection, "query_many"):
+        results = collection.query_many(embeddings, wheres, max(sizes))
+        return [candidates_from_results(results, row)[:sizes[row]] for row in range(len(embeddings))]
+
+    groups: Dict[Tuple[str, int], List[int]] = {}
+    for i, where in enumerate(wheres):
+        groups.setdefault((json.dumps(where, sort_keys=True, ensure_ascii=False), sizes[i]), []).append(i)
+
+    def run(rows):
+        results = collection.query(query_embeddings=[embeddings[i] for i in rows], n_results=sizes[rows[0]],
+                                   where=wheres[rows[0]])
+        return [candidates_from_results(results, j) for j in range(len(rows))]
+
+    candidates: List[Optional[List[Dict]]] = [None] * len(embeddings)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(groups)))) as pool:
+        for rows, found in zip(groups.values(), pool.map(run, groups.values())):
+            for i, rows_candidates in zip(rows, found):
+                candidates[i] = rows_candidates
+    return candidates
+
+
+def retrieve_many(collection, embeddings: List[List[float]], matched_domains: List[List[str]],
+                  recommendation_counts: Optional[List[int]] = None, chunk_counts: Optional[List[int]] = None,
+                  pool_size: int = CANDIDATE_POOL_SIZE) -> List[Tuple[List[Dict], bool]]:
+    """多個評估區塊一起檢索：每個區塊各自的領域過濾，一次查詢（或一次向量化運算）取回全部候選池，
+    再各自篩選。recommendation_counts、chunk_counts 為分類表記錄的各區塊領域內帶建議的塊數與總塊數：
+    帶建議的塊數大於 0 但候選池裡沒有帶建議的塊時，另外查一次只含帶建議的塊。
+    回傳順序跟輸入相同，每個元素為 (參考資料, 是否退回一般觀察資料)。
+
+    查詢次數：numpy/snapshot 後端不論幾個區塊都是一次運算（補查的條件併在裡面）。
+    ChromaDB 後端第一輪每種領域條件一次查詢，補查每種領域條件最多再一次，最壞情況是 2 × 不同領域條件數；
+    候選池已依帶建議的比例放大（pool_size_for），一般只有帶建議的塊排名都很後面時才需要補查"""
+    if not embeddings:
+        return []
+    counts = recommendation_counts or [0] * len(embeddings)
+    wheres = [domain_where(domains) for domains in matched_domains]
+
+    if hasattr(collection, "query_many"):
+        # numpy/snapshot：帶建議的過濾只是多一個遮罩，跟領域查詢放進同一次運算，不必等第一輪的結果
+        extra = [i for i, count in enumerate(counts) if count]
+        found = query_many(collection, embeddings + [embeddings[i] for i in extra],
+                           wheres + [recommendation_where(matched_domains[i]) for i in extra], pool_size)
+        pools, extra_pools = found[:len(embeddings)], dict(zip(extra, found[len(embeddings):]))
+    else:
+        sizes = [pool_size_for(chunks, count, pool_size)
+                 for chunks, count in zip(chunk_counts or [0] * len(embeddings), counts)]
+        pools = query_many(collection, embeddings, wheres, sizes)
+        extra = [i for i, pool in enumerate(pools)
+                 if counts[i] and not any(c["metadata"].get("has_recommendation") for c in pool)]
+        extra_pools = dict(zip(extra, query_many(
+            collection, [embeddings[i] for i in extra], [recommendation_where(matched_domains[i]) for i in extra],
+            pool_size
+        ))) if extra else {}
+
+    results = []
+    for i, pool in enumerate(pools):
+        seen = {c["id"] for c in pool}
+        merged = pool + [c for c in extra_pools.get(i, []) if c["id"] not in seen]
+        merged.sort(key=lambda c: -c["similarity"])
+        results.append(select_references(merged))
+    return results
@@ -0,0 +1,64 @@
+"""
+近乎重複語意塊合併（chunk_dedup.py）的測試
+"""
+
+import numpy as np
+
+from chunk_dedup import LSH_BANDS, NUM_PERM, DedupRegistry, cluster_signatures
+
+
+def _chain_signatures():
+    """A~B、B~C 都達門檻（64 個排列差 8 個），A、C 差 16 個（0.75）"""
+    a = np.arange(NUM_PERM, dtype=np.uint32)
+    b = a.copy()
+    b[0:NUM_PERM // 2:NUM_PERM // LSH_BANDS] += 1000   # 前 8 個分桶各改一個排列
+    c = b.copy()
+    c[NUM_PERM // 2::NUM_PERM // LSH_BANDS] += 1000    # 後 8 個分桶各改一個排列
+    return np.stack([a, b, c])
+
+
+def test_chained_chunks_not_merged_transitively():
+    """A~B~C 但 A、C 不相似：C 不能因為 B 被併進 A 的群"""
+    signatures = _chain_signatures()
+    same = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+    assert same[0, 1] >= 0.85 and same[1, 2] >= 0.85 and same[0, 2] < 0.85
+
+    leaders = cluster_signatures(["語言|True"] * 3, signatures, 0.85)
+    assert leaders == [0, 0, 2]
+    for i, rep in enumerate(leaders):
+        assert same[i, rep] >= 0.85
+
+
+def test_preferred_chunk_stays_representative():
+    """目前已寫入的塊優先當代表：B 優先時 A、C 都跟 B 相似，合成一群"""
+    leaders = cluster_signatures(["語言|True"] * 3, _chain_signatures(), 0.85, preferred=[1])
+    assert leaders == [1, 1, 1]
+
+
+def _chunk(source, index, text):
+    return {"id": f"{source}_{index}", "text": text, "metadata": {
+        "type": "assessment_domain", "domain": "語言", "has_recommendation": True, "source_file": source}}
+
+
+def _sync(registry, threshold=0.85):
+    plan, dropped = registry.plan(threshold)
+    registry.set_physical(plan, dropped)
+    return plan, dropped
+
+
+def test_incremental_plan_only_touches_affected_clusters(tmp_path):
+    """新增一份報告時，只有它會併進去的群需要更新，其他群沿用上次的結果"""
+    texts = ["個案能理解兩步驟指令，建議在家中以圖卡練習生活用語與句型擴展" * 3,
+             "個案手眼協調較弱，建議每天進行串珠、夾豆子與剪紙等精細動作活動" * 3]
+    registry = DedupRegistry(tmp_path / "dedup_registry.sqlite3")
+    for source in ("a", "b"):
+        chunks = [_chunk(source, i, text) for i, text in enumerate(texts)]
+        registry.replace_source(source, chunks, [c["text"] for c in chunks])
+    plan, _ = _sync(registry)
+    assert sorted(plan) == ["a_0", "a_1"]
+
+    chunks = [_chunk("c", 0, texts[0])]
+    registry.replace_source("c", chunks, [c["text"] for c in chunks])
+    plan, dropped = _sync(registry)
+    assert list(plan) == ["a_0"] and plan["a_0"]["members"] == 3 and dropped == []
+    assert _sync(registry) == ({}, [])
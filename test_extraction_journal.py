@@ -0,0 +1,27 @@
+"""
+萃取工作日誌（extract_report.ExtractionJournal）的測試
+"""
+
+from extract_report import ExtractionJournal
+
+
+def test_resume_skips_empty_runs(tmp_path):
+    """中斷的執行之後又有一次沒處理任何檔案的執行：--resume 仍要接續中斷的那一次"""
+    journal = ExtractionJournal(tmp_path / "extraction_journal.sqlite3")
+    interrupted = journal.start_run("workers=2")
+    journal.update("a.pdf", "written", sha256="a", new_attempt=True)
+    journal.update("b.pdf", "llm", sha256="b", new_attempt=True)
+
+    journal.start_run("workers=2")
+    journal.finish_run()
+
+    assert journal.resume_last_run() == interrupted
+    assert journal.unfinished() == {"b.pdf": 1}
+
+
+def test_resume_without_runs(tmp_path):
+    """只有空的執行時沒有可以接續的紀錄"""
+    journal = ExtractionJournal(tmp_path / "extraction_journal.sqlite3")
+    journal.start_run("pipeline")
+    journal.finish_run()
+    assert journal.resume_last_run() is None
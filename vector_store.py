@@ -0,0 +1,475 @@
+"""
+向量檢索後端
+
+app.py 只用到 ChromaDB collection 的一小部分介面：
+- query(query_embeddings=..., n_results=..., where=...)  回傳 Chroma 格式的結果（每個 query 一個清單）
+- get(include=["metadatas"])
+- count()
+
+這裡提供兩種實作，由 open_vector_store(backend) 選擇：
+- "chroma"：直接使用 ChromaDB 的 collection（HNSW 近似搜尋）
+- "numpy" ：把整個 collection 載入成一個連續的 float32 矩陣做暴力 cosine 搜尋（精確結果）。
+            metadata 每個欄位存成一個整數編碼陣列，where 條件（domain、has_recommendation…）
+            直接變成布林遮罩，先過濾再算相似度，不會有 HNSW 在窄範圍過濾時漏掉結果的問題。
+            我們的資料量（數萬個語意塊以內）一次矩陣乘法就算完。
+            可選擇壓縮存放（quantization="float16"/"int8"，dims 截斷 Matryoshka 維度）：
+            先用壓縮矩陣找出 k × rescore_factor 個候選，再用完整精度向量重新計分排序。
+            完整精度向量可以放在磁碟上的 memory-mapped 檔案（full_vectors_path），
+            常駐記憶體的只有壓縮矩陣，重新計分時只會讀到候選那幾列。
+
+寫入仍然只透過 ChromaDB（create_vector_db.py），numpy 後端是從 collection 載入的唯讀副本。
+
+另外 create_vector_db.py 每次建完索引會匯出單一檔案的 snapshot（"snapshot" 後端），
+部署到其他機器只要複製這一個檔案，開啟時向量直接 memory map，不必複製或解析：
+
+    [8 bytes magic][uint32 格式版本][uint32 保留][uint64 header 長度][header JSON]
+    [補齊到 64 bytes 對齊][float32 向量矩陣（已正規化，n × dim）][zlib 壓縮的 JSON：ids/documents/metadatas]
+
+header 裡有 manifest（embedding 模型、萃取 prompt 版本、拆塊版本、索引版本、建立時間等）與各段的位移。
+
+app.py 透過 VectorStoreHandle 在整個程式裡共用同一個已開啟的向量庫，索引版本標記變了才重新載入。
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# =================設定區=================
+DEFAULT_BACKEND = "chroma"  # "chroma" 或 "numpy"
+LOAD_PAGE_SIZE = 5000       # 從 ChromaDB 載入時每次讀取的筆數
+
+# numpy 後端的壓縮存放
+DEFAULT_QUANTIZATION = "float32"  # "float32"、"float16"（一半記憶體）或 "int8"（四分之一）
+DEFAULT_DIMS = None               # 只保留前 N 維（僅適用 Matryoshka 訓練的模型，例如 nomic-embed-text v1.5）
+RESCORE_FACTOR = 4                # 壓縮時先取 k × RESCORE_FACTOR 個候選再用完整精度重新計分；0 表示不重新計分
+SCORE_BLOCK_ROWS = 8192           # 壓縮矩陣每次轉成 float32 計分的列數，限制暫存記憶體
+QUANTIZATIONS = ("float32", "float16", "int8")
+
+# snapshot 檔案格式
+SNAPSHOT_MAGIC = b"OTVSNAP\0"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+
+# 索引版本標記：create_vector_db.py / ingest_pipeline.py 更新索引後改寫這個檔案，
+# app.py 的長駐 handle 看到它變了就重新載入
+INDEX_VERSION_FILENAME = "index_version.json"
+# =======================================
+
+
+def _value_key(value):
+    # True 跟 1 在 dict 裡是同一個 key，連型別一起編碼才不會混在一起
+    return type(value).__name__, value
+
+
+class MetadataColumn:
+    """一個 metadata 欄位：每筆資料存成整數編碼（沒有這個欄位為 -1），比對條件時產生布林遮罩"""
+
+    def __init__(self, values: Sequence[Any]):
+        self.vocab: Dict[Any, int] = {}
+        codes = np.full(len(values), -1, dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            key = _value_key(value)
+            code = self.vocab.get(key)
+            if code is None:
+                code = self.vocab[key] = len(self.vocab)
+            codes[i] = code
+        self.codes = codes
+
+    def _code(self, value) -> int:
+        return self.vocab.get(_value_key(value), -2)  # -2：不存在的值，不會跟任何一筆相等
+
+    def mask(self, condition) -> np.ndarray:
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        (op, operand), = condition.items()
+        if op == "$eq":
+            return self.codes == self._code(operand)
+        if op == "$ne":
+            return self.codes != self._code(operand)
+        if op == "$in":
+            return np.isin(self.codes, [self._code(v) for v in operand])
+        if op == "$nin":
+            return ~np.isin(self.codes, [self._code(v) for v in operand])
+        raise ValueError(f"numpy 後端不支援的 where 運算子: {op}")
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize(matrix: np.ndarray, quantization: str, dims: Optional[int] = None):
+    """把正規化後的 float32 矩陣轉成壓縮表示，回傳 (壓縮矩陣, int8 每維縮放係數或 None)。
+    dims 有設定時先截斷成前 dims 維再重新正規化（Matryoshka）"""
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"不支援的壓縮方式: {quantization}")
+    if dims and dims < matrix.shape[1]:
+        matrix = _normalize_rows(matrix[:, :dims])
+    if quantization == "float32":
+        return np.ascontiguousarray(matrix, dtype=np.float32), None
+    if quantization == "float16":
+        return matrix.astype(np.float16), None
+    # int8：每一維各自對稱縮放到 -127～127
+    scale = np.abs(matrix).max(axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+
+class NumpyVectorStore:
+    """暴力 cosine 搜尋的唯讀向量庫，query/get/count 的輸入輸出格式跟 ChromaDB collection 相同。
+    matrix 是完整精度（正規化後）的 float32 矩陣；compact 是實際拿來掃描的（可能壓縮過的）矩陣。"""
+
+    def __init__(self, ids: List[str], embeddings, documents: List[str], metadatas: List[Dict],
+                 quantization: str = DEFAULT_QUANTIZATION, dims: Optional[int] = DEFAULT_DIMS,
+                 rescore_factor: int = RESCORE_FACTOR, full_vectors_path: Optional[str] = None,
+                 normalized: bool = False):
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = [m or {} for m in metadatas]
+        self.snapshot_manifest = None
+        if normalized:
+            # 已正規化的 float32 矩陣（例如 snapshot 的 memory map）直接使用，不複製
+            full = embeddings
+        else:
+            matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if matrix.ndim != 2:
+                matrix = matrix.reshape(len(self.ids), -1)
+            # 預先正規化，cosine 相似度就是內積
+            full = _normalize_rows(matrix)
+        self.dim = full.shape[1]
+        self.quantization = quantization
+        self.dims = dims if dims and dims < full.shape[1] else None
+        self.compact, self.scale = quantize(full, quantization, self.dims)
+        self.exact = quantization == "float32" and self.dims is None
+        # 壓縮後不重新計分的話就不必留著完整精度矩陣（省下記憶體）
+        self.rescore_factor = 0 if self.exact else rescore_factor
+        self.matrix = full if (self.exact or self.rescore_factor) else None
+        if self.rescore_factor and full_vectors_path and not isinstance(full, np.memmap):
+            # 完整精度向量移到磁碟，用 memory map 讀取（先寫暫存檔再取代，重新載入時舊的 map 不受影響）
+            full.tofile(f"{full_vectors_path}.tmp")
+            os.replace(f"{full_vectors_path}.tmp", full_vectors_path)
+            self.matrix = np.memmap(full_vectors_path, dtype=np.float32, mode="r", shape=full.shape)
+        keys = {k for m in self.metadatas for k in m}
+        self.columns = {k: MetadataColumn([m.get(k) for m in self.metadatas]) for k in keys}
+
+    def memory_bytes(self) -> int:
+        """向量本身常駐的記憶體（壓縮矩陣 + 留在記憶體裡的完整精度矩陣；memory-mapped 的不算）"""
+        total = self.compact.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+        if self.matrix is not None and self.matrix is not self.compact and not isinstance(self.matrix, np.memmap):
+            total += self.matrix.nbytes
+        return total
+
+    @classmethod
+    def from_chroma(cls, collection, **options) -> "NumpyVectorStore":
+        """從 ChromaDB collection 分頁載入全部資料"""
+        ids, embeddings, documents, metadatas = [], [], [], []
+        total = collection.count()
+        for offset in range(0, total, LOAD_PAGE_SIZE):
+            page = collection.get(include=["embeddings", "documents", "metadatas"],
+                                  limit=LOAD_PAGE_SIZE, offset=offset)
+            ids.extend(page["ids"])
+            embeddings.extend(page["embeddings"])
+            documents.extend(page["documents"])
+            metadatas.extend(page["metadatas"])
+        dim = len(embeddings[0]) if embeddings else 0
+        return cls(ids, np.asarray(embeddings, dtype=np.float32).reshape(len(ids), dim), documents, metadatas,
+                   **options)
+
+    @classmethod
+    def from_snapshot(cls, path: str, **options) -> "NumpyVectorStore":
+        """開啟 snapshot：向量直接 memory map（唯讀、不複製），壓縮設定時完整精度向量也直接從 snapshot 讀"""
+        header = read_snapshot_header(path)
+        shape = (header["count"], header["dim"])
+        vectors = (np.memmap(path, dtype=np.float32, mode="r", offset=header["vectors_offset"], shape=shape)
+                   if header["count"] else np.zeros(shape, dtype=np.float32))
+        with open(path, "rb") as f:
+            f.seek(header["sidecar_offset"])
+            sidecar = json.loads(zlib.decompress(f.read(header["sidecar_length"])).decode("utf-8"))
+        options.pop("full_vectors_path", None)
+        store = cls(sidecar["ids"], vectors, sidecar["documents"], sidecar["metadatas"], normalized=True, **options)
+        store.snapshot_manifest = header["manifest"]
+        return store
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def where_mask(self, where: Optional[Dict]) -> np.ndarray:
+        """把 Chroma 的 where 條件轉成布林遮罩"""
+        mask = np.ones(len(self.ids), dtype=bool)
+        if not where:
+            return mask
+        for key, condition in where.items():
+            if key == "$and":
+                for sub in condition:
+                    mask &= self.where_mask(sub)
+            elif key == "$or":
+                any_mask = np.zeros(len(self.ids), dtype=bool)
+                for sub in condition:
+                    any_mask |= self.where_mask(sub)
+                mask &= any_mask
+            elif key in self.columns:
+                mask &= self.columns[key].mask(condition)
+            else:
+                # 沒有任何一筆有這個欄位：只有 $ne / $nin 會成立
+                op = next(iter(condition)) if isinstance(condition, dict) else "$eq"
+                if op not in ("$ne", "$nin"):
+                    mask[:] = False
+        return mask
+
+    def _compact_scores(self, queries: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """用壓縮矩陣計算 (查詢數, 候選數) 的相似度分數"""
+        if self.dims:
+            queries = _normalize_rows(queries[:, :self.dims])
+        if self.scale is not None:
+            queries = queries * self.scale  # int8 的每維縮放併進查詢向量
+        if self.compact.dtype == np.float32:
+            sub = self.compact if candidates.size == len(self.ids) else self.compact[candidates]
+            return queries @ sub.T
+        # 壓縮矩陣分段轉回 float32 再乘，避免一次展開整個矩陣
+        scores = np.empty((len(queries), candidates.size), dtype=np.float32)
+        for start in range(0, candidates.size, SCORE_BLOCK_ROWS):
+            rows = candidates[start:start + SCORE_BLOCK_ROWS]
+            scores[:, start:start + rows.size] = queries @ self.compact[rows].astype(np.float32).T
+        return scores
+
+    @staticmethod
+    def _top(row: np.ndarray, k: int) -> np.ndarray:
+        top = np.argpartition(-row, k - 1)[:k] if k < row.size else np.arange(row.size)
+        return top[np.argsort(-row[top], kind="stable")]
+
+    def _rank(self, query: np.ndarray, candidates: np.ndarray, row: np.ndarray, k: int):
+        """一個查詢在 candidates 上的前 k 名（row 為壓縮矩陣算出的分數），回傳 (列號, 相似度)"""
+        if self.rescore_factor:
+            # 壓縮分數只用來挑候選，最後排序與距離用完整精度重新計算
+            shortlist = candidates[self._top(row, min(k * self.rescore_factor, candidates.size))]
+            exact = self.matrix[shortlist] @ query
+            order = self._top(exact, k)
+            return shortlist[order], exact[order]
+        order = self._top(row, k)
+        return candidates[order], row[order]
+
+    def _append_result(self, result: Dict[str, List], indices: np.ndarray, sims: np.ndarray):
+        result["ids"].append([self.ids[i] for i in indices])
+        # 跟 Chroma 的 cosine space 一樣回傳 1 - cosine 相似度
+        result["distances"].append([float(1.0 - s) for s in sims])
+        result["documents"].append([self.documents[i] for i in indices])
+        result["metadatas"].append([self.metadatas[i] for i in indices])
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[Dict] = None,
+              include: Sequence[str] = ("documents", "metadatas", "distances")) -> Dict[str, List]:
+        return self.query_many(query_embeddings, [where] * len(query_embeddings), n_results)
+
+    def query_many(self, query_embeddings, wheres: Sequence[Optional[Dict]], n_results: int = 10) -> Dict[str, List]:
+        """每個查詢各自帶一個 where 條件（例如每個評估領域各自的領域過濾），一次算完：
+        所有查詢的候選列取聯集只做一次矩陣乘法，再各自套上自己的遮罩取前 n_results 名。
+        回傳格式跟 query 相同（每個查詢一個清單）"""
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = _normalize_rows(queries)
+        result = {"ids": [], "distances": [], "documents": [], "metadatas": [], "embeddings": None}
+        if len(queries) == 0:
+            return result
+
+        # 同樣的 where 只算一次遮罩
+        masks = {}
+        for where in wheres:
+            key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+            if key not in masks:
+                masks[key] = self.where_mask(where)
+        query_masks = [masks[json.dumps(where, sort_keys=True, ensure_ascii=False)] for where in wheres]
+        union = np.flatnonzero(np.logical_or.reduce(list(masks.values())))
+        scores = self._compact_scores(queries, union) if union.size else None
+
+        for i, (query, mask) in enumerate(zip(queries, query_masks)):
+            local = np.flatnonzero(mask[union])
+            if local.size == 0:
+                self._append_result(result, np.array([], dtype=np.int64), np.array([], dtype=np.float32))
+                continue
+            indices, sims = self._rank(query, union[local], scores[i, local], min(n_results, local.size))
+            self._append_result(result, indices, sims)
+        return result
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            include: Sequence[str] = ("documents", "metadatas")) -> Dict[str, List]:
+        mask = self.where_mask(where)
+        if ids is not None:
+            wanted = set(ids)
+            mask &= np.array([i in wanted for i in self.ids], dtype=bool)
+        indices = np.flatnonzero(mask)
+        return {
+            "ids": [self.ids[i] for i in indices],
+            "documents": [self.documents[i] for i in indices] if "documents" in include else None,
+            "metadatas": [self.metadatas[i] for i in indices] if "metadatas" in include else None,
+            "embeddings": (self.matrix if self.matrix is not None else self.compact)[indices]
+            if "embeddings" in include else None,
+        }
+
+
+def read_snapshot_header(path: str) -> Dict:
+    with open(path, "rb") as f:
+        prefix = f.read(24)
+        if len(prefix) < 24 or prefix[:8] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} 不是向量庫 snapshot 檔")
+        version, _, header_length = struct.unpack("<IIQ", prefix[8:])
+        if version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"snapshot 格式版本 {version} 與程式支援的 {SNAPSHOT_FORMAT_VERSION} 不同，請重新匯出")
+        return json.loads(f.read(header_length).decode("utf-8"))
+
+
+def write_snapshot(path: str, ids: List[str], matrix: np.ndarray, documents: List[str],
+                   metadatas: List[Dict], manifest: Dict):
+    """寫出 snapshot（先寫暫存檔再取代，正在 memory map 舊檔的程式不受影響）"""
+    matrix = np.ascontiguousarray(_normalize_rows(np.asarray(matrix, dtype=np.float32)), dtype=np.float32)
+    sidecar = zlib.compress(json.dumps({"ids": ids, "documents": documents, "metadatas": metadatas},
+                                       ensure_ascii=False).encode("utf-8"))
+    manifest = {**manifest, "created_at": datetime.now().isoformat()}
+
+    # header 長度會影響後面各段的位移，位移欄位先用固定寬度的數字佔位再回填
+    def build_header(vectors_offset, sidecar_offset):
+        return json.dumps({
+            "manifest": manifest,
+            "count": matrix.shape[0],
+            "dim": matrix.shape[1],
+            "dtype": "float32",
+            "vectors_offset": vectors_offset,
+            "sidecar_offset": sidecar_offset,
+            "sidecar_length": len(sidecar),
+            "sidecar_encoding": "zlib+json",
+        }, ensure_ascii=False).encode("utf-8")
+
+    placeholder = 10 ** 15
+    header_length = len(build_header(placeholder, placeholder))
+    vectors_offset = -(-(24 + header_length) // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+    sidecar_offset = vectors_offset + matrix.nbytes
+    header = build_header(vectors_offset, sidecar_offset).ljust(header_length)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack("<IIQ", SNAPSHOT_FORMAT_VERSION, 0, header_length))
+        f.write(header)
+        f.write(b"\0" * (vectors_offset - 24 - header_length))
+        f.write(matrix.tobytes())
+        f.write(sidecar)
+    os.replace(tmp_path, path)
+
+
+def export_snapshot(collection, path: str, manifest: Dict) -> int:
+    """把 ChromaDB collection 整個匯出成 snapshot，回傳筆數"""
+    store = NumpyVectorStore.from_chroma(collection)
+    write_snapshot(path, store.ids, store.matrix, store.documents, store.metadatas, manifest)
+    return store.count()
+
+
+def open_chroma_collection(db_path: str, collection_name: str, fresh: bool = False):
+    """fresh=True 時丟掉 chromadb 在這個行程裡快取的 client：同一路徑的 PersistentClient 會共用同一份
+    已載入的 HNSW，其他行程（建索引）寫入後不會反映出來，一定要清掉快取重新開啟才看得到新資料"""
+    import chromadb
+    if fresh:
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+    client = chromadb.PersistentClient(path=db_path)
+    return client.get_collection(collection_name)
+
+
+def snapshot_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.snapshot")
+
+
+def write_index_version(db_path: str, version: str) -> bool:
+    """版本有變時改寫索引版本標記，回傳是否有改寫"""
+    if read_index_version(db_path) == version:
+        return False
+    path = os.path.join(db_path, INDEX_VERSION_FILENAME)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"index_version": version, "updated_at": datetime.now().isoformat()}, f)
+    os.replace(f"{path}.tmp", path)
+    return True
+
+
+def read_index_version(db_path: str) -> Optional[str]:
+    path = os.path.join(db_path, INDEX_VERSION_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("index_version")
+
+
+def open_vector_store(backend: str, db_path: str, collection_name: str, fresh: bool = False, **numpy_options):
+    """依設定開啟向量庫：chroma 直接回傳 collection，numpy 從 collection 載入成記憶體矩陣，
+    snapshot 開啟 create_vector_db.py 匯出的單一檔案（numpy_options 可指定 quantization / dims / rescore_factor）"""
+    if backend == "chroma":
+        return open_chroma_collection(db_path, collection_name, fresh=fresh)
+    if backend == "numpy":
+        return NumpyVectorStore.from_chroma(open_chroma_collection(db_path, collection_name, fresh=fresh),
+                                            **numpy_options)
+    if backend == "snapshot":
+        return NumpyVectorStore.from_snapshot(snapshot_path(db_path, collection_name), **numpy_options)
+    raise ValueError(f"不支援的向量庫後端: {backend}")
+
+
+class VectorStoreHandle:
+    """整個程式共用的長駐向量庫（app.py 用）：第一次 get() 時開啟，之後每個請求都拿同一個物件，
+    不必每次重開 ChromaDB。每次 get() 檢查一次磁碟上的版本標記（snapshot 後端看 snapshot 檔本身，
+    其他後端看 index_version.json），建索引程式更新過就重新載入。
+    重新載入期間其他執行緒繼續用舊的向量庫，不會被擋住；換好之後新請求才拿到新的。"""
+
+    def __init__(self, backend: str, db_path: str, collection_name: str, **numpy_options):
+        self.backend = backend
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self.numpy_options = numpy_options
+        self.version = None  # 目前載入的索引版本（舊版索引沒有標記時為 None）
+        self.loads = 0
+        self._store = None
+        self._marker = None
+        self._lock = threading.Lock()
+
+    def _marker_path(self) -> str:
+        if self.backend == "snapshot":
+            return snapshot_path(self.db_path, self.collection_name)
+        return os.path.join(self.db_path, INDEX_VERSION_FILENAME)
+
+    def _disk_marker(self):
+        try:
+            stat = os.stat(self._marker_path())
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def get(self):
+        marker = self._disk_marker()
+        store = self._store
+        if store is not None and marker == self._marker:
+            return store
+        # 已經有向量庫時，別的執行緒正在重新載入就先用舊的
+        if not self._lock.acquire(blocking=store is None):
+            return store
+        try:
+            if self._store is not None and marker == self._marker:
+                return self._store
+            started = time.perf_counter()
+            store = open_vector_store(self.backend, self.db_path, self.collection_name,
+                                      fresh=self._store is not None, **self.numpy_options)
+            if self.backend == "snapshot":
+                self.version = (store.snapshot_manifest or {}).get("index_version")
+            else:
+                self.version = read_index_version(self.db_path)
+            self._store, self._marker = store, marker
+            self.loads += 1
+            size = (f"，常駐 {store.memory_bytes() / 1024 / 1024:.1f} MB"
+                    if isinstance(store, NumpyVectorStore) else "")
+            print(f"📦 已{'重新' if self.loads > 1 else ''}載入 {self.backend} 向量庫：{store.count()} 筆"
+                  f"（版本 {self.version or '未知'}，{time.perf_counter() - started:.2f} 秒{size}）")
+            return store
+        finally:
+            self._lock.release()